@@ -0,0 +1,235 @@
+# agent.py
+"""
+Unlock agent: holds an unlocked vault in memory and answers credential
+requests over a Unix domain socket, so short-lived jobs don't have to derive
+the master key themselves (much like ssh-agent).
+
+Protocol: one JSON object per line in each direction, using the same
+operations as `main.py pipe` (limited to AGENT_OPERATIONS).
+
+Start it with `python main.py agent`; query it with `python agent.py get <service>`
+or agent_request() from Python. The client side only needs the standard library.
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import threading
+
+import metrics
+
+AGENT_SOCKET_ENV = "CIMEDDA_AGENT_SOCKET"
+AGENT_OPERATIONS = ("get", "list", "add", "stats")
+CLIENT_TIMEOUT = 5.0  # Seconds a client waits for the agent to answer
+
+
+def default_socket_path():
+    if os.environ.get(AGENT_SOCKET_ENV):
+        return os.environ[AGENT_SOCKET_ENV]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "cimedda-agent", "agent.sock")
+    return os.path.join(tempfile.gettempdir(), f"cimedda-agent-{os.getuid()}", "agent.sock")
+
+
+def check_socket_directory(socket_path):
+    """
+    Refuse a socket whose directory another user owns or can write to: they
+    could have put their own socket there to collect our requests.
+    """
+    directory = os.path.dirname(os.path.abspath(socket_path))
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f"{directory} must be a directory owned by you and accessible to nobody else")
+
+
+# --------------------------------------------------------------------------------
+# Client
+# --------------------------------------------------------------------------------
+def agent_request(op, socket_path=None, timeout=CLIENT_TIMEOUT):
+    """Send one operation dict to the agent and return its result dict."""
+    socket_path = socket_path or default_socket_path()
+    check_socket_directory(socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(op).encode() + b"\n")
+        with sock.makefile("rb") as reader:
+            line = reader.readline()
+    if not line:
+        return {"ok": False, "error": "agent closed the connection"}
+    return json.loads(line)
+
+
+def client_main(argv=None):
+    parser = argparse.ArgumentParser(prog="agent.py", description="Query a running CimeddaManager agent")
+    parser.add_argument("--socket", help="agent socket path")
+    commands = parser.add_subparsers(dest="command", required=True)
+    get = commands.add_parser("get", help="print a credential as JSON")
+    get.add_argument("service")
+    get.add_argument("--field", choices=("username", "password", "url", "notes"))
+    listing = commands.add_parser("list", help="list service names")
+    listing.add_argument("--contains")
+    listing.add_argument("--limit", type=int)
+    commands.add_parser("stats", help="print the agent's metrics (start it with 'main.py --metrics FILE agent')")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "get":
+            result = agent_request({"op": "get", "service": args.service,
+                                    "fields": [args.field] if args.field else None}, args.socket)
+        elif args.command == "stats":
+            result = agent_request({"op": "stats"}, args.socket)
+        else:
+            result = agent_request({"op": "list", "contains": args.contains, "limit": args.limit}, args.socket)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print("No agent is running. Start one with 'python main.py agent'.", file=sys.stderr)
+        return 1
+    except PermissionError as e:
+        print(f"Not using the agent socket: {e}", file=sys.stderr)
+        return 1
+
+    if result.get("ok") and args.command == "get" and args.field:
+        print(result["record"][args.field])
+    elif result.get("ok") and args.command == "list":
+        print("\n".join(result["services"]))
+    elif result.get("ok") and args.command == "stats":
+        print(metrics.format_table(result["metrics"]))
+    else:
+        print(json.dumps(result))
+    return 0 if result.get("ok") else 1
+
+
+# --------------------------------------------------------------------------------
+# Server
+# --------------------------------------------------------------------------------
+def _prepare_socket_path(socket_path):
+    """Create a private directory for the socket and clear a stale socket left by a dead agent."""
+    directory = os.path.dirname(socket_path)
+    if directory:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    check_socket_directory(socket_path)
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socket_path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(socket_path)
+            else:
+                raise RuntimeError(f"An agent is already listening on {socket_path}")
+
+
+def _peer_uid(writer):
+    sock = writer.get_extra_info("socket")
+    if sock is None or not hasattr(socket, "SO_PEERCRED"):
+        return None
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    return struct.unpack("3i", credentials)[1]
+
+
+class Agent:
+    """
+    Serves operations through `handler` (a blocking callable taking an op dict)
+    until LOCK_TIMEOUT seconds pass without a request, then calls `on_lock`.
+    """
+
+    def __init__(self, handler, on_lock, lock_timeout, socket_path=None):
+        self.handler = handler
+        self.on_lock = on_lock
+        self.lock_timeout = lock_timeout
+        self.socket_path = socket_path or default_socket_path()
+        self._server = None
+        self._lock_handle = None
+        self._locked = None
+        self._clients = set()
+
+    def _touch(self):
+        # Re-arm the single inactivity deadline
+        if self._lock_handle is not None:
+            self._lock_handle.cancel()
+        self._lock_handle = self._loop.call_later(self.lock_timeout, self._lock)
+
+    def _lock(self):
+        if not self._locked.is_set():
+            self.on_lock()
+            self._locked.set()
+            # Idle clients would otherwise keep wait_closed() waiting forever
+            for writer in list(self._clients):
+                writer.close()
+
+    async def _handle_client(self, reader, writer):
+        self._clients.add(writer)
+        try:
+            uid = _peer_uid(writer)
+            if uid is not None and uid != os.getuid():
+                return
+            while not self._locked.is_set():
+                line = await reader.readline()
+                if not line:
+                    break
+                self._touch()
+                try:
+                    op = json.loads(line)
+                    if not isinstance(op, dict) or op.get("op") not in AGENT_OPERATIONS:
+                        result = {"ok": False, "error": f"unsupported op: {op.get('op') if isinstance(op, dict) else op!r}"}
+                    else:
+                        # Credential work is blocking (SQLite + Fernet); keep the event loop free for other clients
+                        result = await self._loop.run_in_executor(None, self.handler, op)
+                except Exception as e:
+                    result = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                writer.write(json.dumps(result).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._clients.discard(writer)
+            writer.close()
+
+    async def serve(self):
+        import asyncio
+
+        self._loop = asyncio.get_running_loop()
+        self._locked = asyncio.Event()
+        _prepare_socket_path(self.socket_path)
+
+        # Never let the socket exist with looser permissions than 0600, not even briefly
+        old_umask = os.umask(0o177)
+        try:
+            self._server = await asyncio.start_unix_server(self._handle_client, path=self.socket_path)
+        finally:
+            os.umask(old_umask)
+
+        # Terminating the agent locks it like a timeout would (signals only reach the main thread)
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGHUP):
+                self._loop.add_signal_handler(signum, self._lock)
+
+        self._touch()
+        try:
+            await self._locked.wait()
+        finally:
+            self._server.close()
+            await self._server.wait_closed()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def run(self):
+        import asyncio
+
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Whatever ended the loop, leave no key material behind
+            if not self._locked or not self._locked.is_set():
+                self.on_lock()
+
+
+if __name__ == "__main__":
+    sys.exit(client_main())
@@ -0,0 +1,161 @@
+# async_credentials.py
+"""
+asyncio façade over credentials.py for use inside async services.
+
+Nothing here blocks the event loop:
+
+- Reads (get, list, search) run on a small reader thread pool, each with its
+  own pooled connection. Records come back with the requested fields already
+  decrypted, so touching them on the loop costs nothing.
+- Writes (add, update, delete) are queued to a single writer thread. It
+  drains whatever is queued when it wakes up and applies it in one
+  transaction (one commit for the whole batch), with a savepoint per write so
+  a failing write doesn't undo the others.
+- At most `max_concurrency` operations are in flight; further callers wait.
+
+    async with AsyncCredentials(vault) as store:
+        await store.add("github", "me", "s3cret")
+        record = await store.get("github", fields=["password"])
+"""
+
+import asyncio
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import credentials
+import metrics
+from db_setup import POOL_SIZE
+from search import SEARCH_LIMIT
+
+ASYNC_READERS = POOL_SIZE       # Reader threads (one pooled connection each)
+ASYNC_MAX_CONCURRENCY = 64      # Operations in flight before callers have to wait
+ASYNC_WRITE_BATCH_SIZE = 256    # Most writes committed in one transaction
+
+_STOP = object()
+
+
+class _Write:
+    __slots__ = ('op', 'future')
+
+    def __init__(self, op):
+        self.op = op  # A write tuple as taken by credentials.apply_writes
+        self.future = Future()
+
+
+class AsyncCredentials:
+    """Async credential operations on one vault (the default vault unless given one)."""
+
+    def __init__(self, vault=None, readers=ASYNC_READERS, max_concurrency=ASYNC_MAX_CONCURRENCY,
+                 write_batch_size=ASYNC_WRITE_BATCH_SIZE):
+        self.vault = vault if vault is not None else credentials.default_vault()
+        self.write_batch_size = write_batch_size
+        self._readers = ThreadPoolExecutor(readers, thread_name_prefix="credentials-reader")
+        self._limit = asyncio.Semaphore(max_concurrency)
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="credentials-writer", daemon=True)
+        self._writer.start()
+        self._closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """Finish the queued writes, then stop the writer thread and the reader pool."""
+        if self._closed:
+            return
+        self._closed = True
+        self._writes.put(_STOP)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._writer.join)
+        await loop.run_in_executor(None, self._readers.shutdown)
+
+    # ----------------------------------------------------------------------------
+    # Reads
+    # ----------------------------------------------------------------------------
+    async def _read(self, func, *args):
+        if self._closed:
+            raise RuntimeError("AsyncCredentials is closed.")
+        async with self._limit:
+            return await asyncio.get_running_loop().run_in_executor(self._readers, func, *args)
+
+    def _get(self, service, fields):
+        record = credentials.get_credential(service, vault=self.vault)
+        if record is not None:
+            # Decrypt here, on the reader thread, rather than when the caller reads the attributes
+            for field in fields or record.FIELDS:
+                getattr(record, field)
+        return record
+
+    async def get(self, service, fields=None):
+        """The CredentialRecord for `service` (or None) with `fields` (default: all) decrypted."""
+        return await self._read(self._get, service, fields)
+
+    async def list_services(self):
+        return await self._read(credentials.list_services, self.vault)
+
+    async def search(self, query, limit=SEARCH_LIMIT, fuzzy=True):
+        return await self._read(lambda: credentials.search_services(query, limit, fuzzy, vault=self.vault))
+
+    # ----------------------------------------------------------------------------
+    # Writes
+    # ----------------------------------------------------------------------------
+    async def _write(self, *op):
+        if self._closed:
+            raise RuntimeError("AsyncCredentials is closed.")
+        async with self._limit:
+            write = _Write(op)
+            self._writes.put(write)
+            return await asyncio.wrap_future(write.future)
+
+    async def add(self, service, username, password, url='', notes=''):
+        await self._write("add", service, username, password, url, notes)
+
+    async def update(self, service, username=None, password=None, url=None, notes=None) -> bool:
+        """Like credentials.update_credential: blank fields keep their value. Returns False if nothing changed."""
+        return await self._write("update", service, username, password, url, notes)
+
+    async def delete(self, service) -> bool:
+        return await self._write("delete", service)
+
+    def _write_loop(self):
+        while True:
+            batch = [self._writes.get()]
+            # Everything that queued up meanwhile goes into the same transaction
+            while batch[-1] is not _STOP and len(batch) < self.write_batch_size:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is _STOP
+            if stop:
+                batch.pop()
+            if batch:
+                self._apply(batch)
+            if stop:
+                return
+
+    def _apply(self, batch):
+        # Writes whose caller gave up (cancelled) before we got to them are skipped
+        batch = [write for write in batch if write.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            with metrics.timer("async.write_batch"), self.vault.connection() as conn:
+                results = credentials.apply_writes(conn, [write.op for write in batch], self.vault)
+        except Exception as e:
+            for write in batch:
+                write.future.set_exception(e)
+            return
+        metrics.count("async.write_batches")
+        metrics.count("async.writes", len(batch))
+
+        # apply_writes has already updated the cache and search index, so callers see their writes
+        for write, result in zip(batch, results):
+            if isinstance(result, Exception):
+                write.future.set_exception(result)
+            else:
+                write.future.set_result(result)
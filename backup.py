@@ -0,0 +1,371 @@
+# backup.py
+"""
+Point-in-time backups of a vault: its database together with the salt,
+verification token and KDF parameters it was encrypted under.
+
+Each backup is a directory inside the backup directory, named after the time
+it was taken:
+
+    20261018T101500123456Z-full/
+        manifest.json           kind, base backup, key version, SHA-256 of every file
+        salt.bin, verify.bin, kdf.json
+        secure_passwords.db     full snapshots
+        changes.db              incremental backups (rows written since the base backup)
+
+Full snapshots use SQLite's online backup API and copy BACKUP_PAGES_PER_STEP
+pages at a time, so readers and writers keep going while a large vault is
+copied. Incremental backups copy only the rows whose updated_at is past the
+previous backup's watermark (plus rows the previous backup didn't have) and
+the list of live ids, so deletions are replayed too. Rows are copied exactly
+as stored (encrypted), which is why backing up needs no master password.
+
+    backup.backup("backups")                    # full snapshot
+    backup.backup("backups", incremental=True)  # rows changed since the last backup
+    backup.restore("backups/20261018T101500123456Z-incremental", "restored-vault")
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+
+import metrics
+from db_setup import DB_PATH, SCHEMA_VERSION, get_db_connection
+
+BACKUP_PAGES_PER_STEP = 256      # Database pages copied per step of a full snapshot
+BACKUP_STEP_SLEEP = 0.005        # Seconds between steps, for the other connections to get in
+BACKUP_MAX_RESTARTS = 3          # Restarts (source written meanwhile) before copying the rest in one step
+BACKUP_KEY_FILE_RETRIES = 3      # Attempts when the key files change while the database is copied
+# Rows written less than this many seconds before a backup are copied again by the next incremental
+# backup, so rows from transactions still open when the backup started aren't missed
+BACKUP_WATERMARK_SLACK = 300
+
+MANIFEST_NAME = "manifest.json"
+CHANGES_DB = "changes.db"
+VERIFY_FILE = "verify.bin"  # Restore writes it last: a vault counts as set up once it exists
+BACKUP_FORMAT = 1
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def _vault(vault):
+    if vault is None:
+        from credentials import default_vault
+        return default_vault()
+    return vault
+
+
+def _read_key_files(vault):
+    """{file name: contents} of the vault's salt, verification token and KDF parameters (those that exist)."""
+    contents = {}
+    for path in (vault.salt_path, vault.kdf_path, vault.verify_path):
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                contents[os.path.basename(path)] = f.read()
+    return contents
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _vault_state(conn, schema="main"):
+    """Key version and row counts of the database `schema` on `conn`; refuses mid-rotation or outdated schemas."""
+    version = conn.execute(f"PRAGMA {schema}.user_version").fetchone()[0]
+    if version != SCHEMA_VERSION:
+        raise RuntimeError(f"The vault schema is at version {version}, not {SCHEMA_VERSION}. "
+                           f"Open the vault once (or run 'main.py migrate') before backing it up.")
+    key_version, target_version = conn.execute(
+        f"SELECT key_version, target_version FROM {schema}.key_rotation WHERE id = 1").fetchone()
+    if target_version is not None:
+        raise RuntimeError("A master password change is in progress; back up once it has finished.")
+    rows, legacy_rows, unindexed_rows = conn.execute(f'''
+        SELECT COUNT(*), COALESCE(SUM(record_format <> 2), 0), COALESCE(SUM(search_indexed = 0), 0)
+        FROM {schema}.credentials
+    ''').fetchone()
+    history_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {schema}.credential_history").fetchone()[0]
+    return {"schema_version": version, "key_version": key_version, "rows": rows,
+            "legacy_rows": legacy_rows, "unindexed_rows": unindexed_rows, "history_id": history_id}
+
+
+def _watermark(conn):
+    """Rows with updated_at at or after this may not be in a backup whose read started just before."""
+    return conn.execute("SELECT datetime('now', ?)", (f"-{BACKUP_WATERMARK_SLACK} seconds",)).fetchone()[0]
+
+
+def _full_backup_reason(base, state):
+    """Why an incremental backup on top of `base` can't be taken (None if it can)."""
+    if base is None:
+        return "no earlier backup"
+    if base["schema_version"] != state["schema_version"]:
+        return "the schema changed"
+    if base["key_version"] != state["key_version"]:
+        return "the master password changed"
+    if base["legacy_rows"] or base["unindexed_rows"]:
+        # Their backfills rewrite rows without touching updated_at
+        return "the earlier backup has rows awaiting a data migration"
+    return None
+
+
+# --------------------------------------------------------------------------------
+# Listing
+# --------------------------------------------------------------------------------
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def list_backups(directory):
+    """Manifests of the finished backups in `directory`, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    backups = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not name.startswith(".") and os.path.exists(os.path.join(path, MANIFEST_NAME)):
+            backups.append(read_manifest(path))
+    return backups
+
+
+def _backup_chain(path):
+    """The manifests a restore of `path` applies: its full snapshot, then each incremental backup up to `path`."""
+    path = os.path.normpath(path)
+    directory = os.path.dirname(path)
+    chain = [read_manifest(path)]
+    while chain[0]["base"] is not None:
+        base_path = os.path.join(directory, chain[0]["base"])
+        if not os.path.exists(os.path.join(base_path, MANIFEST_NAME)):
+            raise ValueError(f"Backup {chain[0]['name']} builds on {chain[0]['base']}, which is missing.")
+        chain.insert(0, read_manifest(base_path))
+    return directory, chain
+
+
+# --------------------------------------------------------------------------------
+# Taking backups
+# --------------------------------------------------------------------------------
+def _copy_database(source, target, pages_per_step, step_sleep):
+    """Online backup of `source` into `target`, `pages_per_step` pages at a time."""
+    restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            # Another connection wrote to the database, so SQLite started the copy over
+            restarts += 1
+            metrics.count("backup.restarts")
+            if restarts > BACKUP_MAX_RESTARTS:
+                raise _TooManyRestarts()
+        last_remaining = remaining
+
+    try:
+        source.backup(target, pages=pages_per_step, progress=progress, sleep=step_sleep)
+    except _TooManyRestarts:
+        # Under steady writes, copy everything in one step. That is a single read
+        # transaction, which in WAL mode blocks neither readers nor writers.
+        source.backup(target)
+
+
+def _take_full(vault, path, pages_per_step, step_sleep):
+    db_file = os.path.join(path, os.path.basename(DB_PATH))
+    source = get_db_connection(vault.db_path)
+    target = sqlite3.connect(db_file)
+    try:
+        # Taken before the copy starts, so every row older than it is in the copy
+        watermark = _watermark(source)
+        _copy_database(source, target, pages_per_step, step_sleep)
+        state = _vault_state(target)
+    finally:
+        source.close()
+        target.close()
+    state["watermark"] = watermark
+    return state
+
+
+def _take_incremental(vault, path, base_path, base):
+    """Copy the rows changed since `base`; returns (state, None) or (None, reason) when a full backup is needed."""
+    ids_file, ids_table = ((os.path.join(base_path, CHANGES_DB), "live_ids") if base["kind"] == "incremental"
+                           else (os.path.join(base_path, os.path.basename(DB_PATH)), "credentials"))
+    conn = sqlite3.connect(os.path.join(path, CHANGES_DB), isolation_level=None)
+    try:
+        conn.execute("ATTACH DATABASE ? AS live", (vault.db_path,))
+        conn.execute("ATTACH DATABASE ? AS base", (ids_file,))
+        conn.execute("BEGIN")
+        # The first read of `live` fixes the snapshot every statement below sees
+        state = _vault_state(conn, "live")
+        state["watermark"] = _watermark(conn)
+        reason = _full_backup_reason(base, state)
+        if reason is not None:
+            conn.execute("ROLLBACK")
+            return None, reason
+        conn.execute(f'''
+            CREATE TABLE credentials AS SELECT * FROM live.credentials
+            WHERE updated_at >= ? OR id NOT IN (SELECT id FROM base.{ids_table})
+        ''', (base["watermark"],))
+        conn.execute('''
+            CREATE TABLE search_tokens AS SELECT token, credential_id FROM live.search_tokens
+            WHERE credential_id IN (SELECT id FROM credentials)
+        ''')
+        # History is append-only: the versions added since (pruning isn't replayed)
+        conn.execute("CREATE TABLE credential_history AS SELECT * FROM live.credential_history WHERE id > ?",
+                     (base["history_id"],))
+        conn.execute("CREATE TABLE live_ids (id INTEGER PRIMARY KEY)")
+        conn.execute("INSERT INTO live_ids SELECT id FROM live.credentials")
+        state["changed_rows"] = conn.execute("SELECT COUNT(*) FROM credentials").fetchone()[0]
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return state, None
+
+
+def _new_backup_name(kind):
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%fZ") + "-" + kind
+
+
+def backup(directory, vault=None, incremental=False, pages_per_step=BACKUP_PAGES_PER_STEP,
+           step_sleep=BACKUP_STEP_SLEEP) -> dict:
+    """
+    Back `vault` up into a new subdirectory of `directory` and return its manifest.
+
+    With incremental=True only the rows changed since the newest backup in
+    `directory` are copied. A full snapshot is taken instead when there is no
+    earlier backup or the master password or schema changed since (the
+    manifest's "reason" says why). The vault doesn't need to be unlocked.
+    """
+    vault = _vault(vault)
+    if not os.path.exists(vault.db_path) or not os.path.exists(vault.verify_path):
+        raise FileNotFoundError(f"No vault to back up at {vault.db_path}.")
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    backups = list_backups(directory)
+    base = backups[-1] if incremental and backups else None
+    reason = None if base is not None else ("no earlier backup" if incremental else None)
+
+    with metrics.timer("backup.incremental" if base is not None else "backup.full"):
+        for _ in range(BACKUP_KEY_FILE_RETRIES):
+            kind = "incremental" if base is not None else "full"
+            name = _new_backup_name(kind)
+            tmp_path = os.path.join(directory, "." + name)
+            os.makedirs(tmp_path, mode=0o700)
+            try:
+                key_files = _read_key_files(vault)
+                state = None
+                if base is not None:
+                    state, reason = _take_incremental(vault, tmp_path, os.path.join(directory, base["name"]), base)
+                    if state is None:
+                        base, kind = None, "full"
+                        name = _new_backup_name(kind)
+                        os.remove(os.path.join(tmp_path, CHANGES_DB))
+                if state is None:
+                    state = _take_full(vault, tmp_path, pages_per_step, step_sleep)
+                if _read_key_files(vault) != key_files:
+                    # A master password change got in between: the files may not match the copied rows
+                    shutil.rmtree(tmp_path)
+                    continue
+            except BaseException:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                raise
+
+            for file_name, contents in key_files.items():
+                with open(os.path.join(tmp_path, file_name), 'wb') as f:
+                    f.write(contents)
+            manifest = {
+                "format": BACKUP_FORMAT,
+                "name": name,
+                "kind": kind,
+                "base": base["name"] if base is not None else None,
+                "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+                **state,
+                "key_files": list(key_files),
+                "files": {file_name: _sha256(os.path.join(tmp_path, file_name))
+                          for file_name in sorted(os.listdir(tmp_path))},
+            }
+            if reason is not None:
+                manifest["reason"] = reason
+            with open(os.path.join(tmp_path, MANIFEST_NAME), 'w') as f:
+                json.dump(manifest, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            # Only complete backups ever carry their final name
+            os.rename(tmp_path, os.path.join(directory, name))
+            return manifest
+    raise RuntimeError("The vault's key files kept changing during the backup; try again.")
+
+
+# --------------------------------------------------------------------------------
+# Restoring
+# --------------------------------------------------------------------------------
+def _check_files(path, manifest):
+    for file_name, digest in manifest["files"].items():
+        file_path = os.path.join(path, file_name)
+        if not os.path.exists(file_path) or _sha256(file_path) != digest:
+            raise ValueError(f"Backup {manifest['name']} is damaged ({file_name} is missing or altered).")
+
+
+def _apply_changes(conn, changes_file):
+    conn.execute("ATTACH DATABASE ? AS changes", (changes_file,))
+    try:
+        columns = ", ".join(row[1] for row in conn.execute("PRAGMA changes.table_info(credentials)"))
+        conn.execute("BEGIN")
+        history_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM credential_history").fetchone()[0]
+        # The delete triggers drop the search tokens of deleted rows, and add history versions
+        # that the backup already has (copied below)
+        conn.execute("DELETE FROM credentials WHERE id NOT IN (SELECT id FROM changes.live_ids)")
+        conn.execute("DELETE FROM credential_history WHERE id > ?", (history_id,))
+        conn.execute("INSERT INTO credential_history SELECT * FROM changes.credential_history")
+        conn.execute("DELETE FROM search_tokens WHERE credential_id IN (SELECT id FROM changes.credentials)")
+        conn.execute(f"INSERT OR REPLACE INTO credentials ({columns}) SELECT {columns} FROM changes.credentials")
+        conn.execute('''
+            INSERT OR IGNORE INTO search_tokens (token, credential_id)
+            SELECT token, credential_id FROM changes.search_tokens
+        ''')
+        conn.execute("COMMIT")
+    finally:
+        conn.execute("DETACH DATABASE changes")
+
+
+def restore(backup_path, target_directory) -> dict:
+    """
+    Rebuild a vault in `target_directory` (which must not hold one yet) from
+    the backup at `backup_path` and the backups it builds on. Returns the
+    manifest of `backup_path`. Open the result with Vault(target_directory).
+    """
+    directory, chain = _backup_chain(backup_path)
+    for manifest in chain:
+        _check_files(os.path.join(directory, manifest["name"]), manifest)
+
+    os.makedirs(target_directory, mode=0o700, exist_ok=True)
+    db_file = os.path.join(target_directory, os.path.basename(DB_PATH))
+    for existing in (db_file, os.path.join(target_directory, VERIFY_FILE)):
+        if os.path.exists(existing):
+            raise FileExistsError(f"{existing} already exists; restore into a new directory.")
+
+    with metrics.timer("backup.restore"):
+        tmp_file = db_file + ".restore"
+        shutil.copyfile(os.path.join(directory, chain[0]["name"], os.path.basename(DB_PATH)), tmp_file)
+        try:
+            conn = sqlite3.connect(tmp_file, isolation_level=None)
+            try:
+                for manifest in chain[1:]:
+                    _apply_changes(conn, os.path.join(directory, manifest["name"], CHANGES_DB))
+            finally:
+                conn.close()
+            last = os.path.join(directory, chain[-1]["name"])
+            for file_name in chain[-1]["key_files"]:
+                if file_name != VERIFY_FILE:
+                    shutil.copyfile(os.path.join(last, file_name), os.path.join(target_directory, file_name))
+            os.replace(tmp_file, db_file)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        shutil.copyfile(os.path.join(last, VERIFY_FILE), os.path.join(target_directory, VERIFY_FILE))
+    return chain[-1]
@@ -0,0 +1,107 @@
+# benchmarks/bench_backup.py
+"""
+Time full and incremental backups of a synthetic vault and a restore of the
+result, and show what a full snapshot costs concurrent readers: the latency
+of get_credential while the snapshot is being taken versus on an idle vault.
+
+    python benchmarks/bench_backup.py [--rows 100000] [--changed 1000] [--pages 256]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backup  # noqa: E402
+import credentials  # noqa: E402
+from vault import Vault  # noqa: E402
+
+MASTER_PASSWORD = b"benchmark master password"
+
+
+def read_latencies(vault, rows, stop):
+    """get_credential latencies (ms) on random services until `stop` is set."""
+    latencies = []
+    i = 0
+    while not stop.is_set():
+        service = f"service-{(i * 7919) % rows:07d}"
+        start = time.perf_counter()
+        credentials.get_credential(service, vault=vault)
+        latencies.append((time.perf_counter() - start) * 1000)
+        i += 1
+    return latencies
+
+
+def with_readers(vault, rows, func):
+    """Run func() while a reader thread keeps calling get_credential; returns (seconds, reader latencies)."""
+    stop = threading.Event()
+    result = {}
+    reader = threading.Thread(target=lambda: result.setdefault("latencies", read_latencies(vault, rows, stop)))
+    reader.start()
+    start = time.perf_counter()
+    try:
+        func()
+    finally:
+        elapsed = time.perf_counter() - start
+        stop.set()
+        reader.join()
+    return elapsed, result["latencies"]
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return (statistics.median(latencies), latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--changed", type=int, default=1000, help="rows updated before the incremental backup")
+    parser.add_argument("--pages", type=int, default=backup.BACKUP_PAGES_PER_STEP, help="pages per backup step")
+    args = parser.parse_args()
+
+    # Only rows written after the full snapshot should count as changed
+    backup.BACKUP_WATERMARK_SLACK = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        vault = Vault(os.path.join(tmp, "vault"))
+        vault.create(MASTER_PASSWORD)
+        credentials.add_credentials_bulk(
+            ((f"service-{i:07d}", f"user{i}@example.com", f"p@ssw0rd-{i}", f"https://service-{i}.example.com",
+              "created by benchmark") for i in range(args.rows)), vault=vault)
+        time.sleep(1.1)  # updated_at has one-second resolution
+        size = os.path.getsize(vault.db_path) / 2 ** 20
+        print(f"vault: {args.rows} rows, {size:.1f} MiB")
+
+        _, idle = with_readers(vault, args.rows, lambda: time.sleep(1))
+        backups = os.path.join(tmp, "backups")
+        full_seconds, during = with_readers(
+            vault, args.rows, lambda: backup.backup(backups, vault=vault, pages_per_step=args.pages))
+
+        time.sleep(1.1)
+        step = max(1, args.rows // args.changed)
+        credentials.update_credentials_bulk(
+            ((f"service-{i:07d}", None, f"changed-{i}", None, None) for i in range(0, args.rows, step)), vault=vault)
+        start = time.perf_counter()
+        manifest = backup.backup(backups, vault=vault, incremental=True)
+        incremental_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        backup.restore(os.path.join(backups, manifest["name"]), os.path.join(tmp, "restored"))
+        restore_seconds = time.perf_counter() - start
+        vault.lock()
+
+    print(f"full backup:        {full_seconds:8.2f} s ({size / full_seconds:.0f} MiB/s)")
+    print(f"incremental backup: {incremental_seconds:8.2f} s ({manifest['changed_rows']} changed rows)")
+    print(f"restore (full+incr):{restore_seconds:8.2f} s")
+    for label, latencies in (("idle", idle), ("during full backup", during)):
+        p50, p99 = percentiles(latencies)
+        print(f"get_credential {label:<20} p50 {p50:7.3f} ms  p99 {p99:7.3f} ms  ({len(latencies)} reads)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+# benchmarks/bench_concurrency.py
+"""
+Multi-process stress test: several processes add, update and read
+credentials in one vault at the same time while another process changes the
+master password partway through. Writes wait while the vault is re-encrypted,
+so the seconds of the change show a dip.
+
+Every worker owns its own services and remembers the last password it got
+acknowledged for each. Workers whose key went stale during the change unlock
+again with the new password. Afterwards the vault is checked with the final
+key: every acknowledged write must be there with its last value, nothing else
+may be, and every row and history version must carry the current key version
+and decrypt. Throughput is printed per second, so stalls show up. The script
+exits with status 1 if anything was lost or left under the old key.
+
+    python benchmarks/bench_concurrency.py [--processes 4] [--seconds 10] [--rotate-at 3]
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import credentials  # noqa: E402
+import metrics  # noqa: E402
+import security  # noqa: E402
+from vault import Vault  # noqa: E402
+
+OLD_PASSWORD = b"benchmark master password"
+NEW_PASSWORD = b"benchmark master password, changed"
+
+
+def unlock(directory):
+    vault = Vault(directory)
+    # Mid-change either password may be the current one
+    for password in (NEW_PASSWORD, OLD_PASSWORD):
+        if vault.open(password):
+            return vault
+    raise RuntimeError("Neither password unlocks the vault.")
+
+
+def worker(number, directory, ready, seconds, results):
+    metrics.enable()
+    rng = random.Random(number)
+    vault = unlock(directory)
+    acknowledged = {}  # service -> last password written
+    services = []
+    per_second = {}
+    errors = []
+    reunlocks = 0
+    counter = 0
+    ready.wait()  # Start together, once every process has derived its key
+    start = time.time()
+    deadline = start + seconds
+    while time.time() < deadline:
+        counter += 1
+        password = f"{number}-{counter}"
+        if not services or rng.random() < 0.3:
+            service, op = f"w{number}-{len(services):06d}", "add"
+        else:
+            service, op = rng.choice(services), rng.choice(("update", "get"))
+        try:
+            if op == "add":
+                credentials.add_credential(service, f"user{number}", password, vault=vault)
+                acknowledged[service] = password
+                services.append(service)
+            elif op == "update":
+                credentials.update_credential(service, password=password, vault=vault)
+                acknowledged[service] = password
+            else:
+                record = credentials.get_credential(service, vault=vault)
+                if record is None or record.password != acknowledged[service]:
+                    errors.append(f"{service}: read {record and record.password!r}, "
+                                  f"expected {acknowledged[service]!r}")
+        except credentials.KeyVersionChanged:
+            # Another process changed the master password: unlock with the new one and go on
+            vault.lock()
+            vault = unlock(directory)
+            reunlocks += 1
+            continue
+        except credentials.RotationInProgress:
+            # A read hit a row the change has already re-encrypted: wait for it to finish
+            time.sleep(0.01)
+            continue
+        except Exception as e:
+            errors.append(f"{op} {service}: {type(e).__name__}: {e}")
+            continue
+        second = int(time.time() - start)
+        per_second[second] = per_second.get(second, 0) + 1
+    vault.lock()
+    results.put({"worker": number, "acknowledged": acknowledged, "per_second": per_second, "errors": errors,
+                 "reunlocks": reunlocks, "counters": metrics.snapshot()["counters"]})
+
+
+def rotator(directory, ready, rotate_at, results):
+    vault = unlock(directory)
+    ready.wait()
+    start = time.time()
+    time.sleep(rotate_at)
+    began = time.time()
+    try:
+        vault.set_session(security.set_master_password(vault.session, NEW_PASSWORD, vault))
+        results.put({"rotation": (began - start, time.time() - start)})
+    except Exception as e:
+        results.put({"rotation": None, "error": f"{type(e).__name__}: {e}"})
+    finally:
+        vault.lock()
+
+
+def verify(directory, acknowledged):
+    """Problems found with the final key: lost, stray, stale or undecryptable rows."""
+    problems = []
+    vault = Vault(directory)
+    if not vault.open(NEW_PASSWORD):
+        return ["the new master password doesn't unlock the vault"]
+    try:
+        with vault.connection() as conn:
+            key_version = conn.execute("SELECT key_version FROM key_rotation WHERE id = 1").fetchone()[0]
+            for table in ("credentials", "credential_history"):
+                stale = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE key_version <> ?",
+                                     (key_version,)).fetchone()[0]
+                if stale:
+                    problems.append(f"{stale} {table} rows under an old key version")
+        stored = {}
+        for record in credentials.iter_credentials(vault=vault):
+            stored[record.service] = record.password
+        for service, password in acknowledged.items():
+            if service not in stored:
+                problems.append(f"{service}: lost")
+            elif stored[service] != password:
+                problems.append(f"{service}: {stored[service]!r} instead of {password!r}")
+        problems.extend(f"{service}: never acknowledged" for service in stored.keys() - acknowledged.keys())
+        for service in list(acknowledged)[:200]:
+            for version in credentials.get_credential_history(service, vault=vault):
+                if version.password == credentials.DECRYPTION_FAILED:
+                    problems.append(f"{service}: history version {version.version} doesn't decrypt")
+    finally:
+        vault.lock()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=4, help="writer processes")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--rotate-at", type=float, default=3, help="seconds in when the master password changes")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        Vault(tmp).create(OLD_PASSWORD)
+        results = multiprocessing.Queue()
+        ready = multiprocessing.Barrier(args.processes + 1)
+        processes = [multiprocessing.Process(target=worker, args=(n, tmp, ready, args.seconds, results))
+                     for n in range(args.processes)]
+        processes.append(multiprocessing.Process(target=rotator, args=(tmp, ready, args.rotate_at, results)))
+        for process in processes:
+            process.start()
+        reports = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        workers = [report for report in reports if "worker" in report]
+        rotation = next(report for report in reports if "rotation" in report)
+        acknowledged = {}
+        for report in workers:
+            acknowledged.update(report["acknowledged"])
+        problems = [error for report in workers for error in report["errors"]]
+        if rotation["rotation"] is None:
+            problems.append(f"master password change failed: {rotation['error']}")
+        problems.extend(verify(tmp, acknowledged))
+
+    seconds = range(int(args.seconds))
+    totals = [sum(report["per_second"].get(second, 0) for report in workers) for second in seconds]
+    print(f"{'second':>6} {'ops':>8}")
+    for second, total in zip(seconds, totals):
+        print(f"{second:>6} {total:>8}")
+    if rotation["rotation"] is not None:
+        began, ended = rotation["rotation"]
+        print(f"master password change: {began:.1f}s to {ended:.1f}s")
+    mean = statistics.mean(totals)
+    print(f"throughput: mean {mean:.0f} ops/s, stdev {statistics.pstdev(totals):.0f}, min {min(totals)}")
+    counters = {}
+    for report in workers:
+        for name, value in report["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+    print(f"busy retries: {counters.get('db.busy_retries', 0)}, rotation waits: {counters.get('db.rotation_waits', 0)}, "
+          f"re-unlocks: {sum(report['reunlocks'] for report in workers)}")
+    print(f"rows checked: {len(acknowledged)}")
+
+    if problems:
+        print(f"{len(problems)} problems:")
+        for problem in problems[:20]:
+            print(f"  {problem}")
+        sys.exit(1)
+    print("No lost or mixed-key rows.")
+
+
+if __name__ == "__main__":
+    main()
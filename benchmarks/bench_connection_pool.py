@@ -0,0 +1,79 @@
+# benchmarks/bench_connection_pool.py
+"""
+Compare credential operations using a fresh connection per call (the old
+get_db_connection/close pattern) against the shared connection pool.
+
+    python benchmarks/bench_connection_pool.py [--ops 2000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import credentials  # noqa: E402
+import db_setup  # noqa: E402
+
+
+def per_call_add(service, username, password, url='', notes=''):
+    cipher = credentials.get_cipher()
+    conn = db_setup.get_db_connection(db_setup.DB_PATH)
+    conn.execute('''
+        INSERT INTO credentials (service, username, password, url, notes)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (service, cipher.encrypt(username.encode()), cipher.encrypt(password.encode()),
+          cipher.encrypt(url.encode()) if url else b"", cipher.encrypt(notes.encode()) if notes else b""))
+    conn.commit()
+    conn.close()
+
+
+def per_call_get(service):
+    conn = db_setup.get_db_connection(db_setup.DB_PATH)
+    row = conn.execute("SELECT id, service, username, password, url, notes, created_at, updated_at "
+                       "FROM credentials WHERE service = ?", (service,)).fetchone()
+    conn.close()
+    cipher = credentials.get_cipher()
+    return tuple(cipher.decrypt(value).decode() if value else "" for value in row[2:6]) if row else None
+
+
+def run(label, add, get, ops):
+    start = time.perf_counter()
+    for i in range(ops):
+        add(f"{label}-service-{i}", f"user{i}", f"password{i}", "https://example.com")
+    add_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(ops):
+        get(f"{label}-service-{i}")
+    get_elapsed = time.perf_counter() - start
+
+    print(f"{label:<10} add: {ops / add_elapsed:10.1f} ops/sec   get: {ops / get_elapsed:10.1f} ops/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ops", type=int, default=2000, help="operations per phase")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The old code path used the default rollback journal, so give it its own file
+        db_setup.DB_PATH = os.path.join(tmp, "per_call.db")
+        db_setup.initialize_db()
+        db_setup.close_pool()
+        conn = db_setup.get_db_connection(db_setup.DB_PATH)
+        conn.execute("PRAGMA journal_mode = DELETE")
+        conn.close()
+
+        credentials.reinitialize_cipher(os.urandom(32))
+        run("per-call", per_call_add, per_call_get, args.ops)
+
+        db_setup.DB_PATH = os.path.join(tmp, "pooled.db")
+        db_setup.initialize_db()
+        run("pooled", credentials.add_credential, credentials.get_credential, args.ops)
+        db_setup.close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# benchmarks/bench_import_export.py
+"""
+Generate a synthetic CSV fixture (1M rows by default), import it and export
+it again in every format, reporting rows/sec for each step.
+
+    python benchmarks/bench_import_export.py [--rows 1000000] [--workers N]
+"""
+
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import credentials  # noqa: E402
+import db_setup  # noqa: E402
+import transfer  # noqa: E402
+
+
+def write_fixture(path, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(transfer.EXPORT_FIELDS)
+        for i in range(rows):
+            writer.writerow((f"service-{i:07d}", f"user{i}@example.com", f"pw-{i:x}-{i * 7919:x}",
+                             f"https://host{i % 1000}.example.com/login", f"notes for row {i}"))
+
+
+def report(label, result):
+    print(f"{label:<16} {result.rows:>9} rows  {result.elapsed:7.2f}s  {result.rows_per_second:10.0f} rows/sec"
+          f"  ({result.error_count} errors)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--workers", type=int, default=None, help="crypto worker threads (default: CPU count)")
+    args = parser.parse_args()
+
+    credentials.default_vault().crypto_workers = args.workers
+    credentials.reinitialize_cipher(os.urandom(32))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_setup.DB_PATH = os.path.join(tmp, "bench.db")
+        db_setup.initialize_db(quiet=True)
+
+        fixture = os.path.join(tmp, "fixture.csv")
+        start = time.perf_counter()
+        write_fixture(fixture, args.rows)
+        print(f"fixture written in {time.perf_counter() - start:.2f}s")
+
+        report("import csv", transfer.import_csv(fixture))
+        report("export csv", transfer.export_csv(os.path.join(tmp, "out.csv")))
+        report("export jsonl", transfer.export_jsonl(os.path.join(tmp, "out.jsonl")))
+        report("export archive", transfer.export_archive(os.path.join(tmp, "out.bak"), b"benchmark"))
+        db_setup.close_pool()
+
+
+if __name__ == "__main__":
+    main()
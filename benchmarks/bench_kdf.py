@@ -0,0 +1,70 @@
+# benchmarks/bench_kdf.py
+"""
+Report unlock (key derivation) time across KDF parameter settings, plus the
+parameters calibrate_kdf() picks on this host.
+
+    python benchmarks/bench_kdf.py [--repeat 3] [--target 0.5]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import security  # noqa: E402
+
+SETTINGS = [
+    {"algorithm": "pbkdf2-sha256", "iterations": 100000},
+    {"algorithm": "pbkdf2-sha256", "iterations": 300000},
+    {"algorithm": "pbkdf2-sha256", "iterations": 600000},
+    {"algorithm": "scrypt", "n": 2 ** 14, "r": 8, "p": 1},
+    {"algorithm": "scrypt", "n": 2 ** 15, "r": 8, "p": 1},
+    {"algorithm": "scrypt", "n": 2 ** 16, "r": 8, "p": 1},
+    {"algorithm": "argon2id", "iterations": 3, "lanes": 4, "memory_cost": 64 * 1024},
+]
+
+
+def unlock_time(params, repeat):
+    salt = os.urandom(16)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        security.derive_key(b"benchmark password", salt, params=params)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def describe(params):
+    return ", ".join(f"{name}={value}" for name, value in params.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--target", type=float, default=security.KDF_TARGET_SECONDS)
+    args = parser.parse_args()
+
+    for params in SETTINGS:
+        try:
+            elapsed = unlock_time(params, args.repeat)
+        except ValueError as e:
+            print(f"{describe(params):<60} skipped ({e})")
+            continue
+        print(f"{describe(params):<60} {elapsed * 1000:8.1f} ms")
+
+    for algorithm in ("pbkdf2-sha256", "scrypt", "argon2id"):
+        start = time.perf_counter()
+        try:
+            params = security.calibrate_kdf(args.target, algorithm)
+        except ValueError as e:
+            print(f"calibrate {algorithm}: skipped ({e})")
+            continue
+        calibration = time.perf_counter() - start
+        print(f"calibrated ({calibration:.2f}s): {describe(params):<47} "
+              f"{unlock_time(params, args.repeat) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# benchmarks/bench_record_format.py
+"""
+Compare legacy per-field Fernet rows with sealed record envelopes: database
+size per row, and full-record encrypt/decrypt throughput.
+
+    python benchmarks/bench_record_format.py [--rows 20000]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import credentials  # noqa: E402
+import db_setup  # noqa: E402
+from envelope import STORED_COLUMNS  # noqa: E402
+
+
+def sample_rows(count):
+    return [(f"service-{i:07d}", f"user{i}@example.com", f"p@ssw0rd-{i:07d}",
+             f"https://service-{i}.example.com/login", "created by benchmark") for i in range(count)]
+
+
+def fill_legacy(rows):
+    cipher = credentials.get_cipher()
+
+    def encrypt(value):
+        return cipher.encrypt(value.encode()) if value else b""
+
+    with db_setup.pooled_connection() as conn:
+        conn.executemany(
+            "INSERT INTO credentials (service, username, password, url, notes) VALUES (?, ?, ?, ?, ?)",
+            ((service, *(encrypt(value) for value in fields)) for service, *fields in rows),
+        )
+        conn.commit()
+
+
+def fill_envelope(rows):
+    # Sequential, like fill_legacy, so only the record format differs
+    cipher = credentials.default_vault().record_cipher
+    with db_setup.pooled_connection() as conn:
+        conn.executemany(
+            "INSERT INTO credentials (id, service, password, record_format, envelope) VALUES (?, ?, X'', 2, ?)",
+            ((row_id, service, cipher.seal(row_id, service, fields))
+             for row_id, (service, *fields) in enumerate(rows, start=1)),
+        )
+        conn.commit()
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def measure(rows, legacy):
+    write = timed(lambda: fill_legacy(rows) if legacy else fill_envelope(rows))
+    with db_setup.pooled_connection() as conn:
+        conn.execute("VACUUM")
+        pages, page_size = (conn.execute(f"PRAGMA {name}").fetchone()[0] for name in ("page_count", "page_size"))
+        stored = conn.execute(f"SELECT {STORED_COLUMNS} FROM credentials").fetchall()
+    cipher = credentials.default_vault().record_cipher
+    read = timed(lambda: [cipher.open_stored(row) for row in stored])
+    return pages * page_size / len(rows), len(rows) / write, len(rows) / read
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=20000)
+    args = parser.parse_args()
+
+    credentials.reinitialize_cipher(os.urandom(32))
+    rows = sample_rows(args.rows)
+    print(f"{'format':>10} {'bytes/row':>10} {'write rows/sec':>15} {'decrypt rows/sec':>17}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, legacy in (("fernet", True), ("envelope", False)):
+            db_setup.DB_PATH = os.path.join(tmp, f"{name}.db")
+            db_setup.initialize_db(quiet=True)
+            size, write_rate, read_rate = measure(rows, legacy)
+            db_setup.close_pool()
+            print(f"{name:>10} {size:>10.0f} {write_rate:>15.0f} {read_rate:>17.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# benchmarks/bench_service_lookup.py
+"""
+Measure get_credential latency as the vault grows, with and without the
+index on credentials.service.
+
+    python benchmarks/bench_service_lookup.py [--sizes 1000 10000 100000] [--lookups 500]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import credentials  # noqa: E402
+import db_setup  # noqa: E402
+
+
+def fill(size):
+    # One token is reused for every field; lookups still pay the full decrypt
+    token = credentials.get_cipher().encrypt(b"benchmark")
+    with db_setup.pooled_connection() as conn:
+        conn.executemany(
+            "INSERT INTO credentials (service, username, password, url, notes) VALUES (?, ?, ?, ?, ?)",
+            ((f"service-{i:07d}", token, token, token, token) for i in range(size)),
+        )
+        conn.commit()
+
+
+def measure(size, lookups):
+    services = [f"service-{random.randrange(size):07d}" for _ in range(lookups)]
+    timings = []
+    for service in services:
+        start = time.perf_counter()
+        credentials.get_credential(service)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1e6, timings[int(len(timings) * 0.99)] * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--lookups", type=int, default=500)
+    args = parser.parse_args()
+
+    credentials.reinitialize_cipher(os.urandom(32))
+    print(f"{'rows':>10} {'indexed p50/p99 (us)':>24} {'scan p50/p99 (us)':>22}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            db_setup.DB_PATH = os.path.join(tmp, f"lookup_{size}.db")
+            db_setup.initialize_db()
+            fill(size)
+            indexed = measure(size, args.lookups)
+
+            with db_setup.pooled_connection() as conn:
+                conn.execute("DROP INDEX idx_credentials_service")
+                conn.commit()
+            scan = measure(size, args.lookups)
+            db_setup.close_pool()
+
+            print(f"{size:>10} {indexed[0]:>11.1f} / {indexed[1]:<10.1f} {scan[0]:>9.1f} / {scan[1]:<10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# benchmarks/bench_startup.py
+"""
+Measure cold-start cost: module import time of main.py (from `python -X importtime`)
+and the wall time of a one-shot `main.py get` against a temporary vault.
+
+The one-shot time includes key derivation, which is calibrated to take about
+KDF_TARGET_SECONDS on purpose, so the target applies to what is left after
+subtracting it ("overhead"). The script exits with status 1 when the median
+overhead misses --target-ms.
+
+    python benchmarks/bench_startup.py [--runs 10] [--target-ms 150] [--top 15]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import credentials  # noqa: E402
+import security  # noqa: E402
+from vault import Vault  # noqa: E402
+
+MASTER_PASSWORD = "benchmark master password"
+
+# Cold start as users see it: bytecode cached in __pycache__ (written by a warm-up run)
+CHILD_ENV = {name: value for name, value in os.environ.items() if name != "PYTHONDONTWRITEBYTECODE"}
+
+
+def import_times(runs):
+    """Median self and cumulative import time (ms) per module for `import main`."""
+    samples = {}
+    subprocess.run([sys.executable, "-c", "import main"], cwd=ROOT, env=CHILD_ENV, check=True)
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                                cwd=ROOT, env=CHILD_ENV, capture_output=True, text=True, check=True)
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "self [us]" in line:
+                continue
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            samples.setdefault(name.strip(), []).append((int(self_us), int(cumulative_us)))
+    return {name: (statistics.median(s for s, _ in values) / 1000, statistics.median(c for _, c in values) / 1000)
+            for name, values in samples.items()}
+
+
+def wall_time(command, runs, cwd, env=CHILD_ENV):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, env=env, check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def one_shot_get(runs):
+    """(median wall ms of `main.py get`, median ms of the key derivation it has to do)."""
+    with tempfile.TemporaryDirectory() as tmp:
+        # A vault laid out like the default one, so main.py finds it in its working directory
+        vault = Vault(tmp)
+        vault.create(MASTER_PASSWORD.encode())
+        credentials.add_credential("bench", "me", "s3cret", vault=vault)
+        session = vault.session
+        kdf = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            security.derive_key(MASTER_PASSWORD.encode(), session.salt, params=session.params)
+            kdf.append(time.perf_counter() - start)
+        vault.lock()
+
+        env = dict(CHILD_ENV, CIMEDDA_MASTER_PASSWORD=MASTER_PASSWORD)
+        command = [sys.executable, os.path.join(ROOT, "main.py"), "get", "bench", "--field", "password"]
+        return wall_time(command, runs, tmp, env), statistics.median(kdf) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--target-ms", type=float, default=150.0,
+                        help="budget for a one-shot get, excluding key derivation")
+    parser.add_argument("--top", type=int, default=15, help="slowest modules to list")
+    args = parser.parse_args()
+
+    modules = import_times(args.runs)
+    print(f"{'module':<45} {'self ms':>9} {'cumulative ms':>14}")
+    for name, (self_ms, cumulative_ms) in sorted(modules.items(), key=lambda item: -item[1][0])[:args.top]:
+        print(f"{name:<45} {self_ms:>9.2f} {cumulative_ms:>14.2f}")
+    print(f"\nimport main: {modules['main'][1]:.1f} ms")
+
+    interpreter = wall_time([sys.executable, "-c", "pass"], args.runs, ROOT)
+    get_ms, kdf_ms = one_shot_get(args.runs)
+    overhead = get_ms - kdf_ms
+    print(f"python -c pass:         {interpreter:8.1f} ms")
+    print(f"one-shot get:           {get_ms:8.1f} ms")
+    print(f"  key derivation:       {kdf_ms:8.1f} ms")
+    print(f"  overhead:             {overhead:8.1f} ms (target {args.target_ms:.0f} ms)")
+    if overhead > args.target_ms:
+        print("Startup target missed.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+# benchmarks/bench_suite.py
+"""
+End-to-end benchmark suite: builds synthetic vaults of the given sizes in a
+temporary directory (fixed master password, no prompts, no network) and
+measures latency percentiles and throughput of add_credential,
+get_credential, update_credential, delete_credential, list_services,
+derive_key and change_master_password.
+
+Results are written as JSON (to the temp directory unless --output says
+otherwise, so runs don't litter the checkout). With --baseline, every metric
+is compared to an earlier results file and the script exits with status 1 if
+any p50 latency got slower by more than --threshold (default 25%).
+
+    python benchmarks/bench_suite.py [--sizes 1000 10000] [--samples 200] [--output results.json]
+    python benchmarks/bench_suite.py --baseline baseline.json [--threshold 0.25]
+
+derive_key and change_master_password use KDF parameters calibrated on this
+host, so only compare results taken on the same machine.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import credentials  # noqa: E402
+import security  # noqa: E402
+from vault import Vault  # noqa: E402
+
+MASTER_PASSWORD = b"benchmark master password"
+
+
+def synthetic_rows(size):
+    for i in range(size):
+        yield (f"service-{i:07d}", f"user{i}@example.com", f"p@ssw0rd-{i:07d}",
+               f"https://service-{i}.example.com/login", "created by benchmark")
+
+
+def summarize(timings):
+    """Latency percentiles (ms) and throughput for a list of per-operation durations in seconds."""
+    timings = sorted(timings)
+    count = len(timings)
+
+    def percentile(fraction):
+        return timings[min(count - 1, int(fraction * count))] * 1000
+
+    total = sum(timings)
+    return {
+        "samples": count,
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": timings[-1] * 1000,
+        "mean_ms": total / count * 1000,
+        "ops_per_sec": count / total if total > 0 else float(count),
+    }
+
+
+def timed_calls(func, arguments):
+    timings = []
+    for args in arguments:
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def bench_vault(vault, size, samples, list_samples, rotations, rng):
+    results = {}
+    start = time.perf_counter()
+    credentials.add_credentials_bulk(synthetic_rows(size), vault=vault)
+    print(f"  filled {size} rows in {time.perf_counter() - start:.2f}s")
+
+    existing = [(f"service-{rng.randrange(size):07d}",) for _ in range(samples)]
+
+    def get(service):
+        # Records decrypt lazily; read a field so the lookup pays for decryption
+        return credentials.get_credential(service, vault=vault).password
+
+    results["get_credential"] = timed_calls(get, existing)
+    results["update_credential"] = timed_calls(
+        lambda service: credentials.update_credential(service, password=f"rotated-{service}", vault=vault), existing)
+
+    # Added rows are deleted again, so every size keeps its row count for the next measurements
+    added = [(f"bench-added-{i:07d}", f"user{i}@example.com", f"p@ssw0rd-{i:07d}") for i in range(samples)]
+    results["add_credential"] = timed_calls(
+        lambda service, username, password: credentials.add_credential(service, username, password, vault=vault),
+        added)
+    results["delete_credential"] = timed_calls(
+        lambda service: credentials.delete_credential(service, vault=vault), [(row[0],) for row in added])
+    results["list_services"] = timed_calls(lambda: credentials.list_services(vault=vault), [()] * list_samples)
+
+    def change_master_password(round_number):
+        vault.set_session(security.set_master_password(vault.session, MASTER_PASSWORD + round_number, vault))
+
+    results["change_master_password"] = timed_calls(
+        change_master_password, [(str(i).encode(),) for i in range(rotations)])
+    return {name: summarize(timings) for name, timings in results.items()}
+
+
+def bench_derive_key(vault, samples):
+    session = vault.session
+    return summarize(timed_calls(
+        lambda: security.derive_key(MASTER_PASSWORD, session.salt, params=session.params), [()] * samples))
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            print(f"vault with {size} rows")
+            vault = Vault(os.path.join(tmp, f"vault-{size}"))
+            vault.create(MASTER_PASSWORD)
+            try:
+                if not results:
+                    results["derive_key"] = bench_derive_key(vault, args.kdf_samples)
+                    kdf_params = vault.session.params
+                for name, summary in bench_vault(vault, size, args.samples, args.list_samples,
+                                                 args.rotations, rng).items():
+                    if name == "change_master_password":
+                        summary["rows_per_sec"] = size / (summary["mean_ms"] / 1000)
+                    results[f"{name}@{size}"] = summary
+            finally:
+                vault.lock()
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "sizes": args.sizes,
+            "samples": args.samples,
+            "seed": args.seed,
+            "kdf_params": kdf_params,
+        },
+        "results": results,
+    }
+
+
+def print_results(results, baseline=None, metric="p50_ms"):
+    print(f"\n{'benchmark':>32} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'ops/sec':>10} {'vs baseline':>12}")
+    for name, summary in results.items():
+        change = ""
+        if baseline is not None and name in baseline and baseline[name][metric] > 0:
+            change = f"{(summary[metric] / baseline[name][metric] - 1) * 100:+.1f}%"
+        print(f"{name:>32} {summary['p50_ms']:>10.3f} {summary['p95_ms']:>10.3f} {summary['p99_ms']:>10.3f} "
+              f"{summary['ops_per_sec']:>10.1f} {change:>12}")
+
+
+def find_regressions(results, baseline, threshold, metric="p50_ms"):
+    """Names of benchmarks whose `metric` is more than `threshold` (a fraction) above the baseline."""
+    return [name for name, summary in results.items()
+            if name in baseline and summary[metric] > baseline[name][metric] * (1 + threshold)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000],
+                        help="vault sizes to benchmark (1000 to 1000000 rows)")
+    parser.add_argument("--samples", type=int, default=200, help="operations timed per CRUD benchmark")
+    parser.add_argument("--list-samples", type=int, default=10, help="list_services calls timed per vault")
+    parser.add_argument("--kdf-samples", type=int, default=5, help="derive_key calls timed")
+    parser.add_argument("--rotations", type=int, default=1, help="master password changes timed per vault")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=os.path.join(tempfile.gettempdir(), "cimedda_bench_results.json"),
+                        help="where to write the JSON results (default: in the temp directory)")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed slowdown of p50 latency before it counts as a regression")
+    args = parser.parse_args()
+
+    report = run(args)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    print_results(report["results"], baseline)
+    print(f"\nResults written to {args.output}")
+
+    if baseline is not None:
+        regressions = find_regressions(report["results"], baseline, args.threshold)
+        if regressions:
+            print(f"Regressions (p50 more than {args.threshold:.0%} slower than {args.baseline}):")
+            for name in regressions:
+                print(f"  {name}")
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}.")
+
+
+if __name__ == "__main__":
+    main()
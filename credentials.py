@@ -1,194 +1,899 @@
-# credentials.py
-
-from db_setup import get_db_connection
-from cryptography.fernet import Fernet, InvalidToken
-from security import get_master_key
-import base64
-# import pandas as pd
-
-# Global variables for security components (initialized later)
-_master_key = None
-cipher = None
-
-def initialize_credentials():
-    global _master_key, cipher
-    # Derive the master key and set up the Fernet cipher
-    _master_key = get_master_key()
-    fernet_key = base64.urlsafe_b64encode(_master_key[:32])
-    cipher = Fernet(fernet_key)
-
-def get_cipher():
-    global cipher
-    return cipher
-
-def reinitialize_cipher(new_key):
-    """Reinitialize the cipher with a new key when the master password is changed."""
-    global cipher
-    fernet_key = base64.urlsafe_b64encode(new_key[:32])
-    cipher = Fernet(fernet_key)
-
-def add_credential(service, username, password, url='', notes=''):
-    encrypted_password = cipher.encrypt(password.encode())
-    encrypted_username = cipher.encrypt(username.encode()) if username else b""
-    encrypted_url = cipher.encrypt(url.encode()) if url else b""
-    encrypted_notes = cipher.encrypt(notes.encode()) if notes else b""
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-            INSERT INTO credentials (service, username, password, url, notes)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (service, encrypted_username, encrypted_password, encrypted_url, encrypted_notes))
-    conn.commit()
-    conn.close()
-
-def get_credential(service):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-            SELECT id, service, username, password, url, notes, created_at, updated_at 
-            FROM credentials 
-            WHERE service = ?
-        ''', (service,))
-    row = cursor.fetchone()
-    conn.close()
-    if row:
-        # Decrypt fields before returning
-        try:
-            decrypted_username = cipher.decrypt(row[2]).decode() if row[2] else ""
-        except InvalidToken:
-            decrypted_username = "Decryption failed"
-
-        try:
-            decrypted_password = cipher.decrypt(row[3]).decode()
-        except InvalidToken:
-            decrypted_password = "Decryption failed"
-
-        try:
-            decrypted_url = cipher.decrypt(row[4]).decode() if row[4] else ""
-        except InvalidToken:
-            decrypted_url = "Decryption failed"
-
-        try:
-            decrypted_notes = cipher.decrypt(row[5]).decode() if row[5] else ""
-        except InvalidToken:
-            decrypted_notes = "Decryption failed"
-
-        # Reconstruct row with decrypted data
-        decrypted_row = (
-            row[0],  # id
-            row[1],  # service
-            decrypted_username,  # username
-            decrypted_password,  # password
-            decrypted_url,  # url
-            decrypted_notes,  # notes
-            row[6],  # created_at
-            row[7]  # updated_at
-        )
-        return decrypted_row
-    return None
-
-def update_credential(service, username=None, password=None, url=None, notes=None):
-    fields = []
-    values = []
-
-    # Check each field and update only if it's not blank
-    if username is not None and username != "":
-        encrypted_username = cipher.encrypt(username.encode())
-        fields.append("username = ?")
-        values.append(encrypted_username)
-    if password is not None and password != "":
-        encrypted_pass = cipher.encrypt(password.encode())
-        fields.append("password = ?")
-        values.append(encrypted_pass)
-    if url is not None and url != "":
-        encrypted_url = cipher.encrypt(url.encode())
-        fields.append("url = ?")
-        values.append(encrypted_url)
-    if notes is not None and notes != "":
-        encrypted_notes = cipher.encrypt(notes.encode())
-        fields.append("notes = ?")
-        values.append(encrypted_notes)
-
-    # If no fields to update, return False
-    if not fields:
-        return False
-
-    # Add service as the last parameter for the WHERE clause
-    values.append(service)
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    sql = f'''
-            UPDATE credentials
-            SET {', '.join(fields)}, updated_at = CURRENT_TIMESTAMP
-            WHERE service = ?
-        '''
-    cursor.execute(sql, tuple(values))
-    conn.commit()
-    rows_updated = cursor.rowcount
-    conn.close()
-    return rows_updated > 0
-
-
-def delete_credential(service):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        DELETE FROM credentials
-        WHERE service = ?
-    ''', (service,))
-    conn.commit()
-    rows_deleted = cursor.rowcount
-    conn.close()
-    return rows_deleted > 0
-
-def list_services():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, service FROM credentials")
-    services = cursor.fetchall()
-    conn.close()
-    return services
-
-
-# def import_from_excel(file_path):
-#     """
-#     Imports credentials from a non-protected Excel file into the database.
-#
-#     The Excel file should have:
-#       - First row as headers.
-#       - Columns: Service, Password, Username, URL, Notes ...
-#       - Data starting from the second row.
-#     """
-#     try:
-#
-#         # Read the Excel file into a DataFrame using pandas
-#         df = pd.read_excel(file_path, engine='openpyxl', dtype=object)
-#
-#         # Check if the DataFrame has at least 2 columns (Service and Password)
-#         if df.shape[1] < 2:
-#             raise ValueError("The Excel file does not have the required columns.")
-#
-#         # Iterate over each row in the DataFrame and insert into the database
-#         for index, row in df.iterrows():
-#             # Extract values with default empty string if a cell is missing or NaN
-#             service = row[0] if not pd.isna(row[0]) else None
-#             password = row[1] if not pd.isna(row[1]) else ""
-#             username = row[2] if len(row) > 2 and not pd.isna(row[2]) else ""
-#             notes = row[3] if len(row) > 3 and not pd.isna(row[3]) else ""
-#
-#             # Convert password to string if it's not already
-#             service = str(service)
-#             password = str(password)
-#             username = str(username)
-#             notes = str(notes)
-#
-#             if service:  # Proceed only if a service name exists
-#                 try:
-#                     add_credential(service, username, password, "", notes)
-#                     #print(f"Imported credential for service: {service}")
-#                 except Exception as e:
-#                     print(f"Failed to import credential for {service}: {e}")
-#     except Exception as e:
-#         print(f"An error occurred during import: {e}")
-#         raise  # re-raise exception for further debugging if desired
\ No newline at end of file
+# credentials.py
+
+from db_setup import Backfill, KeyVersionChanged, RotationInProgress, begin_write, run_backfill  # noqa: F401
+from cryptography.fernet import InvalidToken
+from crypto_executor import DECRYPTION_FAILED
+from envelope import FORMAT_ENVELOPE, HISTORY_STORED_COLUMNS, STORED_COLUMNS
+from search import SEARCH_LIMIT, store_record_tokens
+from vault import CACHE_MAX_ENTRIES, CACHE_TTL, RecordCache, Vault, VaultLocked  # noqa: F401 (re-exported)
+from itertools import islice
+import metrics
+
+# Every function below works on this vault unless given another one (vault=...)
+_default_vault = Vault()
+
+# Rows fetched per page by iter_services / iter_service_pages
+LIST_PAGE_SIZE = 100
+
+# Bulk operations: rows encrypted and written per executemany() call
+BULK_BATCH_SIZE = 500
+
+
+def default_vault():
+    """The vault stored in the working directory, used when no vault is passed."""
+    return _default_vault
+
+def _vault(vault):
+    return _default_vault if vault is None else vault
+
+def _unlocked(vault):
+    """Resolve `vault` for an operation on its data: raises VaultLocked if it is locked."""
+    vault = _vault(vault)
+    vault.require_unlocked()
+    return vault
+
+def enable_cache(max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL, vault=None):
+    """Serve repeated get_credential() calls from memory until written, expired or wiped."""
+    _vault(vault).enable_cache(max_entries, ttl)
+
+def disable_cache(vault=None):
+    _vault(vault).disable_cache()
+
+def clear_cache(release=False, vault=None):
+    """
+    Drop every decrypted record held in memory. With release=True (session lock)
+    the records are also wiped, including any a caller still holds.
+    """
+    _vault(vault).clear_cache(release)
+
+def _invalidate_cached(vault, service):
+    if vault.cache is not None:
+        vault.cache.invalidate(service)
+
+def initialize_credentials(vault=None):
+    # Unlock the vault (derives the master key once) and set up the record ciphers
+    _vault(vault).unlock()
+
+def get_cipher(vault=None):
+    return _vault(vault).cipher
+
+def get_session(vault=None):
+    """The KeySession of the current unlock (None before initialize_credentials)."""
+    return _vault(vault).session
+
+def set_session(session, vault=None):
+    """Switch to another unlocked session, e.g. the one returned by change_master_password."""
+    _vault(vault).set_session(session)
+
+def reinitialize_cipher(new_key, vault=None):
+    """Reinitialize the cipher with a new key when the master password is changed."""
+    _vault(vault).set_key(new_key)
+
+def lock_session(vault=None):
+    """Forget every piece of key material and decrypted data held for the vault."""
+    _vault(vault).lock()
+
+def get_crypto_executor(vault=None):
+    """Executor for parallel record crypto with the vault's key (created on first use)."""
+    return _unlocked(vault).crypto_executor()
+
+# --------------------------------------------------------------------------------
+# Service search index (built on first search, then kept up to date by every write)
+# --------------------------------------------------------------------------------
+def get_search_index(vault=None):
+    return _unlocked(vault).get_search_index()
+
+def search_services(query, limit=SEARCH_LIMIT, fuzzy=True, vault=None):
+    """Ranked prefix/substring/typo-tolerant search over service names; returns (id, service) pairs."""
+    return get_search_index(vault).search(query, limit, fuzzy)
+
+def _index_added(vault, rows):
+    if vault.search_index is not None:
+        for service_id, service in rows:
+            vault.search_index.add(service_id, service)
+
+def _index_removed(vault, services):
+    if vault.search_index is not None:
+        for service in services:
+            vault.search_index.remove_service(service)
+
+# Envelope rows keep the legacy per-field columns empty (password is NOT NULL). Writes that
+# change a searchable field also replace the row's search tokens in the same transaction
+_INSERT_ENVELOPE_SQL = '''
+        INSERT INTO credentials (id, service, password, record_format, envelope, key_version, search_indexed)
+        VALUES (?, ?, X'', 2, ?, (SELECT key_version FROM key_rotation WHERE id = 1), 1)
+    '''
+_UPDATE_ENVELOPE_SQL = '''
+        UPDATE credentials
+        SET envelope = ?, record_format = 2, username = NULL, password = X'', url = NULL, notes = NULL,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    '''
+
+def _next_credential_id(conn):
+    # Same id SQLite would assign itself (INTEGER PRIMARY KEY without AUTOINCREMENT)
+    return conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM credentials").fetchone()[0]
+
+def _insert_credential(conn, vault, service, fields):
+    """Seal and insert one row inside the caller's write transaction. Returns the new row id."""
+    row_id = _next_credential_id(conn)
+    conn.execute(_INSERT_ENVELOPE_SQL, (row_id, service, vault.record_cipher.seal(row_id, service, fields)))
+    store_record_tokens(conn, vault.token_hasher, [(row_id, fields)], replace=False)
+    return row_id
+
+
+@metrics.timed("credentials.add")
+def add_credential(service, username, password, url='', notes='', vault=None):
+    vault = _unlocked(vault)
+    with vault.connection() as conn:
+        # The envelope is bound to the row id, so pick the id while holding the write lock
+        begin_write(conn, vault.key_version)
+        row_id = _insert_credential(conn, vault, service, (username, password, url, notes))
+        conn.commit()
+        _index_added(vault, [(row_id, service)])
+    _invalidate_cached(vault, service)
+
+class CredentialRecord:
+    """
+    A credential whose encrypted fields are decrypted only when first read, then
+    memoized. Indexing/iteration still behave like the old 8-tuple
+    (id, service, username, password, url, notes, created_at, updated_at), but
+    iterating decrypts every field, so prefer the attributes.
+
+    A field that doesn't decrypt reads as DECRYPTION_FAILED, unless that is
+    because another process changed the master password: then reading it raises
+    KeyVersionChanged (or RotationInProgress while the change is running).
+
+    release() zeroes the memoized plaintext buffers and forgets the ciphertext
+    and cipher. This is best effort: strings already handed out are Python
+    objects the record can't reach.
+    """
+
+    __slots__ = ('id', 'service', 'created_at', 'updated_at', '_vault', '_cipher', '_envelope', '_encrypted',
+                 '_plain')
+    FIELDS = ('username', 'password', 'url', 'notes')
+
+    def __init__(self, row, vault):
+        """`row` holds the STORED_COLUMNS followed by created_at, updated_at."""
+        self.id, self.service = row[0], row[1]
+        self.created_at, self.updated_at = row[8], row[9]
+        self._vault = vault
+        self._cipher = vault.record_cipher
+        # Envelope rows open all four fields in one AEAD call; legacy rows decrypt field by field
+        self._envelope = row[3] if row[2] == FORMAT_ENVELOPE else None
+        self._encrypted = list(row[4:8])
+        self._plain = [None, None, None, None]
+
+    def _field(self, index):
+        if self._cipher is None:
+            raise ValueError("Credential record has been released.")
+        plain = self._plain[index]
+        if plain is None:
+            if self._envelope is not None:
+                try:
+                    self._plain = [bytearray(value) for value in
+                                   self._cipher.open(self.id, self.service, self._envelope)]
+                except InvalidToken:
+                    self._vault.check_key_version()
+                    return DECRYPTION_FAILED
+                self._envelope = None
+                return self._plain[index].decode()
+            token = self._encrypted[index]
+            if not token:
+                plain = bytearray()
+            else:
+                try:
+                    with metrics.timer("crypto.fernet_decrypt"):
+                        plain = bytearray(self._cipher.fernet.decrypt(token))
+                except InvalidToken:
+                    self._vault.check_key_version()
+                    return DECRYPTION_FAILED
+            self._plain[index] = plain
+        return plain.decode()
+
+    @property
+    def username(self):
+        return self._field(0)
+
+    @property
+    def password(self):
+        return self._field(1)
+
+    @property
+    def url(self):
+        return self._field(2)
+
+    @property
+    def notes(self):
+        return self._field(3)
+
+    def release(self):
+        for plain in self._plain:
+            if plain:
+                plain[:] = bytes(len(plain))
+        self._plain = [None, None, None, None]
+        self._encrypted = [None, None, None, None]
+        self._envelope = None
+        self._cipher = None
+
+    def copy(self):
+        """An independent CredentialRecord with the same contents; releasing one leaves the other intact."""
+        if self._envelope is not None and self._cipher is not None:
+            self._field(0)  # Open the envelope here once, so copies don't each decrypt it
+        record = CredentialRecord.__new__(CredentialRecord)
+        record.id, record.service = self.id, self.service
+        record.created_at, record.updated_at = self.created_at, self.updated_at
+        record._vault = self._vault
+        record._cipher = self._cipher
+        record._envelope = self._envelope
+        record._encrypted = list(self._encrypted)
+        record._plain = [None if plain is None else bytearray(plain) for plain in self._plain]
+        return record
+
+    def __iter__(self):
+        yield self.id
+        yield self.service
+        for index in range(4):
+            yield self._field(index)
+        yield self.created_at
+        yield self.updated_at
+
+    def __len__(self):
+        return 8
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        if index < 0:
+            index += 8
+        if 2 <= index <= 5:
+            return self._field(index - 2)
+        return (self.id, self.service, None, None, None, None, self.created_at, self.updated_at)[index]
+
+    def __repr__(self):
+        # Never include secrets
+        return f"CredentialRecord(id={self.id!r}, service={self.service!r})"
+
+
+@metrics.timed("credentials.get")
+def get_credential(service, vault=None):
+    """
+    Return a lazily decrypted CredentialRecord for `service`, or None. With the
+    cache on, every caller gets its own copy of the cached record, so one
+    caller's release() can't wipe it for the others.
+    """
+    vault = _unlocked(vault)
+    if vault.cache is not None:
+        cached = vault.cache.get(service)
+        if cached is not None:
+            metrics.count("cache.hits")
+            return cached.copy()
+        metrics.count("cache.misses")
+
+    with vault.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+                SELECT {STORED_COLUMNS}, created_at, updated_at
+                FROM credentials 
+                WHERE service = ?
+            ''', (service,))
+        row = cursor.fetchone()
+    if row:
+        record = CredentialRecord(row, vault)
+        if vault.cache is not None:
+            vault.cache.put(service, record)
+            return record.copy()
+        return record
+    return None
+
+def iter_credentials(services=None, contains=None, page_size=LIST_PAGE_SIZE, vault=None):
+    """
+    Stream lazily decrypted CredentialRecords, either for the given service names
+    (fetched page_size names per query) or for every credential (optionally
+    filtered by a service substring) in service order.
+    """
+    vault = _unlocked(vault)
+    select = f"SELECT {STORED_COLUMNS}, created_at, updated_at FROM credentials"
+    if services is not None:
+        for batch in _batched(services, page_size):
+            placeholders = ', '.join('?' * len(batch))
+            with vault.connection() as conn:
+                rows = conn.execute(f"{select} WHERE service IN ({placeholders}) ORDER BY service, id",
+                                    batch).fetchall()
+            for row in rows:
+                yield CredentialRecord(row, vault)
+        return
+
+    for page in iter_service_pages(page_size, contains=contains, vault=vault):
+        ids = [service_id for service_id, _ in page]
+        placeholders = ', '.join('?' * len(ids))
+        with vault.connection() as conn:
+            rows = conn.execute(f"{select} WHERE id IN ({placeholders}) ORDER BY service, id", ids).fetchall()
+        for row in rows:
+            yield CredentialRecord(row, vault)
+
+def _merge_fields(row, changes):
+    """Opened (id, service, username, password, url, notes) row with `changes` (field index -> value) applied."""
+    fields = list(row[2:6])
+    for index, value in changes.items():
+        fields[index] = value
+    return (row[0], row[1], *fields)
+
+
+def _changed_fields(username, password, url, notes):
+    # Only non-blank fields are updated
+    return {index: value for index, value in enumerate((username, password, url, notes))
+            if value is not None and value != ""}
+
+
+def _changes_search_terms(changes):
+    # Passwords (field 1) are never indexed, so a password-only change keeps the row's search tokens
+    return any(index != 1 for index in changes)
+
+
+def _reseal_service(conn, vault, service, changes):
+    """Apply `changes` to every row of `service` inside the caller's transaction. Returns the rows updated."""
+    record_cipher = vault.record_cipher
+    # Every row is re-sealed as a whole (legacy Fernet rows are migrated on the way)
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {STORED_COLUMNS} FROM credentials WHERE service = ?", (service,))
+    rows = cursor.fetchall()
+    merged_rows = [_merge_fields((row[0], row[1]) + record_cipher.open_stored(row, strict=True), changes)
+                   for row in rows]
+    for merged in merged_rows:
+        cursor.execute(_UPDATE_ENVELOPE_SQL, (record_cipher.seal(merged[0], service, merged[2:]), merged[0]))
+    if _changes_search_terms(changes):
+        store_record_tokens(conn, vault.token_hasher, ((merged[0], merged[2:]) for merged in merged_rows))
+    return len(rows)
+
+
+def _delete_service(conn, service):
+    """Delete every row of `service` inside the caller's transaction. Returns the rows deleted."""
+    cursor = conn.cursor()
+    cursor.execute('''
+        DELETE FROM credentials
+        WHERE service = ?
+    ''', (service,))
+    return cursor.rowcount
+
+
+@metrics.timed("credentials.update")
+def update_credential(service, username=None, password=None, url=None, notes=None, vault=None):
+    vault = _unlocked(vault)
+    changes = _changed_fields(username, password, url, notes)
+
+    # If no fields to update, return False
+    if not changes:
+        return False
+
+    with vault.connection() as conn:
+        begin_write(conn, vault.key_version)
+        updated = _reseal_service(conn, vault, service, changes)
+        conn.commit()
+    _invalidate_cached(vault, service)
+    return updated > 0
+
+
+@metrics.timed("credentials.delete")
+def delete_credential(service, vault=None):
+    vault = _unlocked(vault)
+    with vault.connection() as conn:
+        begin_write(conn, vault.key_version)
+        rows_deleted = _delete_service(conn, service)
+        conn.commit()
+    _invalidate_cached(vault, service)
+    _index_removed(vault, [service])
+    return rows_deleted > 0
+
+
+def _apply_write(conn, vault, write):
+    kind, service = write[0], write[1]
+    if kind == "add":
+        return _insert_credential(conn, vault, service, tuple(write[2:6]))
+    if kind == "update":
+        changes = _changed_fields(*write[2:6])
+        return bool(changes) and _reseal_service(conn, vault, service, changes) > 0
+    if kind == "delete":
+        return _delete_service(conn, service) > 0
+    raise ValueError(f"unknown write: {kind!r}")
+
+
+@metrics.timed("credentials.apply_writes")
+def apply_writes(conn, writes, vault=None):
+    """
+    Apply a list of writes in one transaction on `conn` and commit it. Each write
+    is ("add", service, username, password, url, notes), ("update", service,
+    username, password, url, notes) with blank fields left unchanged, or
+    ("delete", service).
+
+    Every write gets its own savepoint, so one that fails is rolled back alone.
+    Returns one result per write: None for an add, whether anything changed
+    for an update or delete, or the exception the write raised.
+    """
+    vault = _unlocked(vault)
+    results = []
+    begin_write(conn, vault.key_version)
+    for write in writes:
+        conn.execute("SAVEPOINT write")
+        try:
+            results.append(_apply_write(conn, vault, write))
+            conn.execute("RELEASE write")
+        except Exception as e:
+            conn.execute("ROLLBACK TO write")
+            conn.execute("RELEASE write")
+            results.append(e)
+    conn.commit()
+
+    # Readers see the new rows only now, so update the cache and search index after the commit
+    for index, (write, result) in enumerate(zip(writes, results)):
+        _invalidate_cached(vault, write[1])
+        if isinstance(result, Exception):
+            continue
+        if write[0] == "add":
+            _index_added(vault, [(result, write[1])])
+            results[index] = None
+        elif write[0] == "delete" and result:
+            _index_removed(vault, [write[1]])
+    return results
+
+@metrics.timed("credentials.list")
+def list_services(vault=None):
+    with _unlocked(vault).connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, service FROM credentials")
+        services = cursor.fetchall()
+    return services
+
+
+def iter_service_pages(page_size=LIST_PAGE_SIZE, order_by='service', descending=False, contains=None, vault=None):
+    """
+    Yield pages (lists of (id, service) pairs) using keyset pagination: each page
+    resumes after the last row of the previous one instead of using OFFSET, so
+    every page costs the same however deep into the vault it is. A pooled
+    connection is only borrowed while a page is being read.
+
+    order_by is 'service' or 'id'; contains filters on a case-insensitive substring.
+    """
+    if order_by not in ('service', 'id'):
+        raise ValueError("order_by must be 'service' or 'id'")
+    vault = _unlocked(vault)
+    comparison, direction = ('<', 'DESC') if descending else ('>', 'ASC')
+    key_columns = '(service, id)' if order_by == 'service' else 'id'
+    order_clause = f"service {direction}, id {direction}" if order_by == 'service' else f"id {direction}"
+
+    filters = []
+    filter_params = []
+    if contains:
+        escaped = contains.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        filters.append("service LIKE ? ESCAPE '\\'")
+        filter_params.append(f"%{escaped}%")
+
+    last_key = None
+    while True:
+        conditions = list(filters)
+        params = list(filter_params)
+        if last_key is not None:
+            placeholders = '(?, ?)' if order_by == 'service' else '?'
+            conditions.append(f"{key_columns} {comparison} {placeholders}")
+            params.extend(last_key)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with vault.connection() as conn:
+            page = conn.execute(
+                f"SELECT id, service FROM credentials {where} ORDER BY {order_clause} LIMIT ?",
+                (*params, page_size),
+            ).fetchall()
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last_id, last_service = page[-1]
+        last_key = (last_service, last_id) if order_by == 'service' else (last_id,)
+
+
+def iter_services(page_size=LIST_PAGE_SIZE, order_by='service', descending=False, contains=None, vault=None):
+    """Stream (id, service) pairs page by page; see iter_service_pages."""
+    for page in iter_service_pages(page_size, order_by, descending, contains, vault):
+        yield from page
+
+
+# --------------------------------------------------------------------------------
+# Bulk operations
+# --------------------------------------------------------------------------------
+CREDENTIAL_FIELDS = ('service', 'username', 'password', 'url', 'notes')
+
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _as_credential_dict(item):
+    """Accept either a dict or a (service, username, password, url, notes) tuple."""
+    if isinstance(item, dict):
+        return item
+    return dict(zip(CREDENTIAL_FIELDS, item))
+
+
+def _run_bulk(vault, sql, rows, batch_size, commit_every, after_batch=None):
+    """
+    Execute `sql` for every parameter tuple produced by `rows`, batch by batch.
+    Everything is written in one transaction unless `commit_every` is given, in
+    which case a commit is issued roughly every `commit_every` rows. Each
+    transaction takes the write lock before `rows` is read; a callable `rows`
+    is called with the connection at that point (to read ids under the lock).
+    `after_batch(cursor)` runs after each batch, in the same transaction.
+    """
+    total = 0
+    since_commit = 0
+    with vault.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            begin_write(conn, vault.key_version)
+            if callable(rows):
+                rows = rows(conn)
+            for batch in _batched(rows, batch_size):
+                cursor.executemany(sql, batch)
+                total += cursor.rowcount
+                metrics.count("credentials.bulk_rows", len(batch))
+                if after_batch is not None:
+                    after_batch(cursor)
+                since_commit += len(batch)
+                if commit_every and since_commit >= commit_every:
+                    conn.commit()
+                    since_commit = 0
+                    begin_write(conn, vault.key_version)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    vault.clear_cache()  # Bulk writes may touch any cached record
+    return total
+
+
+@metrics.timed("credentials.add_bulk")
+def add_credentials_bulk(items, batch_size=BULK_BATCH_SIZE, commit_every=None, vault=None):
+    """
+    Insert many credentials at once. `items` is an iterable of dicts or
+    (service, username, password, url, notes) tuples. Returns the number of rows added.
+    """
+    vault = _unlocked(vault)
+    added_rows = []  # (id, service) for the search index
+
+    def rows(chunk, conn):
+        # Runs once _run_bulk holds the write lock on `conn`, so no other writer can take these ids
+        row_id = _next_credential_id(conn)
+        for item in chunk:
+            item = _as_credential_dict(item)
+            fields = tuple(item.get(field) for field in CREDENTIAL_FIELDS[1:])
+            if vault.search_index is not None:
+                added_rows.append((row_id, item.get('service')))
+            # The plaintext fields ride along as an extra column, for the search tokens
+            yield (row_id, item.get('service')) + fields + (fields,)
+            row_id += 1
+
+    pending_tokens = []
+
+    def params(sealed):
+        for row_id, service, envelope, fields in sealed:
+            pending_tokens.append((row_id, fields))
+            yield row_id, service, envelope
+
+    def write_tokens(cursor):
+        store_record_tokens(cursor, vault.token_hasher, pending_tokens, replace=False)
+        pending_tokens.clear()
+
+    # The row ids are sealed into the envelopes, so every transaction (one per
+    # commit_every rows) picks its ids itself; other writers may commit in between
+    added = 0
+    for chunk in (_batched(items, commit_every) if commit_every else [items]):
+        added_rows.clear()
+        added += _run_bulk(vault, _INSERT_ENVELOPE_SQL,
+                           lambda conn: params(vault.crypto_executor().seal_rows(rows(chunk, conn))),
+                           batch_size, None, after_batch=write_tokens)
+        _index_added(vault, added_rows)
+    return added
+
+
+@metrics.timed("credentials.update_bulk")
+def update_credentials_bulk(items, batch_size=BULK_BATCH_SIZE, commit_every=None, vault=None):
+    """
+    Update many credentials at once. Like update_credential, blank or missing
+    fields keep their current value. Returns the number of rows updated.
+    """
+    vault = _unlocked(vault)
+    executor = vault.crypto_executor()
+    total = 0
+    since_commit = 0
+    with vault.connection() as conn:
+        try:
+            for batch in _batched(items, batch_size):
+                if not conn.in_transaction:
+                    begin_write(conn, vault.key_version)
+                # Later items for the same service win, field by field
+                changes = {}
+                for item in batch:
+                    item = _as_credential_dict(item)
+                    values = (item.get(field) for field in CREDENTIAL_FIELDS[1:])
+                    changes.setdefault(item['service'], {}).update(
+                        (index, value) for index, value in enumerate(values) if value)
+                services = [service for service, fields in changes.items() if fields]
+                if not services:
+                    continue
+
+                # Each batch is read through the writing connection, so it sees the batches before it
+                stored = conn.execute(
+                    f"SELECT {STORED_COLUMNS} FROM credentials WHERE service IN ({', '.join('?' * len(services))})",
+                    services).fetchall()
+                merged = [_merge_fields(row, changes[row[1]]) for row in executor.open_rows(stored, strict=True)]
+                sealed = executor.seal_rows(merged)
+                conn.executemany(_UPDATE_ENVELOPE_SQL, ((row[2], row[0]) for row in sealed))
+                store_record_tokens(conn, vault.token_hasher, ((row[0], row[2:6]) for row in merged
+                                                               if _changes_search_terms(changes[row[1]])))
+
+                total += len(stored)
+                since_commit += len(stored)
+                if commit_every and since_commit >= commit_every:
+                    conn.commit()
+                    since_commit = 0
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    vault.clear_cache()  # Bulk writes may touch any cached record
+    return total
+
+
+def legacy_records_backfill(vault=None):
+    """Backfill re-sealing the vault's legacy per-field Fernet rows as envelopes (rows that fail to decrypt stay)."""
+    vault = _unlocked(vault)
+
+    def step(conn, after_id, limit):
+        rows = conn.execute(f'''
+            SELECT {STORED_COLUMNS}
+            FROM credentials
+            WHERE id > ? AND record_format <> 2
+            ORDER BY id
+            LIMIT ?
+        ''', (after_id, limit)).fetchall()
+        if not rows:
+            return 0, None
+
+        executor = vault.crypto_executor()
+        opened = [row for row in executor.open_rows(rows) if DECRYPTION_FAILED not in row[2:6]]
+        conn.executemany('''
+            UPDATE credentials
+            SET envelope = ?, record_format = 2, username = NULL, password = X'', url = NULL, notes = NULL
+            WHERE id = ?
+        ''', ((row[2], row[0]) for row in executor.seal_rows(opened)))
+        return len(opened), rows[-1][0]
+
+    def remaining(conn, after_id):
+        return conn.execute("SELECT COUNT(*) FROM credentials WHERE id > ? AND record_format <> 2",
+                            (after_id,)).fetchone()[0]
+
+    return Backfill("legacy records to envelopes", step, remaining, vault.key_version)
+
+def search_tokens_backfill(vault=None):
+    """Backfill writing the search tokens of rows that have none yet (rows written before search tokens existed)."""
+    vault = _unlocked(vault)
+
+    def step(conn, after_id, limit):
+        rows = conn.execute(f'''
+            SELECT {STORED_COLUMNS}
+            FROM credentials
+            WHERE id > ? AND search_indexed = 0
+            ORDER BY id
+            LIMIT ?
+        ''', (after_id, limit)).fetchall()
+        if not rows:
+            return 0, None
+
+        # Rows that fail to decrypt get no tokens but still count as done, so they aren't retried forever
+        opened = [row for row in vault.crypto_executor().open_rows(rows) if DECRYPTION_FAILED not in row[2:6]]
+        store_record_tokens(conn, vault.token_hasher, ((row[0], row[2:6]) for row in opened))
+        failed = {row[0] for row in rows} - {row[0] for row in opened}
+        conn.executemany("UPDATE credentials SET search_indexed = 1 WHERE id = ?", ((row_id,) for row_id in failed))
+        return len(rows), rows[-1][0]
+
+    def remaining(conn, after_id):
+        return conn.execute("SELECT COUNT(*) FROM credentials WHERE id > ? AND search_indexed = 0",
+                            (after_id,)).fetchone()[0]
+
+    return Backfill("search tokens", step, remaining, vault.key_version)
+
+def keyed_backfills(vault=None):
+    """Data migrations that need the unlocked key, run by 'main.py migrate' after the schema migrations."""
+    return (legacy_records_backfill(vault), search_tokens_backfill(vault))
+
+def _ensure_search_tokens(vault):
+    # Vaults upgraded from before search tokens get them on the first search (resumable, batch by batch)
+    if vault.search_tokens_ready:
+        return
+    with vault.connection() as conn:
+        run_backfill(conn, search_tokens_backfill(vault))
+    vault.search_tokens_ready = True
+
+@metrics.timed("credentials.find")
+def find_credentials(username=None, host=None, keyword=None, vault=None):
+    """
+    (id, service) pairs of the credentials matching every given criterion, via
+    the encrypted token index instead of decrypting rows:
+    `username` (exact, case-insensitive), `host` (a URL or host name; also
+    matches its subdomains) and `keyword` (every word must appear in the notes).
+    """
+    vault = _unlocked(vault)
+    tokens = set(vault.token_hasher.query_tokens(username, host, keyword))
+    if not tokens:
+        raise ValueError("Give a username, host or keyword to search for.")
+    _ensure_search_tokens(vault)
+    with vault.connection() as conn:
+        return conn.execute(f'''
+            SELECT id, service
+            FROM credentials
+            WHERE id IN (
+                SELECT credential_id
+                FROM search_tokens
+                WHERE token IN ({', '.join('?' * len(tokens))})
+                GROUP BY credential_id
+                HAVING COUNT(*) = ?
+            )
+            ORDER BY service, id
+        ''', (*tokens, len(tokens))).fetchall()
+
+def migrate_legacy_records(batch_size=BULK_BATCH_SIZE, vault=None):
+    """
+    Re-seal legacy per-field Fernet rows as envelopes, one committed batch at a
+    time, so it can be interrupted and run again. Rows are migrated anyway when
+    they are next updated; rows that fail to decrypt are left untouched.
+    Returns the number of rows migrated.
+    """
+    vault = _unlocked(vault)
+    with vault.connection() as conn:
+        migrated = run_backfill(conn, legacy_records_backfill(vault), batch_size)
+    vault.clear_cache()
+    return migrated
+
+
+@metrics.timed("credentials.delete_bulk")
+def delete_credentials_bulk(services, batch_size=BULK_BATCH_SIZE, commit_every=None, vault=None):
+    """Delete the credentials for every service in `services`. Returns the number of rows deleted."""
+    vault = _unlocked(vault)
+    deleted_services = []
+
+    def rows():
+        for service in services:
+            deleted_services.append(service)
+            yield (service,)
+
+    deleted = _run_bulk(vault, '''
+            DELETE FROM credentials
+            WHERE service = ?
+        ''', rows(), batch_size, commit_every)
+    _index_removed(vault, deleted_services)
+    return deleted
+
+
+# --------------------------------------------------------------------------------
+# History (prior versions, written by triggers on every update and delete)
+# --------------------------------------------------------------------------------
+HISTORY_MAX_VERSIONS = 10       # Versions kept per service by prune_history (None: no limit)
+HISTORY_MAX_AGE_DAYS = 365      # Older versions are pruned (None: no limit)
+HISTORY_PRUNE_BATCH_SIZE = 500  # Rows (or services) handled per pruning transaction
+
+
+class HistoryRecord(CredentialRecord):
+    """
+    An earlier version of a credential, decrypted lazily like CredentialRecord.
+    `id` is the credential's id, `version` identifies this version (pass it to
+    restore_credential_version), `change` says whether it was replaced by an
+    'update' or removed by a 'delete', at `replaced_at`.
+    """
+
+    __slots__ = ('version', 'replaced_at', 'change')
+
+    def __init__(self, row, vault):
+        super().__init__(row, vault)
+        self.version, self.replaced_at, self.change = row[10:13]
+
+    def __repr__(self):
+        return f"HistoryRecord(version={self.version!r}, service={self.service!r}, change={self.change!r})"
+
+
+def get_credential_history(service, limit=None, vault=None):
+    """Earlier versions of `service` (also after it was deleted), newest first."""
+    vault = _unlocked(vault)
+    with vault.connection() as conn:
+        rows = conn.execute(f'''
+            SELECT {HISTORY_STORED_COLUMNS}, created_at, updated_at, id, replaced_at, change
+            FROM credential_history
+            WHERE service = ?
+            ORDER BY id DESC
+            LIMIT ?
+        ''', (service, -1 if limit is None else limit)).fetchall()
+    return [HistoryRecord(row, vault) for row in rows]
+
+
+@metrics.timed("credentials.restore_version")
+def restore_credential_version(version, vault=None):
+    """
+    Make history `version` the current credential of its service again (re-adding
+    it if the service was deleted since). The version being replaced goes to the
+    history itself, so a restore can be undone. Returns False if there is no such version.
+    """
+    vault = _unlocked(vault)
+    with vault.connection() as conn:
+        begin_write(conn, vault.key_version)
+        try:
+            row = conn.execute(f"SELECT {HISTORY_STORED_COLUMNS} FROM credential_history WHERE id = ?",
+                               (version,)).fetchone()
+            if row is None:
+                conn.rollback()
+                return False
+            service = row[1]
+            fields = vault.record_cipher.open_stored(row, strict=True)
+            added = None
+            if _reseal_service(conn, vault, service, dict(enumerate(fields))) == 0:
+                added = _insert_credential(conn, vault, service, fields)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    if added is not None:
+        _index_added(vault, [(added, service)])
+    _invalidate_cached(vault, service)
+    return True
+
+
+@metrics.timed("credentials.prune_history")
+def prune_history(max_versions=HISTORY_MAX_VERSIONS, max_age_days=HISTORY_MAX_AGE_DAYS,
+                  batch_size=HISTORY_PRUNE_BATCH_SIZE, vault=None):
+    """
+    Drop history versions older than `max_age_days` and all but the newest
+    `max_versions` of each service, committing every `batch_size` rows (or
+    services) so writers are never held up for long. Works on the stored
+    (encrypted) rows, so the vault doesn't have to be unlocked.
+    Returns the number of versions removed.
+    """
+    vault = _vault(vault)
+    pruned = 0
+    with vault.connection() as conn:
+        if max_age_days is not None:
+            while True:
+                # No key version: pruning never seals anything, so it may run with any key (or none)
+                begin_write(conn)
+                # History is appended in replacement order, so the expired versions come first
+                rows = conn.execute('''
+                    SELECT id, replaced_at < datetime('now', ?)
+                    FROM credential_history
+                    ORDER BY id
+                    LIMIT ?
+                ''', (f"-{max_age_days} days", batch_size)).fetchall()
+                expired = [(row_id,) for row_id, is_expired in rows if is_expired]
+                if expired:
+                    conn.executemany("DELETE FROM credential_history WHERE id = ?", expired)
+                    pruned += len(expired)
+                conn.commit()
+                if len(expired) < batch_size:
+                    break
+
+        if max_versions is not None:
+            services = [row[0] for row in conn.execute('''
+                SELECT service FROM credential_history GROUP BY service HAVING COUNT(*) > ?
+            ''', (max_versions,))]
+            for batch in _batched(services, batch_size):
+                begin_write(conn)
+                cursor = conn.executemany('''
+                    DELETE FROM credential_history
+                    WHERE service = ? AND id <= (
+                        SELECT id FROM credential_history WHERE service = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+                    )
+                ''', ((service, service, max_versions) for service in batch))
+                conn.commit()
+                pruned += cursor.rowcount
+    return pruned
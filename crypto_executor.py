@@ -0,0 +1,186 @@
+# crypto_executor.py
+
+import base64
+import os
+from collections import deque
+from itertools import islice
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from envelope import DECRYPTION_FAILED, RecordCipher
+
+DEFAULT_CHUNK_SIZE = 256   # Rows handed to a worker at a time
+
+
+def cipher_from_key(key: bytes) -> Fernet:
+    fernet_key = base64.urlsafe_b64encode(key[:32])
+    return Fernet(fernet_key)
+
+
+def _encrypt_chunk(cipher, rows, fields, empty):
+    result = []
+    for row in rows:
+        row = list(row)
+        for i in fields:
+            value = row[i]
+            row[i] = cipher.encrypt(value.encode()) if value else empty
+        result.append(tuple(row))
+    return result
+
+
+def _decrypt_chunk(cipher, rows, fields, strict):
+    result = []
+    for row in rows:
+        row = list(row)
+        for i in fields:
+            value = row[i]
+            if not value:
+                row[i] = ""
+                continue
+            try:
+                row[i] = cipher.decrypt(value).decode()
+            except InvalidToken:
+                if strict:
+                    raise
+                row[i] = DECRYPTION_FAILED
+        result.append(tuple(row))
+    return result
+
+
+def _seal_chunk(record_cipher, rows):
+    # (id, service, username, password, url, notes, ...) -> (id, service, envelope, ...)
+    return [(row[0], row[1], record_cipher.seal(row[0], row[1], row[2:6])) + tuple(row[6:]) for row in rows]
+
+
+def _open_chunk(record_cipher, rows, strict):
+    # STORED_COLUMNS row (+ extra columns) -> (id, service, username, password, url, notes, ...)
+    return [(row[0], row[1]) + record_cipher.open_stored(row, strict) + tuple(row[8:]) for row in rows]
+
+
+# Process workers build their own ciphers once, from the raw key
+_worker_cipher = None
+_worker_record_cipher = None
+
+
+def _init_worker(key):
+    global _worker_cipher, _worker_record_cipher
+    _worker_cipher = cipher_from_key(key)
+    _worker_record_cipher = RecordCipher(key, _worker_cipher)
+
+
+def _encrypt_chunk_in_worker(rows, fields, empty):
+    return _encrypt_chunk(_worker_cipher, rows, fields, empty)
+
+
+def _decrypt_chunk_in_worker(rows, fields, strict):
+    return _decrypt_chunk(_worker_cipher, rows, fields, strict)
+
+
+def _seal_chunk_in_worker(rows):
+    return _seal_chunk(_worker_record_cipher, rows)
+
+
+def _open_chunk_in_worker(rows, strict):
+    return _open_chunk(_worker_record_cipher, rows, strict)
+
+
+class CryptoExecutor:
+    """
+    Fans record encryption/decryption out over a thread or process pool.
+
+    seal_rows/open_rows work on whole records (see envelope.py); encrypt_rows and
+    decrypt_rows transform individual Fernet fields, where `fields` selects which
+    positions of each row tuple are transformed and the rest pass through
+    untouched. Results are yielded in the same order as the input, and input is
+    consumed lazily so arbitrarily large row streams are processed in bounded memory.
+    """
+
+    def __init__(self, key, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, use_processes=False):
+        self.cipher = cipher_from_key(key)
+        self.record_cipher = RecordCipher(key, self.cipher)
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.use_processes = use_processes
+        # Imported here: concurrent.futures pulls in logging (and multiprocessing), which
+        # one-shot commands that never run bulk crypto shouldn't pay for at startup
+        if use_processes:
+            from concurrent.futures import ProcessPoolExecutor
+            self._pool = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(key,))
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="crypto")
+
+    def _submit(self, chunk_func, worker_func, cipher, chunk, args):
+        if self.use_processes:
+            return self._pool.submit(worker_func, chunk, *args)
+        return self._pool.submit(chunk_func, cipher, chunk, *args)
+
+    def _map(self, chunk_func, worker_func, rows, *args, cipher=None):
+        cipher = cipher or self.cipher
+        iterator = iter(rows)
+        chunk = list(islice(iterator, self.chunk_size))
+        next_chunk = list(islice(iterator, self.chunk_size))
+
+        # A single chunk is cheaper to handle inline than to hand to the pool
+        if not next_chunk:
+            yield from chunk_func(cipher, chunk, *args)
+            return
+
+        pending = deque()
+        max_pending = self.workers * 2
+        while chunk:
+            pending.append(self._submit(chunk_func, worker_func, cipher, chunk, args))
+            if len(pending) >= max_pending:
+                yield from pending.popleft().result()
+            chunk, next_chunk = next_chunk, list(islice(iterator, self.chunk_size))
+        while pending:
+            yield from pending.popleft().result()
+
+    def encrypt_rows(self, rows, fields=None, empty=b""):
+        """Encrypt the given field positions of every row. Blank fields become `empty`."""
+        rows = iter(rows)
+        if fields is None:
+            rows, fields = self._all_fields(rows)
+        return self._map(_encrypt_chunk, _encrypt_chunk_in_worker, rows, tuple(fields), empty)
+
+    def decrypt_rows(self, rows, fields=None, strict=False):
+        """
+        Decrypt the given field positions of every row. A field that fails to
+        decrypt becomes "Decryption failed", or raises InvalidToken when `strict`.
+        """
+        rows = iter(rows)
+        if fields is None:
+            rows, fields = self._all_fields(rows)
+        return self._map(_decrypt_chunk, _decrypt_chunk_in_worker, rows, tuple(fields), strict)
+
+    def seal_rows(self, rows):
+        """Seal (id, service, username, password, url, notes, ...) rows into (id, service, envelope, ...)."""
+        return self._map(_seal_chunk, _seal_chunk_in_worker, rows, cipher=self.record_cipher)
+
+    def open_rows(self, rows, strict=False):
+        """
+        Decrypt rows selected with envelope.STORED_COLUMNS (any format, extra
+        trailing columns allowed) into (id, service, username, password, url, notes, ...).
+        """
+        return self._map(_open_chunk, _open_chunk_in_worker, rows, strict, cipher=self.record_cipher)
+
+    @staticmethod
+    def _all_fields(rows):
+        first = next(rows, None)
+        if first is None:
+            return iter(()), ()
+        return _prepend(first, rows), range(len(first))
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _prepend(first, rows):
+    yield first
+    yield from rows
@@ -1,42 +1,580 @@
-# db_setup.py
-
-import os
-import sqlite3
-
-DB_PATH = 'secure_passwords.db'
-
-def get_db_connection(db_path=DB_PATH):
-    conn = sqlite3.connect(db_path)
-    return conn
-
-
-def initialize_db():
-    # Check if the database file already exists
-    is_first_run = not os.path.exists(DB_PATH)
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    if is_first_run:
-        print("Initializing new database...")
-
-    # Create credentials table if not exists
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS credentials (
-        id INTEGER PRIMARY KEY,
-        service TEXT NOT NULL,
-        username TEXT,
-        password BLOB NOT NULL,  -- will store encrypted password
-        url TEXT,
-        notes TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    ''')
-
-    # You can add more one-time setup operations here if needed
-    conn.commit()
-    conn.close()
-
-    if not is_first_run:
-        print("Database already exists and is up-to-date.")
+# db_setup.py
+
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+DB_PATH = 'secure_passwords.db'
+
+# Connection pool settings
+POOL_SIZE = 4                   # Number of long-lived connections kept open
+POOL_TIMEOUT = 30               # Seconds to wait for a free connection
+STATEMENT_CACHE_SIZE = 128      # Prepared statements cached per connection
+
+# Concurrent access (other threads and other processes, e.g. main.py and a script at once)
+BUSY_TIMEOUT = 10.0             # Seconds SQLite keeps retrying, with its own backoff, while another connection writes
+WRITE_RETRIES = 4               # Further attempts to start a write transaction once BUSY_TIMEOUT has run out
+WRITE_BACKOFF = 0.05            # Seconds before the first of those attempts; doubles each time, plus jitter
+ROTATION_WAIT_TIMEOUT = 120     # Seconds a write waits for a master password change (in any process) to finish
+
+# Pragmas applied to every pooled connection
+CONNECTION_PRAGMAS = (
+    ("journal_mode", "WAL"),    # Readers don't block the writer and vice versa
+    ("synchronous", "NORMAL"),  # Safe with WAL, avoids an fsync per commit
+    ("cache_size", -8000),      # ~8 MB page cache
+    ("mmap_size", 67108864),    # Map up to 64 MB of the database file
+    ("temp_store", "MEMORY"),
+)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that reports statement timings to metrics (the SQL and its parameters are never recorded)."""
+
+    def execute(self, sql, parameters=()):
+        with metrics.timer("db.execute"):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with metrics.timer("db.executemany"):
+            return super().executemany(sql, seq_of_parameters)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    Connection that times execute/executemany (its own and its cursors') and
+    commit. Used for connections opened while metrics are enabled.
+    """
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        with metrics.timer("db.execute"):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with metrics.timer("db.executemany"):
+            return super().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        with metrics.timer("db.commit"):
+            super().commit()
+
+
+def _connection_factory():
+    return InstrumentedConnection if metrics.is_enabled() else sqlite3.Connection
+
+
+@metrics.timed("db.connect")
+def get_db_connection(db_path=DB_PATH):
+    """A single configured connection (WAL, busy timeout) outside the pool."""
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, factory=_connection_factory())
+    return configure_connection(conn)
+
+
+def configure_connection(conn):
+    """Apply the tuned pragmas to a freshly opened connection."""
+    for name, value in CONNECTION_PRAGMAS:
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+class ConnectionPool:
+    """Thread-safe pool of long-lived, pre-configured SQLite connections."""
+
+    def __init__(self, db_path=DB_PATH, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @metrics.timed("db.connect")
+    def _open(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=BUSY_TIMEOUT,
+            check_same_thread=False,  # Connections move between threads, never shared at once
+            cached_statements=STATEMENT_CACHE_SIZE,
+            factory=_connection_factory(),
+        )
+        return configure_connection(conn)
+
+    def acquire(self):
+        if self._closed:
+            raise sqlite3.ProgrammingError("Connection pool is closed.")
+
+        # Reuse an idle connection if there is one
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        # Open a new connection while we are below the pool size
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._open()
+                except Exception:
+                    self._created -= 1
+                    raise
+
+        metrics.count("db.pool_waits")
+        try:
+            with metrics.timer("db.pool_wait"):
+                return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Timed out waiting for a database connection.")
+
+    def release(self, conn):
+        # Never hand out a connection with a half-finished transaction
+        if conn.in_transaction:
+            conn.rollback()
+
+        if self._closed:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put_nowait(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Close all idle connections; busy ones are closed when released."""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+# Process-wide pool (created on first use)
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(db_path=None):
+    """Return the shared pool, (re)creating it if the database path changed."""
+    global _pool
+    db_path = db_path or DB_PATH
+    with _pool_lock:
+        if _pool is None or _pool.db_path != db_path:
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(db_path)
+        return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+@contextmanager
+def pooled_connection():
+    """Borrow a connection from the shared pool for the duration of a block."""
+    with get_pool().connection() as conn:
+        yield conn
+
+
+# --------------------------------------------------------------------------------
+# Write transactions
+#
+# Any number of connections, in any number of processes, read concurrently (WAL).
+# Writes are serialized by SQLite's write lock: every write transaction starts
+# with BEGIN IMMEDIATE through begin_write(), so it holds the lock from its first
+# statement and can't hit a "database is locked" error halfway through. While
+# a master password change runs (key_rotation.target_version is set), every
+# other write waits, so a row can't be written under the old key after the
+# re-encryption has passed it. A writer whose key is older than the vault's
+# (another process changed the password) is refused.
+# --------------------------------------------------------------------------------
+class RotationInProgress(RuntimeError):
+    """
+    A master password change is running: a write waited ROTATION_WAIT_TIMEOUT
+    seconds for it to finish, or a read found a row it had already re-encrypted.
+    """
+
+    def __init__(self, message="A master password change is in progress; try again once it has finished."):
+        super().__init__(message)
+
+
+class KeyVersionChanged(RuntimeError):
+    """The master password was changed since this key was unlocked; unlock again to write."""
+
+    def __init__(self, message="The master password was changed (perhaps by another process); "
+                               "unlock the vault again."):
+        super().__init__(message)
+
+
+def _is_busy(error):
+    return str(error).startswith(("database is locked", "database is busy"))
+
+
+def _begin_immediate(conn):
+    delay = WRITE_BACKOFF
+    for attempt in range(WRITE_RETRIES + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e) or attempt == WRITE_RETRIES:
+                raise
+        metrics.count("db.busy_retries")
+        # Jitter keeps competing processes from retrying in lockstep
+        time.sleep(delay * (1 + random.random()))
+        delay *= 2
+
+
+def begin_write(conn, key_version=None):
+    """
+    Start a write transaction on `conn` holding the database write lock.
+
+    With `key_version` (the version of the writer's key), first wait until no
+    master password change is running, then raise KeyVersionChanged if the
+    vault has moved on to a newer key. Master password changes themselves
+    pass no key_version.
+    """
+    deadline = None
+    delay = WRITE_BACKOFF
+    while True:
+        _begin_immediate(conn)
+        if key_version is None:
+            return
+        current_version, target_version = conn.execute(
+            "SELECT key_version, target_version FROM key_rotation WHERE id = 1").fetchone()
+        if target_version is None:
+            if current_version != key_version:
+                conn.rollback()
+                raise KeyVersionChanged()
+            return
+        conn.rollback()
+        metrics.count("db.rotation_waits")
+        if deadline is None:
+            deadline = time.monotonic() + ROTATION_WAIT_TIMEOUT
+        elif time.monotonic() >= deadline:
+            raise RotationInProgress()
+        time.sleep(min(delay, 1.0) * (1 + random.random()))
+        delay *= 2
+
+
+def column_exists(cursor, table, column):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return any(row[1] == column for row in cursor.fetchall())
+
+
+# --------------------------------------------------------------------------------
+# Schema migrations
+#
+# PRAGMA user_version records the last migration applied. Each migration's schema
+# step runs in one transaction together with the version bump. Data migrations
+# (backfills) run in short batches afterwards, each committed with a checkpoint in
+# migration_progress, so a large vault stays usable while they run and an
+# interrupted run picks up where it stopped. The version is only bumped once the
+# backfill is done.
+# --------------------------------------------------------------------------------
+MIGRATION_BATCH_SIZE = 1000   # Rows per backfill transaction
+
+
+class Backfill:
+    """
+    A resumable data migration over credential ids.
+
+    step(conn, after_id, limit) migrates up to `limit` rows with id > after_id and
+    returns (rows migrated, last id looked at), or (0, None) when nothing is left.
+    remaining(conn, after_id) counts the rows still to do (used for estimates).
+    """
+
+    def __init__(self, name, step, remaining, key_version=None):
+        self.name = name
+        self.step = step
+        self.remaining = remaining
+        self.key_version = key_version  # Version of the key a keyed backfill writes with (see begin_write)
+
+
+class Migration:
+    """
+    One step of the schema history. `schema(cursor)` must be idempotent: databases
+    created before versioning may already contain the change.
+    """
+
+    def __init__(self, version, description, schema=None, backfill=None):
+        self.version = version
+        self.description = description
+        self.schema = schema
+        self.backfill = backfill
+
+
+def _create_base_tables(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS credentials (
+        id INTEGER PRIMARY KEY,
+        service TEXT NOT NULL,
+        username TEXT,
+        password BLOB NOT NULL,  -- will store encrypted password
+        url TEXT,
+        notes TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ''')
+
+
+def _add_key_rotation(cursor):
+    if not column_exists(cursor, 'credentials', 'key_version'):
+        # Master key generation the row is encrypted with
+        cursor.execute("ALTER TABLE credentials ADD COLUMN key_version INTEGER NOT NULL DEFAULT 1")
+
+    # Single-row table tracking the current key version and any master password change in progress
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS key_rotation (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        key_version INTEGER NOT NULL DEFAULT 1,  -- version every committed row is encrypted with
+        target_version INTEGER,                  -- set while a rotation is in progress
+        last_id INTEGER NOT NULL DEFAULT 0,      -- checkpoint: highest credential id re-encrypted
+        pending_verification BLOB,               -- verification token under the new key
+        started_at TIMESTAMP
+    );
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO key_rotation (id) VALUES (1)")
+
+
+def _add_service_index(cursor):
+    # Lookups, updates and deletes all filter on service
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_credentials_service ON credentials (service)")
+
+
+def _add_record_envelope(cursor):
+    if not column_exists(cursor, 'credentials', 'record_format'):
+        # 1: per-field Fernet tokens, 2: envelope (see envelope.py). Legacy rows
+        # need the key to convert, see credentials.migrate_legacy_records
+        cursor.execute("ALTER TABLE credentials ADD COLUMN record_format INTEGER NOT NULL DEFAULT 1")
+        cursor.execute("ALTER TABLE credentials ADD COLUMN envelope BLOB")
+
+
+def _add_search_tokens(cursor):
+    # Keyed-hash tokens of usernames, URL hosts and note keywords (see search.TokenHasher).
+    # Rows with search_indexed = 0 still need their tokens (credentials.search_tokens_backfill)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS search_tokens (
+            token BLOB NOT NULL,
+            credential_id INTEGER NOT NULL,
+            PRIMARY KEY (token, credential_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_search_tokens_credential ON search_tokens (credential_id)")
+    if not column_exists(cursor, 'credentials', 'search_indexed'):
+        cursor.execute("ALTER TABLE credentials ADD COLUMN search_indexed INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_credentials_unindexed ON credentials (id) WHERE search_indexed = 0")
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS credentials_delete_search_tokens AFTER DELETE ON credentials
+        BEGIN
+            DELETE FROM search_tokens WHERE credential_id = OLD.id;
+        END
+    ''')
+
+
+def _add_credential_history(cursor):
+    # Prior versions of each credential, encrypted exactly as they were stored (the envelope stays
+    # bound to credential_id and service). The triggers write them inside the same statement as the
+    # update or delete, so keeping history costs no extra round trip. Only updates that set
+    # updated_at count as new versions: key rotation and legacy backfills rewrite rows in place.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS credential_history (
+            id INTEGER PRIMARY KEY,
+            credential_id INTEGER NOT NULL,
+            service TEXT NOT NULL,
+            record_format INTEGER NOT NULL,
+            envelope BLOB,
+            username TEXT,
+            password BLOB,
+            url TEXT,
+            notes TEXT,
+            key_version INTEGER NOT NULL,
+            created_at TIMESTAMP,
+            updated_at TIMESTAMP,                          -- when this version was written
+            replaced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            change TEXT NOT NULL                           -- 'update' or 'delete'
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_credential_history_service ON credential_history (service, id)")
+    for name, event, change in (("credentials_history_update", "UPDATE OF updated_at", "update"),
+                                ("credentials_history_delete", "DELETE", "delete")):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON credentials
+            BEGIN
+                INSERT INTO credential_history (credential_id, service, record_format, envelope, username,
+                                                password, url, notes, key_version, created_at, updated_at, change)
+                VALUES (OLD.id, OLD.service, OLD.record_format, OLD.envelope, OLD.username, OLD.password,
+                        OLD.url, OLD.notes, OLD.key_version, OLD.created_at, OLD.updated_at, '{change}');
+            END
+        ''')
+
+
+# Ordered schema history; append new migrations with the next version number
+MIGRATIONS = [
+    Migration(1, "credentials table", _create_base_tables),
+    Migration(2, "key versioning and rotation state", _add_key_rotation),
+    Migration(3, "index on credentials.service", _add_service_index),
+    Migration(4, "record envelope columns", _add_record_envelope),
+    Migration(5, "encrypted search token index", _add_search_tokens),
+    Migration(6, "credential history", _add_credential_history),
+]
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _ensure_progress_table(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS migration_progress (
+        name TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL DEFAULT 0,   -- checkpoint: highest id handled so far
+        rows_done INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ''')
+
+
+def run_backfill(conn, backfill, batch_size=MIGRATION_BATCH_SIZE, progress=None):
+    """Run `backfill` to completion in committed batches, resuming from its checkpoint. Returns rows migrated."""
+    _ensure_progress_table(conn)
+    row = conn.execute("SELECT last_id, rows_done FROM migration_progress WHERE name = ?",
+                       (backfill.name,)).fetchone()
+    last_id, done = row or (0, 0)
+
+    while True:
+        begin_write(conn, backfill.key_version)
+        count, batch_last_id = backfill.step(conn, last_id, batch_size)
+        if batch_last_id is None:
+            conn.rollback()
+            break
+        last_id = batch_last_id
+        done += count
+        conn.execute('''
+            INSERT INTO migration_progress (name, last_id, rows_done) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE
+            SET last_id = excluded.last_id, rows_done = excluded.rows_done, updated_at = CURRENT_TIMESTAMP
+        ''', (backfill.name, last_id, done))
+        conn.commit()  # Short transactions: the write lock is only held for one batch
+        if progress:
+            progress(f"  {backfill.name}: {done} rows")
+
+    conn.execute("DELETE FROM migration_progress WHERE name = ?", (backfill.name,))
+    conn.commit()
+    return done
+
+
+def _estimate_backfill(conn, backfill, batch_size):
+    """(rows left, estimated seconds), timing one batch of the caller's transaction."""
+    row = conn.execute("SELECT last_id FROM migration_progress WHERE name = ?", (backfill.name,)).fetchone()
+    after_id = row[0] if row else 0
+    remaining = backfill.remaining(conn, after_id)
+    if not remaining:
+        return 0, 0.0
+    started = time.perf_counter()
+    count, _ = backfill.step(conn, after_id, batch_size)
+    elapsed = time.perf_counter() - started
+    return remaining, elapsed * remaining / max(count, 1)
+
+
+def migrate(backfills=(), dry_run=False, batch_size=MIGRATION_BATCH_SIZE, progress=None, pool=None):
+    """
+    Apply pending schema migrations, then the extra `backfills` (data migrations
+    that need more than the database, e.g. the unlocked key). Works on the
+    shared pool's database unless another `pool` is given.
+
+    With dry_run, everything runs inside a single transaction that is rolled
+    back: schema steps are timed for real and each backfill is timed on one batch
+    and extrapolated. Returns a list of (description, rows, seconds) with the
+    measured or estimated cost of each step.
+    """
+    results = []
+    with (pool or get_pool()).connection() as conn:
+        version = get_schema_version(conn)
+        pending = [migration for migration in MIGRATIONS if migration.version > version]
+
+        if dry_run:
+            begin_write(conn)
+            try:
+                # Inside the rolled-back transaction, so a dry run leaves the database as it was
+                _ensure_progress_table(conn)
+                for migration in pending:
+                    started = time.perf_counter()
+                    if migration.schema:
+                        migration.schema(conn.cursor())
+                    rows, seconds = 0, time.perf_counter() - started
+                    if migration.backfill:
+                        rows, backfill_seconds = _estimate_backfill(conn, migration.backfill, batch_size)
+                        seconds += backfill_seconds
+                    results.append((f"{migration.version}: {migration.description}", rows, seconds))
+                for backfill in backfills:
+                    results.append((backfill.name, *_estimate_backfill(conn, backfill, batch_size)))
+            finally:
+                conn.rollback()
+            return results
+
+        _ensure_progress_table(conn)
+        for migration in pending:
+            if progress:
+                progress(f"Applying migration {migration.version}: {migration.description}")
+            started = time.perf_counter()
+            # Explicit transaction: sqlite3 would otherwise run DDL in autocommit mode
+            begin_write(conn)
+            if migration.schema:
+                migration.schema(conn.cursor())
+            if migration.backfill is None:
+                conn.execute(f"PRAGMA user_version = {migration.version}")
+            conn.commit()
+
+            rows = 0
+            if migration.backfill:
+                rows = run_backfill(conn, migration.backfill, batch_size, progress)
+                conn.execute(f"PRAGMA user_version = {migration.version}")
+                conn.commit()
+            results.append((f"{migration.version}: {migration.description}", rows, time.perf_counter() - started))
+
+        for backfill in backfills:
+            started = time.perf_counter()
+            rows = run_backfill(conn, backfill, batch_size, progress)
+            results.append((backfill.name, rows, time.perf_counter() - started))
+    return results
+
+
+def initialize_db(quiet=False, pool=None):
+    # Check if the database file already exists
+    is_first_run = not os.path.exists(pool.db_path if pool else DB_PATH)
+
+    if is_first_run and not quiet:
+        print("Initializing new database...")
+
+    # A new database simply runs every migration
+    migrate(progress=None if quiet or is_first_run else print, pool=pool)
+
+    if not is_first_run and not quiet:
+        print("Database already exists and is up-to-date.")
@@ -0,0 +1,124 @@
+# envelope.py
+"""
+Record encryption formats.
+
+FORMAT_FERNET (legacy): username, password, url and notes are four separate
+base64 Fernet tokens in their own columns.
+
+FORMAT_ENVELOPE: all four fields are sealed together into one raw AES-256-GCM
+blob in the `envelope` column:
+
+    version (1 byte) | nonce (12 bytes) | ciphertext + tag (16 bytes)
+
+The plaintext is the four fields, each prefixed by a 4-byte length. The row id
+and service name are bound as associated data, so a blob copied onto another
+row fails to open. The `record_format` column says which format a row uses;
+legacy rows stay readable and are re-sealed whenever they are written.
+"""
+
+import os
+import struct
+
+from cryptography.fernet import InvalidToken
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+import metrics
+
+FORMAT_FERNET = 1
+FORMAT_ENVELOPE = 2
+
+ENVELOPE_VERSION = b"\x01"
+DECRYPTION_FAILED = "Decryption failed"
+
+# Columns every decrypting read selects, in this order (see RecordCipher.open_stored)
+STORED_COLUMNS = "id, service, record_format, envelope, username, password, url, notes"
+# The same for credential_history rows: their envelopes stay bound to the credential's id
+HISTORY_STORED_COLUMNS = "credential_id, service, record_format, envelope, username, password, url, notes"
+
+
+def _envelope_key(key: bytes) -> bytes:
+    # Separate subkey, so the AES-GCM key is never the same bytes as the Fernet key
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                info=b"CimeddaManager record envelope v1").derive(key[:32])
+
+
+def _associated_data(row_id, service):
+    return ENVELOPE_VERSION + struct.pack('>q', row_id) + service.encode()
+
+
+def _pack(fields):
+    parts = []
+    for value in fields:
+        data = value.encode() if value else b""
+        parts.append(struct.pack('>I', len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def _unpack(plaintext):
+    fields = []
+    offset = 0
+    for _ in range(4):
+        (length,) = struct.unpack_from('>I', plaintext, offset)
+        offset += 4
+        fields.append(plaintext[offset:offset + length])
+        offset += length
+    return fields
+
+
+class RecordCipher:
+    """Seals/opens record envelopes and still reads legacy per-field Fernet tokens."""
+
+    def __init__(self, key: bytes, fernet):
+        self.fernet = fernet
+        self._aead = AESGCM(_envelope_key(key))
+
+    @metrics.timed("crypto.seal")
+    def seal(self, row_id, service, fields) -> bytes:
+        """Encrypt (username, password, url, notes) for the row `row_id`/`service`."""
+        nonce = os.urandom(12)
+        return ENVELOPE_VERSION + nonce + self._aead.encrypt(
+            nonce, _pack(fields), _associated_data(row_id, service))
+
+    @metrics.timed("crypto.open")
+    def open(self, row_id, service, blob) -> list:
+        """Return the four fields as bytes. Raises InvalidToken, like Fernet, on any failure."""
+        if blob[:1] != ENVELOPE_VERSION:
+            raise InvalidToken
+        try:
+            plaintext = self._aead.decrypt(blob[1:13], blob[13:], _associated_data(row_id, service))
+        except InvalidTag:
+            raise InvalidToken from None
+        return _unpack(plaintext)
+
+    def open_stored(self, row, strict=False) -> tuple:
+        """
+        Decrypt a row selected with STORED_COLUMNS into (username, password, url, notes).
+        A field that fails to decrypt becomes "Decryption failed", or raises
+        InvalidToken when `strict`.
+        """
+        row_id, service, record_format, blob = row[:4]
+        if record_format == FORMAT_ENVELOPE:
+            try:
+                return tuple(value.decode() for value in self.open(row_id, service, blob))
+            except InvalidToken:
+                if strict:
+                    raise
+                return (DECRYPTION_FAILED,) * 4
+
+        fields = []
+        for token in row[4:8]:
+            if not token:
+                fields.append("")
+                continue
+            try:
+                with metrics.timer("crypto.fernet_decrypt"):
+                    fields.append(self.fernet.decrypt(token).decode())
+            except InvalidToken:
+                if strict:
+                    raise
+                fields.append(DECRYPTION_FAILED)
+        return tuple(fields)
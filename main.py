@@ -1,257 +1,687 @@
-# main.py
-# --------------------------------------------------------------------------------
-from db_setup import initialize_db
-from credentials import (
-    add_credential,
-    get_credential,
-    update_credential,
-    delete_credential,
-    list_services,
-    initialize_credentials,
-    # import_from_excel,
-    get_cipher,
-    reinitialize_cipher
-)
-from colorama import init, Fore, Style
-import getpass
-import os
-from security import change_master_password
-import time
-import threading
-
-
-# --------------------------------------------------------------------------------
-# Auto-lock settings
-LOCK_TIMEOUT = 300 # Auto-lock after 300 seconds (5 minutes)
-last_activity_time = time.time()
-is_locked = False
-stop_last_activity_thread = False  # Global flag to stop the thread
-
-# Initialize Colorama
-init(autoreset=True)
-
-# Define the ASCII art logo
-LOGO = Fore.CYAN + Style.BRIGHT + r"""
-
-   _____ _                    _     _       __  __                                   
-  / ____(_)                  | |   | |     |  \/  |                                  
- | |     _ _ __ ___   ___  __| | __| | __ _| \  / | __ _ _ __   __ _  __ _  ___ _ __ 
- | |    | | '_ ` _ \ / _ \/ _` |/ _` |/ _` | |\/| |/ _` | '_ \ / _` |/ _` |/ _ \ '__|
- | |____| | | | | | |  __/ (_| | (_| | (_| | |  | | (_| | | | | (_| | (_| |  __/ |   
-  \_____|_|_| |_| |_|\___|\__,_|\__,_|\__,_|_|  |_|\__,_|_| |_|\__,_|\__, |\___|_|   
-                                                                      __/ |          
-                                                                     |___/           
-
-""" + Style.RESET_ALL
-# --------------------------------------------------------------------------------
-def monitor_activity():
-    """Monitor user activity and lock after timeout."""
-    global last_activity_time, is_locked, stop_last_activity_thread
-    while not stop_last_activity_thread:
-        if time.time() - last_activity_time > LOCK_TIMEOUT:
-            is_locked = True
-            print(Fore.RED + "\n\nSession timed out. Please log in again." + Style.RESET_ALL)
-            exit(1)
-        time.sleep(1)
-# --------------------------------------------------------------------------------
-def reset_timer():
-    """Reset the inactivity timer."""
-    global last_activity_time
-    last_activity_time = time.time()
-# --------------------------------------------------------------------------------
-def service_display_and_selector():
-    services = list_services()
-
-    if not services:
-        print(Fore.RED + "No credentials available." + Style.RESET_ALL)
-
-    print("\nAvailable Services:")
-
-    for index, (service_id, service_name) in enumerate(services):
-        print(f"{index}. {service_name}")
-
-    user_input = input("Enter the number or part of the service name you want: ")
-    selected_service = None
-
-    # Attempt numeric selection first
-    try:
-        selection_index = int(user_input)
-        if selection_index < 0 or selection_index >= len(services):
-            print(Fore.RED + "Invalid selection." + Style.RESET_ALL)
-
-        selected_service = normalize_str_value(services[selection_index][1])
-    except ValueError:
-        # Handle as text search if not a valid number
-        search_query = user_input.lower()
-        matching_services = [
-            (idx, service_name) for idx, (_, service_name) in enumerate(services)
-            if search_query in service_name.lower()
-        ]
-
-        if not matching_services:
-            print(Fore.RED + f"No services found matching '{user_input}'." + Style.RESET_ALL)
-        elif len(matching_services) == 1:
-            # If only one match, select it automatically
-            selected_service = normalize_str_value(matching_services[0][1])
-        else:
-            # Multiple matches found. Let user refine choice.
-            print("\nMultiple services found:")
-            for idx, service_name in matching_services:
-                print(f"{idx}. {service_name}")
-
-            try:
-                refined_index = int(input("Multiple matches found. Enter the number of the desired service: "))
-                # Validate refined index is among the matching ones
-                if any(refined_index == idx for idx, _ in matching_services):
-                    selected_service = normalize_str_value(services[refined_index][1])
-                else:
-                    print(Fore.RED + "Invalid selection among matches." + Style.RESET_ALL)
-            except ValueError:
-                print(Fore.RED + "Please enter a valid number." + Style.RESET_ALL)
-
-    return selected_service
-# --------------------------------------------------------------------------------
-def normalize_str_value(val):
-    val = str(val)
-    if val == "None":
-        val = None
-    return val
-# --------------------------------------------------------------------------------
-def main():
-    # Start the activity monitor thread
-    global is_locked, stop_last_activity_thread
-    threading.Thread(target=monitor_activity, daemon=True).start()
-
-    # Print the logo at the top of the console
-    os.system('cls')
-    print(LOGO)
-
-    initialize_credentials()   # Set up master key and cipher (prompts if needed).
-    initialize_db()            # Initialize or verify the database.
-    cipher = get_cipher()
-
-    while True:
-        # Check if session is locked
-        if is_locked:
-            # Re-authenticate the user
-            print(Fore.YELLOW + "Session locked due to inactivity." + Style.RESET_ALL)
-            stop_last_activity_thread = True
-            break
-
-        reset_timer()  # Reset the timer after any user activity
-
-        print("\n" + Fore.CYAN + Style.BRIGHT + "---------------------------------------")
-        print(Fore.CYAN + Style.BRIGHT + "CimeddaManager - Password Manager")
-        print("1. Add Credential")
-        print("2. Retrieve Credential")
-        print("3. Update Credential")
-        print("4. Delete Credential")
-        print("5. Change Master Password")
-        print("6. Exit")
-        # print("7. Import Credentials from Excel")  # New option
-
-        choice = input(Fore.YELLOW + "Select an option (1-5): " + Style.RESET_ALL)
-
-        if choice == '1':
-            service_name = normalize_str_value(input(Fore.YELLOW + "Enter service name: "+ Style.RESET_ALL))
-            username = normalize_str_value(input(Fore.YELLOW + "Enter username: "+ Style.RESET_ALL))
-            password_value = normalize_str_value(getpass.getpass(Fore.YELLOW + "Enter password: "+ Style.RESET_ALL))
-            url = normalize_str_value(input(Fore.YELLOW + "Enter URL (optional): "+ Style.RESET_ALL))
-            notes = normalize_str_value(input(Fore.YELLOW + "Enter notes (optional): "+ Style.RESET_ALL))
-            add_credential(service_name, username, password_value, url, notes)
-            print(Fore.GREEN + f"Credential for '{service_name}' added successfully." + Style.RESET_ALL)
-
-        elif choice == '2':
-            selected_service = service_display_and_selector()
-
-            # Now retrieve and display the credential if a service was selected
-            if selected_service:
-                record = get_credential(selected_service)
-                if record:
-                    print("\n" + Fore.GREEN + "Retrieved Record:" + Style.RESET_ALL)
-                    print(Fore.YELLOW + f"ID: {Style.RESET_ALL}{record[0]}")
-                    print(Fore.YELLOW + f"Service: {Style.RESET_ALL}{record[1]}")
-                    print(Fore.YELLOW + f"Username: {Style.RESET_ALL}{record[2]}")
-                    print(Fore.YELLOW + f"Password: {Style.RESET_ALL}{record[3]}")
-                    print(Fore.YELLOW + f"URL: {Style.RESET_ALL}{record[4]}")
-                    print(Fore.YELLOW + f"Notes: {Style.RESET_ALL}{record[5]}")
-                    print(Fore.YELLOW + f"Created At: {Style.RESET_ALL}{record[6]}")
-                    print(Fore.YELLOW + f"Updated At: {Style.RESET_ALL}{record[7]}")
-                else:
-                    print(Fore.RED + f"No record found for service '{selected_service}'." + Style.RESET_ALL)
-            else:
-                print(Fore.RED + f"Invalid service selected: '{selected_service}'." + Style.RESET_ALL)
-
-        elif choice == '3':
-            selected_service = service_display_and_selector()
-
-            # Now retrieve and display the credential if a service was selected
-            if selected_service:
-                print(f"\nUpdating credential for '{selected_service}'." + Style.RESET_ALL)
-                print(Fore.YELLOW + "Enter new values (leave blank to keep current value):" + Style.RESET_ALL)
-                username = normalize_str_value(input(Fore.YELLOW + "New username: " + Style.RESET_ALL))
-                password_value = normalize_str_value(getpass.getpass(Fore.YELLOW + "New password: " + Style.RESET_ALL))
-                url = normalize_str_value(input(Fore.YELLOW + "New URL: " + Style.RESET_ALL))
-                notes = normalize_str_value(input(Fore.YELLOW + "New notes: " + Style.RESET_ALL))
-
-                # Only include values in kwargs if they are not empty
-                kwargs = {}
-                if username.strip():
-                    kwargs['username'] = username.strip()
-                if password_value.strip():
-                    kwargs['password'] = password_value.strip()
-                if url.strip():
-                    kwargs['url'] = url.strip()
-                if notes.strip():
-                    kwargs['notes'] = notes.strip()
-
-                success = update_credential(selected_service, **kwargs)
-                if success:
-                    print(Fore.GREEN + f"Credential for '{selected_service}' updated successfully." + Style.RESET_ALL)
-                else:
-                    print(Fore.RED + f"Failed to update credential for '{selected_service}'. Make sure it exists." + Style.RESET_ALL)
-            else:
-                print(Fore.RED + f"Invalid service selected: '{selected_service}'." + Style.RESET_ALL)
-
-        elif choice == '4':
-            selected_service = service_display_and_selector()
-
-            # Now retrieve and display the credential if a service was selected
-            if selected_service:
-                confirm = input(f"Are you sure you want to delete '{selected_service}'? (y/n): ").lower()
-                if confirm == 'y':
-                    success = delete_credential(selected_service)
-                    if success:
-                        print(Fore.GREEN + f"Credential for '{selected_service}' deleted successfully." + Style.RESET_ALL)
-                    else:
-                        print(Fore.RED + f"No credential found for service '{selected_service}'." + Style.RESET_ALL)
-                else:
-                    print("Deletion canceled.")
-            else:
-                print(Fore.RED + f"Invalid service selected: '{selected_service}'." + Style.RESET_ALL)
-
-        elif choice == '5':
-            new_key = change_master_password(cipher)
-
-            # Reinitialize the global cipher
-            reinitialize_cipher(new_key)
-            cipher = get_cipher()
-
-        elif choice == '6':
-            print(Fore.CYAN + "Exiting CimeddaManager. Goodbye!" + Style.RESET_ALL)
-            stop_last_activity_thread = True
-            break
-
-        # elif choice == '7':
-        #     file_path = input(Fore.YELLOW + "Enter the path to the Excel file: " + Style.RESET_ALL)
-        #     try:
-        #         import_from_excel(file_path)
-        #         print(Fore.GREEN + "Import completed." + Style.RESET_ALL)
-        #     except Exception as e:
-        #         print(Fore.RED + f"An error occurred during import: {e}" + Style.RESET_ALL)
-
-        else:
-            print(Fore.RED + "Invalid option. Please select a valid number." + Style.RESET_ALL)
-# --------------------------------------------------------------------------------
-if __name__ == "__main__":
-    main()
+# main.py
+# --------------------------------------------------------------------------------
+from db_setup import MIGRATION_BATCH_SIZE, KeyVersionChanged, initialize_db, migrate
+from credentials import (
+    add_credential,
+    get_credential,
+    update_credential,
+    delete_credential,
+    iter_service_pages,
+    iter_services,
+    search_services,
+    find_credentials,
+    get_credential_history,
+    restore_credential_version,
+    prune_history,
+    HISTORY_MAX_AGE_DAYS,
+    HISTORY_MAX_VERSIONS,
+    initialize_credentials,
+    enable_cache,
+    get_session,
+    set_session,
+    lock_session,
+    keyed_backfills,
+    default_vault,
+    CredentialRecord,
+    VaultLocked
+)
+from colorama import init, Fore, Style
+import argparse
+import getpass
+import json
+import os
+import sys
+from itertools import islice
+import metrics
+from security import change_master_password, open_session, rotation_in_progress, set_master_password
+
+
+# --------------------------------------------------------------------------------
+# Auto-lock settings
+LOCK_TIMEOUT = 300 # Auto-lock after 300 seconds (5 minutes)
+SERVICE_PAGE_SIZE = 50  # Services listed per page in the selector
+CLEAR_SCREEN = "\033[2J\033[H"  # ANSI erase display + cursor home (colorama translates it on Windows)
+
+# Define the ASCII art logo
+LOGO = Fore.CYAN + Style.BRIGHT + r"""
+
+   _____ _                    _     _       __  __                                   
+  / ____(_)                  | |   | |     |  \/  |                                  
+ | |     _ _ __ ___   ___  __| | __| | __ _| \  / | __ _ _ __   __ _  __ _  ___ _ __ 
+ | |    | | '_ ` _ \ / _ \/ _` |/ _` |/ _` | |\/| |/ _` | '_ \ / _` |/ _` |/ _ \ '__|
+ | |____| | | | | | |  __/ (_| | (_| | (_| | |  | | (_| | | | | (_| | (_| |  __/ |   
+  \_____|_|_| |_| |_|\___|\__,_|\__,_|\__,_|_|  |_|\__,_|_| |_|\__,_|\__, |\___|_|   
+                                                                      __/ |          
+                                                                     |___/           
+
+""" + Style.RESET_ALL
+# --------------------------------------------------------------------------------
+def announce_lock():
+    """Called on the auto-lock thread once the vault has been wiped."""
+    print(Fore.RED + "\n\nSession timed out. Please log in again." + Style.RESET_ALL)
+# --------------------------------------------------------------------------------
+def reset_timer():
+    """Reset the inactivity timer."""
+    default_vault().touch()
+# --------------------------------------------------------------------------------
+def service_display_and_selector():
+    # Services are shown one page at a time, so large vaults start displaying immediately
+    pages = iter_service_pages(page_size=SERVICE_PAGE_SIZE)
+    services = []
+
+    print("\nAvailable Services:")
+    while True:
+        page = next(pages, [])
+        for index, (service_id, service_name) in enumerate(page, start=len(services)):
+            print(f"{index}. {service_name}")
+        services.extend(page)
+
+        if not services:
+            print(Fore.RED + "No credentials available." + Style.RESET_ALL)
+
+        if len(page) == SERVICE_PAGE_SIZE:
+            user_input = input("Enter the number or part of the service name you want (Enter for more): ")
+            if user_input == "":
+                continue
+        else:
+            user_input = input("Enter the number or part of the service name you want: ")
+        break
+
+    selected_service = None
+
+    # Attempt numeric selection first
+    try:
+        selection_index = int(user_input)
+        if selection_index < 0 or selection_index >= len(services):
+            print(Fore.RED + "Invalid selection." + Style.RESET_ALL)
+        else:
+            selected_service = normalize_str_value(services[selection_index][1])
+    except ValueError:
+        # Handle as text search if not a valid number (ranked prefix/substring/typo-tolerant matches)
+        matching_services = search_services(user_input)
+
+        if not matching_services:
+            print(Fore.RED + f"No services found matching '{user_input}'." + Style.RESET_ALL)
+        elif len(matching_services) == 1:
+            # If only one match, select it automatically
+            selected_service = normalize_str_value(matching_services[0][1])
+        else:
+            # Multiple matches found. Let user refine choice.
+            print("\nMultiple services found:")
+            for idx, (_, service_name) in enumerate(matching_services):
+                print(f"{idx}. {service_name}")
+
+            try:
+                refined_index = int(input("Multiple matches found. Enter the number of the desired service: "))
+                # Validate refined index is among the matching ones
+                if 0 <= refined_index < len(matching_services):
+                    selected_service = normalize_str_value(matching_services[refined_index][1])
+                else:
+                    print(Fore.RED + "Invalid selection among matches." + Style.RESET_ALL)
+            except ValueError:
+                print(Fore.RED + "Please enter a valid number." + Style.RESET_ALL)
+
+    return selected_service
+# --------------------------------------------------------------------------------
+def print_transfer_errors(report, limit=20):
+    for line, message in report.errors[:limit]:
+        print(Fore.RED + f"  {line}: {message}" + Style.RESET_ALL)
+    if report.error_count > limit:
+        print(Fore.RED + f"  ... and {report.error_count - limit} more errors." + Style.RESET_ALL)
+# --------------------------------------------------------------------------------
+def normalize_str_value(val):
+    val = str(val)
+    if val == "None":
+        val = None
+    return val
+# --------------------------------------------------------------------------------
+def interactive_main():
+    # Print the logo at the top of the console
+    if sys.stdout.isatty():
+        print(CLEAR_SCREEN, end="")
+    print(LOGO)
+
+    initialize_db()            # Initialize or verify the database (cheap; before the slow key derivation).
+    initialize_credentials()   # Set up master key and cipher (prompts if needed).
+    enable_cache()             # Keep recently viewed records decrypted until the session locks.
+    # Wipes the key, cached records and connections after LOCK_TIMEOUT seconds without activity
+    default_vault().start_autolock(LOCK_TIMEOUT, on_lock=announce_lock)
+
+    # Finish an interrupted master password change before touching any credential
+    if rotation_in_progress():
+        print(Fore.YELLOW + "A previous master password change did not complete." + Style.RESET_ALL)
+        set_session(change_master_password(get_session()))
+
+    while True:
+        # Check if session is locked
+        if not default_vault().unlocked:
+            print(Fore.YELLOW + "Session locked due to inactivity." + Style.RESET_ALL)
+            break
+
+        reset_timer()  # Reset the timer after any user activity
+
+        print("\n" + Fore.CYAN + Style.BRIGHT + "---------------------------------------")
+        print(Fore.CYAN + Style.BRIGHT + "CimeddaManager - Password Manager")
+        print("1. Add Credential")
+        print("2. Retrieve Credential")
+        print("3. Update Credential")
+        print("4. Delete Credential")
+        print("5. Change Master Password")
+        print("6. Exit")
+        print("7. Import Credentials (CSV, JSON-lines or archive)")
+        print("8. Export Credentials (CSV, JSON-lines or archive)")
+
+        choice = input(Fore.YELLOW + "Select an option (1-8): " + Style.RESET_ALL)
+
+        if choice == '1':
+            service_name = normalize_str_value(input(Fore.YELLOW + "Enter service name: "+ Style.RESET_ALL))
+            username = normalize_str_value(input(Fore.YELLOW + "Enter username: "+ Style.RESET_ALL))
+            password_value = normalize_str_value(getpass.getpass(Fore.YELLOW + "Enter password: "+ Style.RESET_ALL))
+            url = normalize_str_value(input(Fore.YELLOW + "Enter URL (optional): "+ Style.RESET_ALL))
+            notes = normalize_str_value(input(Fore.YELLOW + "Enter notes (optional): "+ Style.RESET_ALL))
+            add_credential(service_name, username, password_value, url, notes)
+            print(Fore.GREEN + f"Credential for '{service_name}' added successfully." + Style.RESET_ALL)
+
+        elif choice == '2':
+            selected_service = service_display_and_selector()
+
+            # Now retrieve and display the credential if a service was selected
+            if selected_service:
+                record = get_credential(selected_service)
+                if record:
+                    print("\n" + Fore.GREEN + "Retrieved Record:" + Style.RESET_ALL)
+                    print(Fore.YELLOW + f"ID: {Style.RESET_ALL}{record.id}")
+                    print(Fore.YELLOW + f"Service: {Style.RESET_ALL}{record.service}")
+                    print(Fore.YELLOW + f"Username: {Style.RESET_ALL}{record.username}")
+                    print(Fore.YELLOW + f"Password: {Style.RESET_ALL}{record.password}")
+                    print(Fore.YELLOW + f"URL: {Style.RESET_ALL}{record.url}")
+                    print(Fore.YELLOW + f"Notes: {Style.RESET_ALL}{record.notes}")
+                    print(Fore.YELLOW + f"Created At: {Style.RESET_ALL}{record.created_at}")
+                    print(Fore.YELLOW + f"Updated At: {Style.RESET_ALL}{record.updated_at}")
+                else:
+                    print(Fore.RED + f"No record found for service '{selected_service}'." + Style.RESET_ALL)
+            else:
+                print(Fore.RED + f"Invalid service selected: '{selected_service}'." + Style.RESET_ALL)
+
+        elif choice == '3':
+            selected_service = service_display_and_selector()
+
+            # Now retrieve and display the credential if a service was selected
+            if selected_service:
+                print(f"\nUpdating credential for '{selected_service}'." + Style.RESET_ALL)
+                print(Fore.YELLOW + "Enter new values (leave blank to keep current value):" + Style.RESET_ALL)
+                username = normalize_str_value(input(Fore.YELLOW + "New username: " + Style.RESET_ALL))
+                password_value = normalize_str_value(getpass.getpass(Fore.YELLOW + "New password: " + Style.RESET_ALL))
+                url = normalize_str_value(input(Fore.YELLOW + "New URL: " + Style.RESET_ALL))
+                notes = normalize_str_value(input(Fore.YELLOW + "New notes: " + Style.RESET_ALL))
+
+                # Only include values in kwargs if they are not empty
+                kwargs = {}
+                if username.strip():
+                    kwargs['username'] = username.strip()
+                if password_value.strip():
+                    kwargs['password'] = password_value.strip()
+                if url.strip():
+                    kwargs['url'] = url.strip()
+                if notes.strip():
+                    kwargs['notes'] = notes.strip()
+
+                success = update_credential(selected_service, **kwargs)
+                if success:
+                    print(Fore.GREEN + f"Credential for '{selected_service}' updated successfully." + Style.RESET_ALL)
+                else:
+                    print(Fore.RED + f"Failed to update credential for '{selected_service}'. Make sure it exists." + Style.RESET_ALL)
+            else:
+                print(Fore.RED + f"Invalid service selected: '{selected_service}'." + Style.RESET_ALL)
+
+        elif choice == '4':
+            selected_service = service_display_and_selector()
+
+            # Now retrieve and display the credential if a service was selected
+            if selected_service:
+                confirm = input(f"Are you sure you want to delete '{selected_service}'? (y/n): ").lower()
+                if confirm == 'y':
+                    success = delete_credential(selected_service)
+                    if success:
+                        print(Fore.GREEN + f"Credential for '{selected_service}' deleted successfully." + Style.RESET_ALL)
+                    else:
+                        print(Fore.RED + f"No credential found for service '{selected_service}'." + Style.RESET_ALL)
+                else:
+                    print("Deletion canceled.")
+            else:
+                print(Fore.RED + f"Invalid service selected: '{selected_service}'." + Style.RESET_ALL)
+
+        elif choice == '5':
+            # Reuses the unlocked session: the current password is re-checked without another key derivation
+            set_session(change_master_password(get_session()))
+
+        elif choice == '6':
+            print(Fore.CYAN + "Exiting CimeddaManager. Goodbye!" + Style.RESET_ALL)
+            lock_session()
+            break
+
+        elif choice == '7':
+            import transfer
+            file_path = input(Fore.YELLOW + "Enter the path of the file to import: " + Style.RESET_ALL)
+            try:
+                passphrase = None
+                if transfer.detect_format(file_path) == 'archive':
+                    passphrase = getpass.getpass(Fore.YELLOW + "Archive passphrase: " + Style.RESET_ALL).encode()
+                report = transfer.import_file(file_path, passphrase=passphrase)
+                print(Fore.GREEN + f"Import completed: {report.rows} credentials "
+                                   f"({report.rows_per_second:.0f} rows/sec)." + Style.RESET_ALL)
+                print_transfer_errors(report)
+            except Exception as e:
+                print(Fore.RED + f"An error occurred during import: {e}" + Style.RESET_ALL)
+
+        elif choice == '8':
+            import transfer
+            file_path = input(Fore.YELLOW + "Enter the path of the export file (.csv, .jsonl, anything else = encrypted archive): " + Style.RESET_ALL)
+            try:
+                passphrase = None
+                if transfer.detect_format(file_path) == 'archive':
+                    passphrase = getpass.getpass(Fore.YELLOW + "Archive passphrase: " + Style.RESET_ALL).encode()
+                else:
+                    print(Fore.RED + "Warning: this file will contain your passwords in plain text." + Style.RESET_ALL)
+                report = transfer.export_file(file_path, passphrase=passphrase)
+                print(Fore.GREEN + f"Export completed: {report.rows} credentials "
+                                   f"({report.rows_per_second:.0f} rows/sec)." + Style.RESET_ALL)
+                print_transfer_errors(report)
+            except Exception as e:
+                print(Fore.RED + f"An error occurred during export: {e}" + Style.RESET_ALL)
+
+        else:
+            print(Fore.RED + "Invalid option. Please select a valid number." + Style.RESET_ALL)
+# --------------------------------------------------------------------------------
+# Non-interactive mode: subcommands and a JSON-lines pipeline over one unlocked session
+# --------------------------------------------------------------------------------
+MASTER_PASSWORD_ENV = "CIMEDDA_MASTER_PASSWORD"
+NEW_MASTER_PASSWORD_ENV = "CIMEDDA_NEW_MASTER_PASSWORD"
+ARCHIVE_PASSPHRASE_ENV = "CIMEDDA_ARCHIVE_PASSPHRASE"
+METRICS_FILE_ENV = "CIMEDDA_METRICS_FILE"
+
+
+def read_master_password(args):
+    """Master password for batch use: --password-file, then $CIMEDDA_MASTER_PASSWORD, then a prompt."""
+    if args.password_file:
+        with open(args.password_file, 'r') as f:
+            return f.readline().rstrip("\r\n").encode()
+    if os.environ.get(MASTER_PASSWORD_ENV):
+        return os.environ[MASTER_PASSWORD_ENV].encode()
+    return getpass.getpass("Master password: ").encode()
+
+
+def read_new_master_password(args):
+    """New master password for `rotate`: --new-password-file, then $CIMEDDA_NEW_MASTER_PASSWORD, else None."""
+    if args.new_password_file:
+        with open(args.new_password_file, 'r') as f:
+            return f.readline().rstrip("\r\n").encode()
+    if os.environ.get(NEW_MASTER_PASSWORD_ENV):
+        return os.environ[NEW_MASTER_PASSWORD_ENV].encode()
+    return None
+
+
+def batch_unlock(args):
+    if not os.path.exists(default_vault().verify_path):
+        print("No master password is set yet. Run 'main.py' once to create the vault.", file=sys.stderr)
+        sys.exit(1)
+    # Schema first: it needs no key, and a broken database should fail before the slow key derivation
+    if args.command != "migrate":  # migrate applies (or with --dry-run only estimates) the schema changes itself
+        initialize_db(quiet=True)
+    session = open_session(read_master_password(args))
+    if session is None:
+        print("Unable to unlock the vault: wrong master password or no master password set.", file=sys.stderr)
+        sys.exit(1)
+    set_session(session)
+    if args.command == "migrate":
+        return
+
+    if args.command != "rotate" and rotation_in_progress():
+        print("A master password change did not complete. Run 'main.py rotate' to finish it first.", file=sys.stderr)
+        sys.exit(1)
+
+
+def record_to_dict(record, fields=None):
+    """Only the requested secret fields are decrypted (all four when `fields` is None)."""
+    result = {"id": record.id, "service": record.service,
+              "created_at": record.created_at, "updated_at": record.updated_at}
+    for field in fields or record.FIELDS:
+        if field in record.FIELDS:
+            result[field] = getattr(record, field)
+    return result
+
+
+def history_to_dict(version, fields=None):
+    result = record_to_dict(version, fields)
+    result.update(version=version.version, replaced_at=version.replaced_at, change=version.change)
+    return result
+
+
+OPERATION_TEXT_FIELDS = ("service", "username", "password", "url", "notes")
+
+
+def run_operation(op):
+    """Execute one operation dict ({"op": "add", "service": ...}) and return a JSON-able result."""
+    if not isinstance(op, dict):
+        return {"ok": False, "error": f"operation must be a JSON object, not {type(op).__name__}"}
+    for field in OPERATION_TEXT_FIELDS:
+        if op.get(field) is not None and not isinstance(op[field], str):
+            return {"ok": False, "error": f"{field} must be a string, not {type(op[field]).__name__}"}
+    fields = op.get("fields")
+    if fields is not None and (not isinstance(fields, list) or not all(field in CredentialRecord.FIELDS for field in fields)):
+        return {"ok": False, "error": f"fields must be a list of {', '.join(CredentialRecord.FIELDS)}"}
+    name = op.get("op")
+    if name == "add":
+        add_credential(op["service"], op.get("username") or "", op["password"], op.get("url") or "", op.get("notes") or "")
+        return {"ok": True}
+    if name == "get":
+        record = get_credential(op["service"])
+        if record is None:
+            return {"ok": False, "error": "not found"}
+        return {"ok": True, "record": record_to_dict(record, op.get("fields"))}
+    if name == "update":
+        fields = {field: op[field] for field in ("username", "password", "url", "notes") if op.get(field)}
+        return {"ok": update_credential(op["service"], **fields)}
+    if name == "delete":
+        return {"ok": delete_credential(op["service"])}
+    if name == "list":
+        services = iter_services(contains=op.get("contains"))
+        limit = op.get("limit")
+        return {"ok": True, "services": [service for _, service in islice(services, limit)]}
+    if name == "find":
+        try:
+            matches = find_credentials(op.get("username"), op.get("host"), op.get("keyword"))
+        except ValueError as e:
+            return {"ok": False, "error": str(e)}
+        return {"ok": True, "services": [service for _, service in matches]}
+    if name == "history":
+        versions = get_credential_history(op["service"], op.get("limit"))
+        return {"ok": True, "versions": [history_to_dict(version, op.get("fields")) for version in versions]}
+    if name == "restore_version":
+        return {"ok": restore_credential_version(op["version"])}
+    if name == "stats":
+        return {"ok": True, "metrics": metrics.snapshot()}
+    return {"ok": False, "error": f"unknown op: {name!r}"}
+
+
+def run_pipe(input_stream=sys.stdin, output_stream=sys.stdout):
+    """
+    Read one JSON operation per line, write one JSON result per line. A failing
+    operation only fails its own line; the stream stops once the vault locks or
+    another process changes the master password.
+    """
+    for line in input_stream:
+        line = line.strip()
+        if not line:
+            continue
+        op = {}
+        try:
+            op = json.loads(line)
+            result = run_operation(op)
+        except VaultLocked as e:
+            output_stream.write(json.dumps({"ok": False, "error": f"VaultLocked: {e}"}) + "\n")
+            output_stream.flush()
+            break
+        except KeyVersionChanged as e:
+            # Another process changed the master password; this session can't write any more
+            output_stream.write(json.dumps({"ok": False, "error": f"KeyVersionChanged: {e}"}) + "\n")
+            output_stream.flush()
+            break
+        except Exception as e:
+            result = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        if isinstance(op, dict) and "request_id" in op:
+            result["request_id"] = op["request_id"]
+        output_stream.write(json.dumps(result) + "\n")
+        output_stream.flush()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="main.py", description="CimeddaManager - Password Manager")
+    parser.add_argument("--password-file", help="read the master password from the first line of this file")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help=f"record timings and write them to FILE on exit (.prom for Prometheus text, "
+                             f"else JSON; default: ${METRICS_FILE_ENV})")
+    commands = parser.add_subparsers(dest="command")
+
+    add = commands.add_parser("add", help="add a credential")
+    add.add_argument("service")
+    add.add_argument("--username", default="")
+    add.add_argument("--password", help="credential password (prompted for if omitted)")
+    add.add_argument("--url", default="")
+    add.add_argument("--notes", default="")
+
+    get = commands.add_parser("get", help="print a credential as JSON")
+    get.add_argument("service")
+    get.add_argument("--field", choices=("username", "password", "url", "notes"),
+                     help="print only this field, unformatted")
+
+    update = commands.add_parser("update", help="update fields of a credential")
+    update.add_argument("service")
+    for field in ("username", "password", "url", "notes"):
+        update.add_argument(f"--{field}")
+
+    delete = commands.add_parser("delete", help="delete a credential")
+    delete.add_argument("service")
+
+    listing = commands.add_parser("list", help="list service names")
+    listing.add_argument("--contains", help="only services containing this text")
+    listing.add_argument("--limit", type=int)
+
+    find = commands.add_parser("find", help="list services by username, URL host or note keywords (indexed)")
+    find.add_argument("--username", help="exact username (case-insensitive)")
+    find.add_argument("--host", help="host name or URL; subdomains match too")
+    find.add_argument("--keyword", help="words that must all appear in the notes")
+
+    history = commands.add_parser("history", help="print earlier versions of a credential as JSON, newest first")
+    history.add_argument("service")
+    history.add_argument("--field", choices=("username", "password", "url", "notes"),
+                         help="only decrypt this field of each version")
+    history.add_argument("--limit", type=int)
+    history.add_argument("--restore", type=int, metavar="VERSION",
+                         help="make this version current again (the current one goes to the history)")
+
+    prune = commands.add_parser("prune-history", help="drop old credential versions (no password needed)")
+    prune.add_argument("--max-versions", type=int, default=HISTORY_MAX_VERSIONS,
+                       help=f"versions kept per service (default {HISTORY_MAX_VERSIONS})")
+    prune.add_argument("--max-age-days", type=int, default=HISTORY_MAX_AGE_DAYS,
+                       help=f"drop versions replaced longer ago (default {HISTORY_MAX_AGE_DAYS})")
+
+    import_parser = commands.add_parser("import", help="import credentials from CSV, JSON-lines or an encrypted archive")
+    import_parser.add_argument("file")
+    import_parser.add_argument("--format", choices=("csv", "jsonl", "archive"), help="default: from the file extension")
+
+    export_parser = commands.add_parser("export", help="export credentials to CSV, JSON-lines or an encrypted archive")
+    export_parser.add_argument("file")
+    export_parser.add_argument("--format", choices=("csv", "jsonl", "archive"), help="default: from the file extension")
+
+    rotate = commands.add_parser("rotate", help="change the master password")
+    rotate.add_argument("--new-password-file",
+                        help=f"read the new master password from the first line of this file "
+                             f"(or set ${NEW_MASTER_PASSWORD_ENV}; without either, prompt)")
+
+    migrate_parser = commands.add_parser("migrate", help="apply pending schema and data migrations (resumable)")
+    migrate_parser.add_argument("--dry-run", action="store_true",
+                                help="estimate the time each step needs without changing anything")
+    migrate_parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH_SIZE,
+                                help="rows per backfill transaction")
+    commands.add_parser("pipe", help="run JSON-lines operations from stdin, one result per line on stdout")
+
+    backup_parser = commands.add_parser("backup", help="back up the database and key files (no password needed)")
+    backup_parser.add_argument("directory", help="backup directory; each backup gets a subdirectory")
+    backup_parser.add_argument("--incremental", action="store_true",
+                               help="only copy the rows changed since the newest backup in the directory")
+
+    restore_parser = commands.add_parser("restore", help="rebuild a vault from a backup in a new directory")
+    restore_parser.add_argument("backup", help="a backup subdirectory (incremental ones bring in their base)")
+    restore_parser.add_argument("target", help="directory for the restored vault (must not hold one yet)")
+
+    stats = commands.add_parser("stats", help="summarize a metrics file written with --metrics")
+    stats.add_argument("file", nargs="?", help=f"default: ${METRICS_FILE_ENV}")
+    stats.add_argument("--format", choices=("table", "json", "prometheus"), default="table")
+
+    agent = commands.add_parser("agent", help="unlock once and serve get/list/add requests on a Unix socket")
+    agent.add_argument("--socket", help="socket path (default: $CIMEDDA_AGENT_SOCKET or a private temp directory)")
+    return parser
+
+
+def show_stats(args):
+    path = args.file or os.environ.get(METRICS_FILE_ENV)
+    if not path:
+        print(f"No metrics file given (pass one or set ${METRICS_FILE_ENV}).", file=sys.stderr)
+        return 1
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Cannot read {path} ({e}); stats needs a JSON metrics file.", file=sys.stderr)
+        return 1
+    if args.format == "json":
+        print(metrics.to_json(data))
+    elif args.format == "prometheus":
+        print(metrics.to_prometheus(data), end="")
+    else:
+        print(metrics.format_table(data))
+    return 0
+
+
+def run_backup(args):
+    """backup/restore copy the vault as stored (encrypted), so they run without unlocking."""
+    import backup
+    try:
+        if args.command == "backup":
+            if os.path.exists(default_vault().verify_path):
+                initialize_db(quiet=True)
+            manifest = backup.backup(args.directory, incremental=args.incremental)
+        else:
+            manifest = backup.restore(args.backup, args.target)
+    except (OSError, ValueError, RuntimeError) as e:
+        print(json.dumps({"ok": False, "error": str(e)}))
+        return 1
+    result = {"ok": True, "backup": manifest["name"], "kind": manifest["kind"], "rows": manifest["rows"]}
+    if args.command == "backup":
+        result["changed_rows"] = manifest.get("changed_rows", manifest["rows"])
+        if "reason" in manifest:
+            result["full_backup_because"] = manifest["reason"]
+    else:
+        result["restored_to"] = args.target
+    print(json.dumps(result))
+    return 0
+
+
+def main(argv=None):
+    init(autoreset=True)  # The only colorama init: library modules just use Fore/Style
+    args = build_parser().parse_args(argv)
+    if args.command == "stats":
+        return show_stats(args)
+
+    metrics_file = args.metrics or os.environ.get(METRICS_FILE_ENV)
+    if not metrics_file:
+        return run_command(args)
+    metrics.enable()
+    try:
+        return run_command(args)
+    finally:
+        metrics.dump(metrics_file)
+
+
+def run_command(args):
+    if args.command is None:
+        try:
+            interactive_main()
+        except VaultLocked:
+            # The auto-lock fired in the middle of an operation
+            print(Fore.YELLOW + "Session locked due to inactivity." + Style.RESET_ALL)
+        return 0
+
+    if args.command in ("backup", "restore"):
+        return run_backup(args)
+    if args.command == "prune-history":
+        # Works on the stored (encrypted) versions, so no unlock
+        if not os.path.exists(default_vault().verify_path):
+            print("No master password is set yet. Run 'main.py' once to create the vault.", file=sys.stderr)
+            return 1
+        initialize_db(quiet=True)
+        print(json.dumps({"ok": True, "pruned": prune_history(args.max_versions, args.max_age_days)}))
+        return 0
+    batch_unlock(args)
+
+    if args.command == "add":
+        password_value = args.password if args.password is not None else getpass.getpass("Credential password: ")
+        result = run_operation({"op": "add", "service": args.service, "username": args.username,
+                                "password": password_value, "url": args.url, "notes": args.notes})
+    elif args.command == "get":
+        result = run_operation({"op": "get", "service": args.service,
+                                "fields": [args.field] if args.field else None})
+        if result["ok"] and args.field:
+            print(result["record"][args.field])
+            return 0
+    elif args.command == "update":
+        result = run_operation({"op": "update", "service": args.service, "username": args.username,
+                                "password": args.password, "url": args.url, "notes": args.notes})
+    elif args.command == "delete":
+        result = run_operation({"op": "delete", "service": args.service})
+    elif args.command == "list":
+        for _, service in islice(iter_services(contains=args.contains), args.limit):
+            print(service)
+        return 0
+    elif args.command == "find":
+        result = run_operation({"op": "find", "username": args.username, "host": args.host,
+                                "keyword": args.keyword})
+        if result["ok"]:
+            print("\n".join(result["services"]))
+            return 0
+    elif args.command == "history":
+        if args.restore is not None:
+            result = run_operation({"op": "restore_version", "version": args.restore})
+        else:
+            result = run_operation({"op": "history", "service": args.service, "limit": args.limit,
+                                    "fields": [args.field] if args.field else None})
+    elif args.command in ("import", "export"):
+        import transfer
+        passphrase = None
+        if (args.format or transfer.detect_format(args.file)) == 'archive':
+            passphrase = (os.environ.get(ARCHIVE_PASSPHRASE_ENV) or getpass.getpass("Archive passphrase: ")).encode()
+        run = transfer.import_file if args.command == "import" else transfer.export_file
+        report = run(args.file, args.format, passphrase)
+        result = {"ok": report.error_count == 0, "rows": report.rows, "errors": report.error_count,
+                  "rows_per_second": round(report.rows_per_second, 1),
+                  "error_details": [{"at": at, "error": message} for at, message in report.errors]}
+    elif args.command == "rotate":
+        new_password = read_new_master_password(args)
+        if new_password is None:
+            set_session(change_master_password(get_session()))
+            return 0
+        try:
+            set_session(set_master_password(get_session(), new_password))
+        except RuntimeError as e:
+            # An interrupted change (finish it interactively), or another process changing the password
+            print(json.dumps({"ok": False, "error": str(e)}))
+            return 1
+        result = {"ok": True}
+    elif args.command == "migrate":
+        steps = migrate(keyed_backfills(), args.dry_run, args.batch_size,
+                        progress=lambda message: print(message, file=sys.stderr))
+        result = {"ok": True, "dry_run": args.dry_run,
+                  "steps": [{"step": step, "rows": rows, "seconds": round(seconds, 3)}
+                            for step, rows, seconds in steps]}
+    elif args.command == "agent":
+        from agent import Agent
+        enable_cache()
+        server = Agent(run_operation, lock_session, LOCK_TIMEOUT, args.socket)
+        print(f"Agent listening on {server.socket_path} (locks after {LOCK_TIMEOUT}s of inactivity).", file=sys.stderr)
+        try:
+            server.run()
+        except (PermissionError, RuntimeError) as e:
+            print(f"Agent not started: {e}", file=sys.stderr)
+            return 1
+        return 0
+    else:
+        default_vault().start_autolock(LOCK_TIMEOUT)
+        run_pipe()
+        return 0
+
+    print(json.dumps(result))
+    return 0 if result["ok"] else 1
+# --------------------------------------------------------------------------------
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+# metrics.py
+"""
+Opt-in instrumentation: per-operation timings (count, total, min, max and a
+latency histogram) and plain counters, kept in memory for this process.
+
+Everything is off until enable() is called; while disabled each hook returns
+after a single flag check. Timings use time.perf_counter(), which is
+monotonic. Metric names are fixed strings chosen in the code ("kdf.derive",
+"db.execute", ...): no name, label or value ever contains a service name,
+username, SQL parameter or secret.
+
+    metrics.enable()
+    credentials.get_credential("github")
+    print(metrics.to_prometheus())
+
+Crypto work done in worker processes (CryptoExecutor with use_processes=True)
+is not counted; thread workers are.
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+from functools import wraps
+
+# Histogram bucket upper bounds in seconds; one more bucket catches everything slower
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+PROMETHEUS_PREFIX = "cimedda_"
+
+_enabled = False
+_lock = threading.Lock()
+_timings = {}   # name -> Timing
+_counters = {}  # name -> int
+
+
+class Timing:
+    """Aggregated durations of one operation."""
+
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def as_dict(self):
+        return {"count": self.count, "total_seconds": self.total, "min_seconds": self.min or 0.0,
+                "max_seconds": self.max, "buckets": list(self.buckets)}
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+
+
+def observe(name, seconds):
+    """Record one `seconds`-long occurrence of operation `name`."""
+    if not _enabled:
+        return
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = Timing()
+        timing.add(seconds)
+
+
+def count(name, amount=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+class _Timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name):
+    """Context manager that records the duration of its block as `name`."""
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def timed(name):
+    """Decorator that records the duration of every call as `name` (not for generators)."""
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+# --------------------------------------------------------------------------------
+# Reporting
+# --------------------------------------------------------------------------------
+def snapshot():
+    """A JSON-able copy of everything recorded so far."""
+    with _lock:
+        return {
+            "enabled": _enabled,
+            "bucket_bounds": list(BUCKETS),
+            "timings": {name: timing.as_dict() for name, timing in sorted(_timings.items())},
+            "counters": dict(sorted(_counters.items())),
+        }
+
+
+def approximate_percentile(timing, fraction):
+    """Upper bound of the histogram bucket holding the `fraction` quantile (the max for the last bucket)."""
+    target = fraction * timing["count"]
+    seen = 0
+    for bound, bucket_count in zip(BUCKETS, timing["buckets"]):
+        seen += bucket_count
+        if bucket_count and seen >= target:
+            return min(bound, timing["max_seconds"])
+    return timing["max_seconds"]
+
+
+def to_json(data=None):
+    return json.dumps(data or snapshot(), indent=2)
+
+
+def _metric_name(name):
+    return PROMETHEUS_PREFIX + name.replace(".", "_")
+
+
+def to_prometheus(data=None):
+    """Prometheus text exposition format: one histogram per timing, one counter per count."""
+    data = data or snapshot()
+    lines = []
+    for name, timing in data["timings"].items():
+        metric = _metric_name(name) + "_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(data["bucket_bounds"], timing["buckets"]):
+            cumulative += bucket_count
+            lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_bucket{{le="+Inf"}} {timing["count"]}')
+        lines.append(f"{metric}_sum {timing['total_seconds']}")
+        lines.append(f"{metric}_count {timing['count']}")
+    for name, value in data["counters"].items():
+        metric = _metric_name(name) + "_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def format_table(data=None):
+    """Human-readable summary, as printed by `main.py stats`."""
+    data = data or snapshot()
+    lines = [f"{'operation':<28} {'count':>9} {'total s':>10} {'mean ms':>10} {'~p95 ms':>10} {'max ms':>10}"]
+    for name, timing in data["timings"].items():
+        mean = timing["total_seconds"] / timing["count"] if timing["count"] else 0.0
+        lines.append(f"{name:<28} {timing['count']:>9} {timing['total_seconds']:>10.3f} {mean * 1000:>10.3f} "
+                     f"{approximate_percentile(timing, 0.95) * 1000:>10.3f} {timing['max_seconds'] * 1000:>10.3f}")
+    if data["counters"]:
+        lines.append("")
+        lines.append(f"{'counter':<28} {'value':>9}")
+        for name, value in data["counters"].items():
+            lines.append(f"{name:<28} {value:>9}")
+    return "\n".join(lines)
+
+
+def dump(path):
+    """Write the current metrics to `path`: Prometheus text for .prom/.txt files, JSON otherwise."""
+    text = to_prometheus() if path.endswith((".prom", ".txt")) else to_json()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
@@ -0,0 +1,291 @@
+# search.py
+
+import hashlib
+import hmac
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+
+SEARCH_LIMIT = 20         # Default number of results returned by a search
+FUZZY_CANDIDATES = 50     # Names sharing the most trigrams with the query that get a closer look
+FUZZY_THRESHOLD = 0.6     # Minimum similarity ratio for typo-tolerant matches
+
+# Rank of each kind of match (lower is better)
+EXACT, PREFIX, SUBSTRING, FUZZY = range(4)
+
+# Encrypted token index (see TokenHasher)
+TOKEN_LENGTH = 16             # Bytes of HMAC-SHA256 kept per token
+NOTE_KEYWORD_MIN_LENGTH = 3   # Shorter words in notes are not indexed
+NOTE_KEYWORDS_MAX = 64        # Distinct note keywords indexed per record
+USERNAME, HOST, KEYWORD = "username", "host", "keyword"
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _padded_trigrams(text):
+    # Padding lets short names and word boundaries take part in fuzzy matching
+    return _trigrams(f"  {text} ")
+
+
+class ServiceIndex:
+    """
+    In-memory search index over service names.
+
+    Keeps a sorted list of lower-cased names for prefix lookups and a trigram
+    posting list for substring and typo-tolerant matching. Entries are added and
+    removed incrementally, so the index never has to be rebuilt after a write.
+    """
+
+    def __init__(self, services=()):
+        self._names = {}                    # id -> service name
+        self._sorted = []                   # sorted (lower-cased name, id)
+        self._postings = defaultdict(set)   # padded trigram -> ids
+        self._lock = threading.Lock()
+
+        # Initial load: fill everything first and sort once instead of insort per entry
+        for service_id, service in services:
+            lowered = service.lower()
+            self._names[service_id] = service
+            self._sorted.append((lowered, service_id))
+            for gram in _padded_trigrams(lowered):
+                self._postings[gram].add(service_id)
+        self._sorted.sort()
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, service_id, service):
+        with self._lock:
+            if service_id in self._names:
+                self._remove_id(service_id)
+            lowered = service.lower()
+            self._names[service_id] = service
+            insort(self._sorted, (lowered, service_id))
+            for gram in _padded_trigrams(lowered):
+                self._postings[gram].add(service_id)
+
+    def remove(self, service_id):
+        with self._lock:
+            self._remove_id(service_id)
+
+    def remove_service(self, service):
+        """Remove every entry with the given service name."""
+        lowered = service.lower()
+        with self._lock:
+            start = bisect_left(self._sorted, (lowered, float('-inf')))
+            ids = []
+            for name, service_id in self._sorted[start:]:
+                if name != lowered:
+                    break
+                if self._names[service_id] == service:
+                    ids.append(service_id)
+            for service_id in ids:
+                self._remove_id(service_id)
+
+    def _remove_id(self, service_id):
+        service = self._names.pop(service_id, None)
+        if service is None:
+            return
+        lowered = service.lower()
+        position = bisect_left(self._sorted, (lowered, service_id))
+        del self._sorted[position]
+        for gram in _padded_trigrams(lowered):
+            postings = self._postings[gram]
+            postings.discard(service_id)
+            if not postings:
+                del self._postings[gram]
+
+    def search(self, query, limit=SEARCH_LIMIT, fuzzy=True):
+        """
+        Return up to `limit` (id, service) pairs matching `query`, best first:
+        exact matches, then prefix, then substring, then (optionally) names
+        within typo distance ranked by similarity.
+        """
+        query = query.strip().lower()
+        if not query or limit <= 0:
+            return []
+
+        with self._lock:
+            ranked = {}
+
+            # Exact and prefix matches come straight from the sorted list
+            start = bisect_left(self._sorted, (query, float('-inf')))
+            for name, service_id in self._sorted[start:]:
+                if not name.startswith(query):
+                    break
+                ranked[service_id] = (EXACT if name == query else PREFIX, 0.0, name)
+                if len(ranked) >= limit:
+                    break
+
+            if len(ranked) < limit:
+                for service_id in self._substring_candidates(query):
+                    if service_id in ranked:
+                        continue
+                    name = self._names[service_id].lower()
+                    position = name.find(query)
+                    if position >= 0:
+                        ranked[service_id] = (SUBSTRING, position, name)
+
+            if fuzzy and len(ranked) < limit:
+                for service_id, score in self._fuzzy_candidates(query):
+                    if service_id not in ranked:
+                        ranked[service_id] = (FUZZY, -score, self._names[service_id].lower())
+
+            best = sorted(ranked.items(), key=lambda item: item[1])[:limit]
+            return [(service_id, self._names[service_id]) for service_id, _ in best]
+
+    def _substring_candidates(self, query):
+        grams = _trigrams(query)
+        if not grams:
+            # Too short for trigrams: every name is a candidate
+            return list(self._names)
+        postings = sorted((self._postings.get(gram, set()) for gram in grams), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates &= posting
+            if not candidates:
+                break
+        return candidates
+
+    def _fuzzy_candidates(self, query):
+        from difflib import SequenceMatcher
+
+        # Trigram overlap narrows the field cheaply; the edit-based ratio then
+        # copes with transpositions that break most trigrams ("gihtub")
+        shared = Counter()
+        for gram in _padded_trigrams(query):
+            shared.update(self._postings.get(gram, ()))
+        for service_id, _ in shared.most_common(FUZZY_CANDIDATES):
+            score = SequenceMatcher(None, query, self._names[service_id].lower()).ratio()
+            if score >= FUZZY_THRESHOLD:
+                yield service_id, score
+
+
+# --------------------------------------------------------------------------------
+# Encrypted token index over usernames, URL hosts and note keywords
+# --------------------------------------------------------------------------------
+_WORD = re.compile(r"\w+")
+
+
+def normalize_username(username):
+    return username.strip().lower()
+
+
+def url_hosts(url):
+    """
+    The host of `url` and its parent domains, without "www." and the bare TLD:
+    "https://www.mail.example.com/x" -> ["mail.example.com", "example.com"].
+    """
+    from ipaddress import ip_address  # Deferred (with urllib.parse): not needed to start up
+    from urllib.parse import urlsplit
+
+    url = url.strip().lower()
+    if not url:
+        return []
+    if "//" not in url:
+        url = "//" + url  # Bare "example.com/login"
+    try:
+        host = urlsplit(url).hostname or ""
+    except ValueError:
+        return []
+    if host.startswith("www."):
+        host = host[4:]
+    try:
+        ip_address(host)
+        return [host]
+    except ValueError:
+        pass
+    labels = host.split(".")
+    if len(labels) == 1:
+        return [host] if host else []  # "localhost"
+    return [".".join(labels[i:]) for i in range(len(labels) - 1)]
+
+
+def note_keywords(notes):
+    keywords = []
+    seen = set()
+    for word in _WORD.findall(notes.lower()):
+        if len(word) >= NOTE_KEYWORD_MIN_LENGTH and word not in seen:
+            seen.add(word)
+            keywords.append(word)
+            if len(keywords) >= NOTE_KEYWORDS_MAX:
+                break
+    return keywords
+
+
+def record_terms(username, url, notes):
+    """(kind, term) pairs indexed for one record."""
+    terms = set()
+    username = normalize_username(username or "")
+    if username:
+        terms.add((USERNAME, username))
+    terms.update((HOST, host) for host in url_hosts(url or ""))
+    terms.update((KEYWORD, word) for word in note_keywords(notes or ""))
+    return terms
+
+
+class TokenHasher:
+    """
+    Turns search terms into keyed hashes (truncated HMAC-SHA256 under a subkey
+    of the vault key), so the search_tokens table can be queried for equality
+    without storing any username, host or note word in the clear. Equal terms
+    give equal tokens: the database does reveal which records share a term.
+    """
+
+    def __init__(self, key: bytes):
+        token_key = hmac.new(key[:32], b"CimeddaManager search tokens v1", hashlib.sha256).digest()
+        # Keyed once; token() copies the prepared state instead of re-keying per term
+        self._mac = hmac.new(token_key, digestmod=hashlib.sha256)
+
+    def token(self, kind, term) -> bytes:
+        mac = self._mac.copy()
+        mac.update(f"{kind}\0{term}".encode())
+        return mac.digest()[:TOKEN_LENGTH]
+
+    def record_tokens(self, fields) -> set:
+        """Tokens for a record's (username, password, url, notes); the password is never indexed."""
+        username, _, url, notes = fields
+        return {self.token(kind, term) for kind, term in record_terms(username, url, notes)}
+
+    def query_tokens(self, username=None, host=None, keyword=None) -> list:
+        """
+        Tokens a record must all have to match. Raises ValueError for a criterion
+        that can't match anything (e.g. a keyword shorter than NOTE_KEYWORD_MIN_LENGTH).
+        """
+        tokens = []
+        if username is not None:
+            if not normalize_username(username):
+                raise ValueError("Empty username.")
+            tokens.append(self.token(USERNAME, normalize_username(username)))
+        if host is not None:
+            hosts = url_hosts(host)
+            if not hosts:
+                raise ValueError(f"Not a host name: {host!r}")
+            tokens.append(self.token(HOST, hosts[0]))
+        if keyword is not None:
+            words = note_keywords(keyword)
+            if not words:
+                raise ValueError(f"Keywords need at least {NOTE_KEYWORD_MIN_LENGTH} characters.")
+            tokens.extend(self.token(KEYWORD, word) for word in words)
+        return tokens
+
+
+_INSERT_TOKEN_SQL = "INSERT OR IGNORE INTO search_tokens (token, credential_id) VALUES (?, ?)"
+
+
+def store_record_tokens(conn, hasher, rows, replace=True):
+    """
+    Write the search tokens of each (row id, (username, password, url, notes)) in
+    `rows` inside the caller's transaction. Unless `replace` is False (new rows,
+    inserted with search_indexed = 1), the row's old tokens are dropped first
+    and the row is marked as indexed.
+    """
+    rows = list(rows)
+    if replace:
+        conn.executemany("DELETE FROM search_tokens WHERE credential_id = ?", ((row_id,) for row_id, _ in rows))
+        conn.executemany("UPDATE credentials SET search_indexed = 1 WHERE id = ?", ((row_id,) for row_id, _ in rows))
+    conn.executemany(_INSERT_TOKEN_SQL,
+                     ((token, row_id) for row_id, fields in rows for token in hasher.record_tokens(fields)))
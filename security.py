@@ -1,158 +1,511 @@
-# security.py
-
-import os
-import sys
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.backends import default_backend
-from cryptography.fernet import Fernet, InvalidToken
-import base64
-from colorama import init, Fore, Style
-import getpass
-from db_setup import get_db_connection
-
-
-VERIFICATION_TOKEN = b"This is a verification token."
-MAX_ATTEMPTS = 3  # Maximum allowed attempts for entering the correct password
-
-# Initialize Colorama
-init(autoreset=True)
-
-def derive_key(password: bytes, salt: bytes, iterations: int = 100000) -> bytes:
-    kdf_func = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=salt,
-        iterations=iterations,
-        backend=default_backend()
-    )
-    key = kdf_func.derive(password)
-    return key
-
-def load_or_create_salt(salt_path='salt.bin') -> bytes:
-    if os.path.exists(salt_path):
-        with open(salt_path, 'rb') as f:
-            return f.read()
-    else:
-        new_salt = os.urandom(16)
-        with open(salt_path, 'wb') as f:
-            f.write(new_salt)
-        return new_salt
-
-def store_verification(cipher: Fernet, verify_path='verify.bin'):
-    token_encrypted = cipher.encrypt(VERIFICATION_TOKEN)
-    with open(verify_path, 'wb') as f:
-        f.write(token_encrypted)
-
-def verify_master_password(key: bytes, verify_path='verify.bin') -> bool:
-    fernet_key = base64.urlsafe_b64encode(key[:32])
-    cipher = Fernet(fernet_key)
-    try:
-        with open(verify_path, 'rb') as f:
-            encrypted_token = f.read()
-        decrypted_token = cipher.decrypt(encrypted_token)
-        return decrypted_token == VERIFICATION_TOKEN
-    except (InvalidToken, FileNotFoundError):
-        return False
-
-
-
-
-def get_master_key():
-    salt = load_or_create_salt()
-
-    # First execution: set master password
-    if not os.path.exists('verify.bin'):
-        print(Fore.RED + "No master password set. Please create one."+ Style.RESET_ALL)
-        while True:
-            # Flush prints to ensure they appear before prompt
-            master_password = getpass.getpass(Fore.YELLOW + "Create a master password: "+ Style.RESET_ALL).encode()
-            confirm_password = getpass.getpass(Fore.YELLOW + "Confirm master password: "+ Style.RESET_ALL).encode()
-            if master_password == confirm_password:
-                key = derive_key(master_password, salt)
-                fernet_key = base64.urlsafe_b64encode(key[:32])
-                cipher = Fernet(fernet_key)
-                store_verification(cipher)
-                print(Fore.GREEN + "Master password set and verification token created."+ Style.RESET_ALL)
-                return key
-            else:
-                print(Fore.RED + "Passwords do not match. Please try again."+ Style.RESET_ALL)
-
-    # Subsequent executions: verify master password with limited attempts
-    attempts = 0
-    while attempts < MAX_ATTEMPTS:
-        sys.stdout.flush()
-        master_password = getpass.getpass(Fore.YELLOW + "Enter your master password: "+ Style.RESET_ALL).encode()
-        key = derive_key(master_password, salt)
-        if verify_master_password(key):
-            print(Fore.GREEN + "Master password verified."+ Style.RESET_ALL)
-            return key
-        else:
-            attempts += 1
-            print(Fore.RED + f"Incorrect master password. Attempts remaining: {MAX_ATTEMPTS - attempts}"+ Style.RESET_ALL)
-
-    print(Fore.RED + "Maximum password attempts exceeded. Access blocked."+ Style.RESET_ALL)
-    exit(1)
-
-
-def change_master_password(cipher):
-    print(Fore.YELLOW + "You are about to change the master password." + Style.RESET_ALL)
-
-    # Verify current master password
-    current_key = get_master_key()  # Initializes and validates the current master password
-
-    # Prompt for the new master password
-    while True:
-        new_password = getpass.getpass(Fore.YELLOW + "Enter new master password: " + Style.RESET_ALL).encode()
-        confirm_password = getpass.getpass(Fore.YELLOW + "Confirm new master password: " + Style.RESET_ALL).encode()
-
-        if new_password != confirm_password:
-            print(Fore.RED + "Passwords do not match. Try again." + Style.RESET_ALL)
-            continue
-
-        break
-
-    # Derive new key
-    salt = load_or_create_salt()  # Use the same salt
-    new_key = derive_key(new_password, salt)
-
-    # Create a new cipher with the new key
-    new_fernet_key = base64.urlsafe_b64encode(new_key[:32])
-    new_cipher = Fernet(new_fernet_key)
-
-    # Re-encrypt all database credentials
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, username, password, url, notes FROM credentials")
-    rows = cursor.fetchall()
-
-    for row in rows:
-        record_id = row[0]
-
-        # Decrypt using the old cipher
-        username = cipher.decrypt(row[1]).decode() if row[1] else ""
-        password = cipher.decrypt(row[2]).decode()
-        url = cipher.decrypt(row[3]).decode() if row[3] else ""
-        notes = cipher.decrypt(row[4]).decode() if row[4] else ""
-
-        # Re-encrypt with the new cipher
-        new_encrypted_username = new_cipher.encrypt(username.encode()) if username else b""
-        new_encrypted_password = new_cipher.encrypt(password.encode())
-        new_encrypted_url = new_cipher.encrypt(url.encode()) if url else b""
-        new_encrypted_notes = new_cipher.encrypt(notes.encode()) if notes else b""
-
-        # Update the database
-        cursor.execute('''
-            UPDATE credentials
-            SET username = ?, password = ?, url = ?, notes = ?
-            WHERE id = ?
-        ''', (new_encrypted_username, new_encrypted_password, new_encrypted_url, new_encrypted_notes, record_id))
-
-    conn.commit()
-    conn.close()
-
-    # Update the verification token with the new cipher
-    store_verification(new_cipher)
-    print(Fore.GREEN + "Master password changed successfully!" + Style.RESET_ALL)
-
-    return new_key
\ No newline at end of file
+# security.py
+
+import os
+import sys
+import hashlib
+import hmac
+import json
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.backends import default_backend
+from cryptography.fernet import Fernet, InvalidToken
+import base64
+from colorama import Fore, Style
+import getpass
+import time
+import metrics
+from db_setup import KeyVersionChanged, RotationInProgress, begin_write, pooled_connection
+from crypto_executor import DECRYPTION_FAILED, CryptoExecutor, cipher_from_key
+from envelope import HISTORY_STORED_COLUMNS, STORED_COLUMNS
+from search import TokenHasher, store_record_tokens
+
+try:
+    from cryptography.hazmat.primitives.kdf.argon2 import Argon2id
+except ImportError:  # cryptography < 44
+    Argon2id = None
+
+
+VERIFICATION_TOKEN = b"This is a verification token."
+MAX_ATTEMPTS = 3  # Maximum allowed attempts for entering the correct password
+ROTATION_CHUNK_SIZE = 1000  # Credentials re-encrypted and committed per batch when changing the master password
+
+# Key derivation settings
+KDF_PARAMS_PATH = 'kdf.json'   # Stored next to salt.bin
+KDF_ALGORITHM = 'scrypt'       # Used when calibrating new vaults: pbkdf2-sha256, scrypt or argon2id
+KDF_TARGET_SECONDS = 0.5       # Unlock latency calibration aims for on this host
+LEGACY_KDF_PARAMS = {"algorithm": "pbkdf2-sha256", "iterations": 100000}  # Vaults created before kdf.json
+
+@metrics.timed("kdf.derive")
+def derive_key(password: bytes, salt: bytes, iterations: int = 100000, params: dict = None) -> bytes:
+    params = params or {"algorithm": "pbkdf2-sha256", "iterations": iterations}
+    algorithm = params["algorithm"]
+
+    if algorithm == "pbkdf2-sha256":
+        kdf_func = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            iterations=params["iterations"],
+            backend=default_backend()
+        )
+    elif algorithm == "scrypt":
+        kdf_func = Scrypt(salt=salt, length=32, n=params["n"], r=params["r"], p=params["p"])
+    elif algorithm == "argon2id" and Argon2id is not None:
+        kdf_func = Argon2id(
+            salt=salt,
+            length=32,
+            iterations=params["iterations"],
+            lanes=params["lanes"],
+            memory_cost=params["memory_cost"],  # KiB
+        )
+    else:
+        raise ValueError(f"Unsupported key derivation algorithm: {algorithm}")
+
+    key = kdf_func.derive(password)
+    return key
+
+@metrics.timed("kdf.calibrate")
+def calibrate_kdf(target_seconds: float = KDF_TARGET_SECONDS, algorithm: str = KDF_ALGORITHM) -> dict:
+    """
+    Pick KDF parameters whose derivation takes roughly `target_seconds` on this
+    host, never weaker than the legacy 100,000 PBKDF2 iterations.
+    """
+    probe_salt = os.urandom(16)
+
+    def timed(params):
+        start = time.perf_counter()
+        derive_key(b"calibration", probe_salt, params=params)
+        return time.perf_counter() - start
+
+    if algorithm == "pbkdf2-sha256":
+        probe = {"algorithm": algorithm, "iterations": 20000}
+        iterations = int(probe["iterations"] * target_seconds / timed(probe))
+        return {"algorithm": algorithm, "iterations": max(LEGACY_KDF_PARAMS["iterations"], iterations // 1000 * 1000)}
+
+    if algorithm == "scrypt":
+        # Memory cost grows with n (128 * r * n bytes); double it until the target is reached
+        params = {"algorithm": algorithm, "n": 2 ** 14, "r": 8, "p": 1}
+        while params["n"] < 2 ** 20 and timed(params) < target_seconds / 2:
+            params["n"] *= 2
+        return params
+
+    if algorithm == "argon2id" and Argon2id is not None:
+        params = {"algorithm": algorithm, "iterations": 3, "lanes": 4, "memory_cost": 32 * 1024}
+        while params["memory_cost"] < 1024 * 1024 and timed(params) < target_seconds / 2:
+            params["memory_cost"] *= 2
+        return params
+
+    raise ValueError(f"Unsupported key derivation algorithm: {algorithm}")
+
+def load_kdf_config(path=KDF_PARAMS_PATH) -> dict:
+    """
+    Return {"current": params, "pending": params or None}. "pending" holds the
+    parameters of a master password change that has not been completed yet.
+    """
+    if not os.path.exists(path):
+        return {"current": dict(LEGACY_KDF_PARAMS), "pending": None}
+    with open(path, 'r') as f:
+        config = json.load(f)
+    config.setdefault("pending", None)
+    return config
+
+def store_kdf_config(current: dict, pending: dict = None, path=KDF_PARAMS_PATH):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({"current": current, "pending": pending}, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class KeySession:
+    """
+    Handle to an unlocked master key. Keeps the derived key, its KDF parameters
+    and an in-memory password verifier, so the session can re-check the master
+    password (e.g. before a password change) without running the KDF again.
+    The verifier is keyed with a random per-session secret and never persisted.
+    """
+
+    def __init__(self, key: bytes, salt: bytes, params: dict, password: bytes):
+        self.key = key
+        self.salt = salt
+        self.params = params
+        self.cipher = cipher_from_key(key)
+        self._verifier_secret = os.urandom(32)
+        self._verifier = hmac.new(self._verifier_secret, password, hashlib.sha256).digest()
+
+    def verify_password(self, password: bytes) -> bool:
+        candidate = hmac.new(self._verifier_secret, password, hashlib.sha256).digest()
+        return hmac.compare_digest(candidate, self._verifier)
+
+    def wipe(self):
+        self.key = None
+        self.cipher = None
+        self._verifier_secret = None
+        self._verifier = None
+
+def load_or_create_salt(salt_path='salt.bin') -> bytes:
+    if os.path.exists(salt_path):
+        with open(salt_path, 'rb') as f:
+            return f.read()
+    else:
+        new_salt = os.urandom(16)
+        with open(salt_path, 'wb') as f:
+            f.write(new_salt)
+        return new_salt
+
+def store_verification(cipher: Fernet, verify_path='verify.bin'):
+    token_encrypted = cipher.encrypt(VERIFICATION_TOKEN)
+    # Write to a temporary file and swap it in so the token is never half-written
+    tmp_path = verify_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(token_encrypted)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, verify_path)
+
+@metrics.timed("kdf.verify")
+def verify_master_password(key: bytes, verify_path='verify.bin') -> bool:
+    fernet_key = base64.urlsafe_b64encode(key[:32])
+    cipher = Fernet(fernet_key)
+    try:
+        with open(verify_path, 'rb') as f:
+            encrypted_token = f.read()
+        decrypted_token = cipher.decrypt(encrypted_token)
+        return decrypted_token == VERIFICATION_TOKEN
+    except (InvalidToken, FileNotFoundError):
+        return False
+
+
+
+
+def _vault_paths(vault):
+    """(salt, verification token, KDF parameters) paths of `vault`; the default vault's files live in the working directory."""
+    if vault is None:
+        return 'salt.bin', 'verify.bin', KDF_PARAMS_PATH
+    return vault.salt_path, vault.verify_path, vault.kdf_path
+
+
+def _connection(vault):
+    return pooled_connection() if vault is None else vault.connection()
+
+
+def create_master_password(master_password: bytes, vault=None) -> KeySession:
+    """Set the master password of a vault that has none yet (calibrates the KDF) and return its session."""
+    salt_path, verify_path, kdf_path = _vault_paths(vault)
+    if os.path.exists(verify_path):
+        raise FileExistsError(f"A master password is already set ({verify_path}).")
+    salt = load_or_create_salt(salt_path)
+    params = calibrate_kdf()
+    key = derive_key(master_password, salt, params=params)
+    store_kdf_config(params, path=kdf_path)
+    store_verification(cipher_from_key(key), verify_path)
+    return KeySession(key, salt, params, master_password)
+
+
+def unlock_session(vault=None) -> KeySession:
+    salt_path, verify_path, kdf_path = _vault_paths(vault)
+    salt = load_or_create_salt(salt_path)
+    kdf_config = load_kdf_config(kdf_path)
+
+    # First execution: set master password
+    if not os.path.exists(verify_path):
+        print(Fore.RED + "No master password set. Please create one."+ Style.RESET_ALL)
+        while True:
+            # Flush prints to ensure they appear before prompt
+            master_password = getpass.getpass(Fore.YELLOW + "Create a master password: "+ Style.RESET_ALL).encode()
+            confirm_password = getpass.getpass(Fore.YELLOW + "Confirm master password: "+ Style.RESET_ALL).encode()
+            if master_password == confirm_password:
+                session = create_master_password(master_password, vault)
+                print(Fore.GREEN + "Master password set and verification token created."+ Style.RESET_ALL)
+                return session
+            else:
+                print(Fore.RED + "Passwords do not match. Please try again."+ Style.RESET_ALL)
+
+    # Subsequent executions: verify master password with limited attempts
+    attempts = 0
+    while attempts < MAX_ATTEMPTS:
+        sys.stdout.flush()
+        master_password = getpass.getpass(Fore.YELLOW + "Enter your master password: "+ Style.RESET_ALL).encode()
+        session = _open_session(master_password, salt, kdf_config, vault)
+        if session is not None:
+            print(Fore.GREEN + "Master password verified."+ Style.RESET_ALL)
+            return session
+        else:
+            attempts += 1
+            print(Fore.RED + f"Incorrect master password. Attempts remaining: {MAX_ATTEMPTS - attempts}"+ Style.RESET_ALL)
+
+    print(Fore.RED + "Maximum password attempts exceeded. Access blocked."+ Style.RESET_ALL)
+    exit(1)
+
+
+def _open_session(master_password: bytes, salt: bytes, kdf_config: dict, vault=None):
+    _, verify_path, kdf_path = _vault_paths(vault)
+    params = kdf_config["current"]
+    key = derive_key(master_password, salt, params=params)
+    verified = verify_master_password(key, verify_path)
+
+    # A password change may have replaced verify.bin but not yet kdf.json
+    if not verified and kdf_config["pending"]:
+        params = kdf_config["pending"]
+        key = derive_key(master_password, salt, params=params)
+        verified = verify_master_password(key, verify_path)
+        if verified:
+            store_kdf_config(params, path=kdf_path)
+
+    return KeySession(key, salt, params, master_password) if verified else None
+
+
+def open_session(master_password: bytes, vault=None):
+    """
+    Non-interactive unlock for scripts and services: no prompts, no output.
+    Returns None if no master password is set yet or the password is wrong.
+    """
+    salt_path, verify_path, kdf_path = _vault_paths(vault)
+    if not os.path.exists(verify_path):
+        return None
+    return _open_session(master_password, load_or_create_salt(salt_path), load_kdf_config(kdf_path), vault)
+
+
+def get_master_key():
+    return unlock_session().key
+
+
+def get_rotation_state(vault=None):
+    """Return (key_version, target_version, last_id, pending_verification) from the key_rotation table."""
+    with _connection(vault) as conn:
+        return conn.execute(
+            "SELECT key_version, target_version, last_id, pending_verification FROM key_rotation WHERE id = 1"
+        ).fetchone()
+
+
+def rotation_in_progress(vault=None) -> bool:
+    state = get_rotation_state(vault)
+    return state is not None and state[1] is not None
+
+
+def _prompt_new_master_password(salt, params, pending_verification=None):
+    """Prompt for the new master password. When resuming, it must match the pending verification token."""
+    while True:
+        new_password = getpass.getpass(Fore.YELLOW + "Enter new master password: " + Style.RESET_ALL).encode()
+        confirm_password = getpass.getpass(Fore.YELLOW + "Confirm new master password: " + Style.RESET_ALL).encode()
+
+        if new_password != confirm_password:
+            print(Fore.RED + "Passwords do not match. Try again." + Style.RESET_ALL)
+            continue
+
+        new_key = derive_key(new_password, salt, params=params)
+        if pending_verification is not None and not matches_verification(new_key, pending_verification):
+            print(Fore.RED + "This is not the new master password of the interrupted change. Try again." + Style.RESET_ALL)
+            continue
+        return new_key, new_password
+
+
+def matches_verification(key, token) -> bool:
+    """Whether `key` decrypts a verification `token` (verify.bin's contents or a pending one)."""
+    try:
+        return cipher_from_key(key).decrypt(token) == VERIFICATION_TOKEN
+    except InvalidToken:
+        return False
+
+
+def _confirm_current_password(session: KeySession) -> bool:
+    """Re-check the current master password against the unlocked session (no key derivation)."""
+    for attempt in range(MAX_ATTEMPTS):
+        password = getpass.getpass(Fore.YELLOW + "Enter your current master password: " + Style.RESET_ALL).encode()
+        if session.verify_password(password):
+            return True
+        print(Fore.RED + f"Incorrect master password. Attempts remaining: {MAX_ATTEMPTS - attempt - 1}" + Style.RESET_ALL)
+    return False
+
+
+@metrics.timed("rotation.run")
+def rotate_credentials(current_key, new_key, target_version, start_after=0, chunk_size=ROTATION_CHUNK_SIZE,
+                       vault=None):
+    """
+    Re-encrypt every credential not yet at `target_version` (and rebuild its
+    search tokens under the new key), streaming them in id order. Each chunk is decrypted/re-encrypted in parallel and committed together
+    with the checkpoint, so an interrupted run resumes from the last committed chunk.
+    The history versions are re-encrypted the same way afterwards.
+    Returns (credentials re-encrypted, elapsed seconds).
+    """
+    processed = 0
+    last_id = start_after
+    started = time.perf_counter()
+    new_tokens = TokenHasher(new_key)
+
+    with _connection(vault) as conn, \
+            CryptoExecutor(current_key) as old_crypto, CryptoExecutor(new_key) as new_crypto:
+        cursor = conn.cursor()
+        while True:
+            # Each chunk is read and re-encrypted under the write lock (other writers wait for the whole change)
+            begin_write(conn)
+            cursor.execute(f'''
+                SELECT {STORED_COLUMNS}
+                FROM credentials
+                WHERE id > ? AND key_version <> ?
+                ORDER BY id
+                LIMIT ?
+            ''', (last_id, target_version, chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                conn.rollback()
+                break
+
+            # Decrypt using the old key (strict: never re-encrypt a failed field) and re-seal with the
+            # new one; legacy per-field rows come out as envelopes
+            decrypted = list(old_crypto.open_rows(rows, strict=True))
+            resealed = new_crypto.seal_rows(decrypted)
+
+            cursor.executemany('''
+                UPDATE credentials
+                SET envelope = ?, record_format = 2, username = NULL, password = X'', url = NULL, notes = NULL,
+                    key_version = ?, search_indexed = 1
+                WHERE id = ?
+            ''', ((row[2], target_version, row[0]) for row in resealed))
+            # Search tokens are keyed too: rebuild them under the new key
+            store_record_tokens(conn, new_tokens, ((row[0], row[2:6]) for row in decrypted))
+
+            last_id = rows[-1][0]
+            cursor.execute("UPDATE key_rotation SET last_id = ? WHERE id = 1", (last_id,))
+            conn.commit()
+            processed += len(rows)
+            metrics.count("rotation.rows", len(rows))
+
+        # History needs no checkpoint: a resumed run finds the versions left by their key_version
+        last_version = 0
+        while True:
+            begin_write(conn)
+            cursor.execute(f'''
+                SELECT {HISTORY_STORED_COLUMNS}, id
+                FROM credential_history
+                WHERE id > ? AND key_version <> ?
+                ORDER BY id
+                LIMIT ?
+            ''', (last_version, target_version, chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                conn.rollback()
+                break
+
+            # A version that no longer decrypts could not be restored anyway: drop it rather than
+            # block the password change
+            opened = [row for row in old_crypto.open_rows(rows) if DECRYPTION_FAILED not in row[2:6]]
+            cursor.executemany('''
+                UPDATE credential_history
+                SET envelope = ?, record_format = 2, username = NULL, password = X'', url = NULL, notes = NULL,
+                    key_version = ?
+                WHERE id = ?
+            ''', ((row[2], target_version, row[3]) for row in new_crypto.seal_rows(opened)))
+            failed = {row[8] for row in rows} - {row[6] for row in opened}
+            cursor.executemany("DELETE FROM credential_history WHERE id = ?", ((version,) for version in failed))
+            conn.commit()
+            last_version = rows[-1][8]
+            metrics.count("rotation.history_rows", len(rows))
+
+    return processed, time.perf_counter() - started
+
+
+def change_master_password(session: KeySession, vault=None) -> KeySession:
+    print(Fore.YELLOW + "You are about to change the master password." + Style.RESET_ALL)
+
+    _, _, kdf_path = _vault_paths(vault)
+    _, target_version, _, pending_verification = get_rotation_state(vault)
+    resuming = target_version is not None
+    if resuming:
+        print(Fore.YELLOW + "Resuming an interrupted master password change. "
+                            "Enter the current password, then the new one you chose before." + Style.RESET_ALL)
+
+    # Verify current master password against the unlocked session
+    if not _confirm_current_password(session):
+        print(Fore.RED + "Master password not changed." + Style.RESET_ALL)
+        return session
+    current_key = session.key
+
+    kdf_config = load_kdf_config(kdf_path)
+    if resuming and matches_verification(current_key, pending_verification):
+        # verify.bin was already switched over; only the bookkeeping is left
+        new_key, new_params, new_password = current_key, session.params, None
+    else:
+        # New passwords get freshly calibrated KDF parameters, kept as "pending" until the change completes
+        if resuming:
+            # Rotations started before kdf.json existed derived the new key with the current parameters
+            new_params = kdf_config["pending"] or kdf_config["current"]
+        else:
+            new_params = calibrate_kdf()
+        new_key, new_password = _prompt_new_master_password(
+            session.salt, new_params, pending_verification if resuming else None)
+    return _switch_master_key(session, new_key, new_params, new_password, vault)
+
+
+def set_master_password(session: KeySession, new_password: bytes, vault=None) -> KeySession:
+    """
+    Non-interactive change_master_password() for scripts and benchmarks: the caller
+    has already authenticated `session`. Refuses to run while an interrupted change
+    is pending (that one has to be finished with the same new password).
+    """
+    if rotation_in_progress(vault):
+        raise RuntimeError("A master password change is in progress; finish it with change_master_password().")
+    new_params = calibrate_kdf()
+    new_key = derive_key(new_password, session.salt, params=new_params)
+    return _switch_master_key(session, new_key, new_params, new_password, vault, quiet=True)
+
+
+def _switch_master_key(session, new_key, new_params, new_password, vault=None, quiet=False) -> KeySession:
+    current_key = session.key
+    _, verify_path, kdf_path = _vault_paths(vault)
+    key_version, target_version, last_id, _ = get_rotation_state(vault)
+    resuming = target_version is not None
+    kdf_config = load_kdf_config(kdf_path)
+    new_cipher = cipher_from_key(new_key)
+
+    # Record the rotation before touching any row so a crash can be resumed
+    if not resuming:
+        target_version = key_version + 1
+        last_id = 0
+        with _connection(vault) as conn:
+            # Holding the write lock: another process may have started or finished a change meanwhile
+            begin_write(conn)
+            if conn.execute("SELECT target_version FROM key_rotation WHERE id = 1").fetchone()[0] is not None:
+                conn.rollback()
+                raise RotationInProgress()
+            if not verify_master_password(current_key, verify_path):
+                conn.rollback()
+                raise KeyVersionChanged()
+            store_kdf_config(kdf_config["current"], new_params, kdf_path)
+            conn.execute('''
+                UPDATE key_rotation
+                SET target_version = ?, last_id = 0, pending_verification = ?, started_at = CURRENT_TIMESTAMP
+                WHERE id = 1
+            ''', (target_version, new_cipher.encrypt(VERIFICATION_TOKEN)))
+            conn.commit()
+
+    # Re-encrypt all database credentials
+    processed, elapsed = rotate_credentials(current_key, new_key, target_version, last_id, vault=vault)
+    rate = processed / elapsed if elapsed > 0 else float(processed)
+    if not quiet:
+        print(Fore.CYAN + f"Re-encrypted {processed} credentials in {elapsed:.2f}s ({rate:.0f} rows/sec)."
+              + Style.RESET_ALL)
+
+    # Switch verify.bin over first: until kdf.json is updated, unlocking falls back to the pending parameters
+    store_verification(new_cipher, verify_path)
+    store_kdf_config(new_params, path=kdf_path)
+    with _connection(vault) as conn:
+        begin_write(conn)
+        conn.execute('''
+            UPDATE key_rotation
+            SET key_version = target_version, target_version = NULL, last_id = 0,
+                pending_verification = NULL, started_at = NULL
+            WHERE id = 1
+        ''')
+        conn.commit()
+
+    if not quiet:
+        print(Fore.GREEN + "Master password changed successfully!" + Style.RESET_ALL)
+
+    if new_password is None:
+        return session
+    new_session = KeySession(new_key, session.salt, new_params, new_password)
+    session.wipe()
+    return new_session
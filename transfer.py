@@ -0,0 +1,356 @@
+# transfer.py
+"""
+Streaming import/export of credentials.
+
+Plain formats: CSV (header row with service, username, password, url, notes)
+and JSON-lines (one object per line with the same keys). Backups use an
+encrypted single-file archive (see export_archive). Every reader and writer
+streams in chunks, so memory use stays flat regardless of vault size.
+Imports go through add_credentials_bulk (parallel encryption, batched
+transactional inserts); exports decrypt through the crypto executor.
+"""
+
+import base64
+import csv
+import io
+import json
+import os
+import struct
+import time
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import credentials
+from crypto_executor import DECRYPTION_FAILED
+from envelope import STORED_COLUMNS
+from security import calibrate_kdf, derive_key
+
+EXPORT_FIELDS = ('service', 'username', 'password', 'url', 'notes')
+EXPORT_CHUNK_SIZE = 1000     # Rows read, decrypted and written per chunk
+MAX_REPORTED_ERRORS = 1000   # Row errors kept in a report (all of them are counted)
+
+ARCHIVE_MAGIC = b"CIMEDDA-ARCHIVE\x00"
+ARCHIVE_VERSION = 1
+ARCHIVE_MAX_HEADER = 64 * 1024  # Bytes; real headers are a few hundred
+_DATA_FRAME, _END_FRAME = b"\x00", b"\x01"
+
+# Largest KDF cost an archive may ask for (calibrate_kdf stays well below these)
+ARCHIVE_KDF_LIMITS = {
+    "pbkdf2-sha256": {"iterations": 10_000_000},
+    "scrypt": {"n": 2 ** 20, "r": 16, "p": 16},
+    "argon2id": {"iterations": 16, "lanes": 64, "memory_cost": 1024 * 1024},  # memory_cost in KiB
+}
+
+
+class TransferReport:
+    """Outcome of an import or export: rows handled, per-row errors, throughput."""
+
+    def __init__(self):
+        self.rows = 0
+        self.error_count = 0
+        self.errors = []   # (input line number or credential id, message), capped at MAX_REPORTED_ERRORS
+        self.elapsed = 0.0
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed > 0 else float(self.rows)
+
+    def __repr__(self):
+        return (f"TransferReport(rows={self.rows}, errors={self.error_count}, "
+                f"elapsed={self.elapsed:.2f}s, rate={self.rows_per_second:.0f} rows/sec)")
+
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    return 'archive'
+
+
+# --------------------------------------------------------------------------------
+# Import
+# --------------------------------------------------------------------------------
+def _text_fields(record):
+    """The credential fields of `record` as strings, or an error message for the first bad one."""
+    fields = {}
+    for field in ('service', 'username', 'password', 'url', 'notes'):
+        value = record.get(field)
+        if value is None:
+            value = ''
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and field != 'service':
+            value = str(value)  # e.g. an all-digit PIN written as a JSON number
+        elif not isinstance(value, str):
+            return None, f"{field} must be text, not {type(value).__name__}"
+        fields[field] = value
+    return fields, None
+
+
+def _validated(records, report):
+    """Yield importable credential dicts from (line, record) pairs, reporting the rest."""
+    for line, record in records:
+        if not isinstance(record, dict):
+            report.add_error(line, "expected an object with service/password fields")
+            continue
+        fields, error = _text_fields(record)
+        if error:
+            report.add_error(line, error)
+            continue
+        fields['service'] = fields['service'].strip()
+        if not fields['service']:
+            report.add_error(line, "missing service")
+            continue
+        if not fields['password']:
+            report.add_error(line, "missing password")
+            continue
+        report.rows += 1
+        yield fields
+
+
+def _csv_records(stream):
+    reader = csv.DictReader(stream)
+    if reader.fieldnames is None:
+        return
+    reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+    for record in reader:
+        yield reader.line_num, record
+
+
+def _jsonl_records(stream, report):
+    for line_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError as e:
+            report.add_error(line_number, f"invalid JSON: {e}")
+
+
+def _import_records(records, report, batch_size, commit_every, vault):
+    started = time.perf_counter()
+    credentials.add_credentials_bulk(_validated(records, report), batch_size, commit_every, vault)
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def import_csv(path, batch_size=credentials.BULK_BATCH_SIZE, commit_every=None, vault=None):
+    report = TransferReport()
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        return _import_records(_csv_records(f), report, batch_size, commit_every, vault)
+
+
+def import_jsonl(path, batch_size=credentials.BULK_BATCH_SIZE, commit_every=None, vault=None):
+    report = TransferReport()
+    with open(path, 'r', encoding='utf-8') as f:
+        return _import_records(_jsonl_records(f, report), report, batch_size, commit_every, vault)
+
+
+# --------------------------------------------------------------------------------
+# Export
+# --------------------------------------------------------------------------------
+def iter_decrypted_chunks(report, chunk_size=EXPORT_CHUNK_SIZE, vault=None):
+    """Yield lists of decrypted credential dicts in id order, one chunk at a time."""
+    executor = credentials.get_crypto_executor(vault)   # Raises VaultLocked if the vault is locked
+    vault = credentials.default_vault() if vault is None else vault
+    last_id = 0
+    while True:
+        with vault.connection() as conn:
+            rows = conn.execute(f'''
+                SELECT {STORED_COLUMNS}
+                FROM credentials
+                WHERE id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (last_id, chunk_size)).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+
+        chunk = []
+        for row in executor.open_rows(rows):
+            if DECRYPTION_FAILED in row:
+                vault.check_key_version()  # Rather than skip every row of a vault re-keyed elsewhere
+                report.add_error(row[0], "decryption failed, row skipped")
+                continue
+            chunk.append(dict(zip(EXPORT_FIELDS, row[1:])))
+        report.rows += len(chunk)
+        yield chunk
+
+
+def _open_private(path, mode, **kwargs):
+    """open() for files holding secrets: readable by the owner only, whatever the umask."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    if hasattr(os, 'fchmod'):
+        os.fchmod(fd, 0o600)  # The file may have existed with looser permissions
+    return os.fdopen(fd, mode, **kwargs)
+
+
+def export_csv(path, chunk_size=EXPORT_CHUNK_SIZE, vault=None):
+    """Write every credential, decrypted, to a CSV file. The file is NOT encrypted."""
+    report = TransferReport()
+    started = time.perf_counter()
+    with _open_private(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+        for chunk in iter_decrypted_chunks(report, chunk_size, vault):
+            writer.writerows(chunk)
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def export_jsonl(path, chunk_size=EXPORT_CHUNK_SIZE, vault=None):
+    """Write every credential, decrypted, to a JSON-lines file. The file is NOT encrypted."""
+    report = TransferReport()
+    started = time.perf_counter()
+    with _open_private(path, 'w', encoding='utf-8') as f:
+        for chunk in iter_decrypted_chunks(report, chunk_size, vault):
+            f.write(''.join(json.dumps(record) + '\n' for record in chunk))
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+# --------------------------------------------------------------------------------
+# Encrypted archive
+#
+#   magic | header length (4 bytes) | header JSON (version, KDF params, salt)
+#   frames: length (4 bytes) | nonce (12 bytes) | AES-256-GCM ciphertext
+#
+# Each frame holds a type byte followed by a JSON-lines chunk. The header and
+# the frame index are bound as associated data, so frames can't be swapped,
+# reordered or replayed from another archive; a final END frame carrying the
+# row count detects truncation.
+# --------------------------------------------------------------------------------
+def _frame_ad(header, index):
+    return header + struct.pack('>Q', index)
+
+
+def _write_frame(f, aead, header, index, payload):
+    nonce = os.urandom(12)
+    sealed = aead.encrypt(nonce, payload, _frame_ad(header, index))
+    f.write(struct.pack('>I', len(sealed) + 12) + nonce + sealed)
+
+
+def export_archive(path, passphrase: bytes, chunk_size=EXPORT_CHUNK_SIZE, vault=None):
+    """Write an encrypted, self-contained backup of every credential, protected by `passphrase`."""
+    report = TransferReport()
+    started = time.perf_counter()
+
+    salt = os.urandom(16)
+    params = calibrate_kdf()
+    aead = AESGCM(derive_key(passphrase, salt, params=params))
+    header = json.dumps({
+        "version": ARCHIVE_VERSION,
+        "kdf": params,
+        "salt": base64.b64encode(salt).decode(),
+    }).encode()
+
+    tmp_path = path + '.tmp'
+    with _open_private(tmp_path, 'wb') as f:
+        f.write(ARCHIVE_MAGIC + struct.pack('>I', len(header)) + header)
+        index = 0
+        for chunk in iter_decrypted_chunks(report, chunk_size, vault):
+            payload = ''.join(json.dumps(record) + '\n' for record in chunk).encode()
+            _write_frame(f, aead, header, index, _DATA_FRAME + payload)
+            index += 1
+        _write_frame(f, aead, header, index, _END_FRAME + json.dumps({"rows": report.rows}).encode())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    report.elapsed = time.perf_counter() - started
+    return report
+
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Archive is truncated.")
+    return data
+
+
+def _archive_kdf_params(params):
+    """The header's KDF parameters, if they are well-formed and affordable."""
+    limits = ARCHIVE_KDF_LIMITS.get(params.get("algorithm")) if isinstance(params, dict) else None
+    if limits is None or set(params) != {"algorithm", *limits}:
+        raise ValueError("Not a CimeddaManager archive (unknown key derivation parameters).")
+    for name, limit in limits.items():
+        value = params[name]
+        if not isinstance(value, int) or isinstance(value, bool) or not 1 <= value <= limit:
+            raise ValueError(f"Archive asks for an unsupported key derivation cost ({name}={value!r}).")
+    return params
+
+
+def _archive_records(f, passphrase, report):
+    if f.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+        raise ValueError("Not a CimeddaManager archive.")
+    header_length = struct.unpack('>I', _read_exact(f, 4))[0]
+    if header_length > ARCHIVE_MAX_HEADER:
+        raise ValueError("Not a CimeddaManager archive (header too large).")
+    header = _read_exact(f, header_length)
+    meta = json.loads(header)
+    if not isinstance(meta, dict):
+        raise ValueError("Not a CimeddaManager archive.")
+    if meta.get("version") != ARCHIVE_VERSION:
+        raise ValueError(f"Unsupported archive version: {meta.get('version')}")
+    if not isinstance(meta.get("salt"), str):
+        raise ValueError("Not a CimeddaManager archive (no salt).")
+    params = _archive_kdf_params(meta.get("kdf"))
+    aead = AESGCM(derive_key(passphrase, base64.b64decode(meta["salt"], validate=True), params=params))
+
+    index = 0
+    line_number = 0
+    while True:
+        length_bytes = f.read(4)
+        if not length_bytes:
+            raise ValueError("Archive is truncated (no end marker).")
+        frame = _read_exact(f, struct.unpack('>I', length_bytes)[0])
+        try:
+            payload = aead.decrypt(frame[:12], frame[12:], _frame_ad(header, index))
+        except InvalidTag:
+            raise ValueError("Wrong passphrase or corrupted archive.") from None
+        index += 1
+
+        if payload[:1] == _END_FRAME:
+            return
+        for line in io.StringIO(payload[1:].decode()):
+            line_number += 1
+            yield line_number, json.loads(line)
+
+
+def import_archive(path, passphrase: bytes, batch_size=credentials.BULK_BATCH_SIZE, vault=None):
+    """
+    Restore credentials from an encrypted archive. The import is one transaction:
+    a wrong passphrase, tampering or truncation leaves the vault untouched.
+    """
+    report = TransferReport()
+    with open(path, 'rb') as f:
+        return _import_records(_archive_records(f, passphrase, report), report, batch_size, None, vault)
+
+
+# --------------------------------------------------------------------------------
+# Format dispatch
+# --------------------------------------------------------------------------------
+def import_file(path, fmt=None, passphrase: bytes = None, vault=None):
+    fmt = fmt or detect_format(path)
+    if fmt == 'csv':
+        return import_csv(path, vault=vault)
+    if fmt == 'jsonl':
+        return import_jsonl(path, vault=vault)
+    return import_archive(path, passphrase, vault=vault)
+
+
+def export_file(path, fmt=None, passphrase: bytes = None, vault=None):
+    fmt = fmt or detect_format(path)
+    if fmt == 'csv':
+        return export_csv(path, vault=vault)
+    if fmt == 'jsonl':
+        return export_jsonl(path, vault=vault)
+    return export_archive(path, passphrase, vault=vault)
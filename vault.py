@@ -0,0 +1,407 @@
+# vault.py
+"""
+A Vault bundles everything one password database needs: its files (database,
+salt, verification token, KDF parameters), a connection pool, the unlocked key
+session and its ciphers, the crypto executor, the decrypted-record cache and
+the service search index.
+
+Vaults don't share any state, so one process can keep several open (one per
+team or environment) and lock each of them on its own. The functions in
+credentials.py work on the default vault (the files in the working directory)
+unless they are given vault=...:
+
+    staging = Vault("vaults/staging")
+    if staging.open(password):
+        credentials.get_credential("github", vault=staging)
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import db_setup
+from crypto_executor import CryptoExecutor, cipher_from_key
+from envelope import RecordCipher
+from search import ServiceIndex, TokenHasher
+from security import (KDF_PARAMS_PATH, create_master_password, matches_verification, open_session,
+                      unlock_session, verify_master_password)
+
+# Parallel record crypto used by the bulk operations (None = one worker per CPU)
+CRYPTO_WORKERS = None
+CRYPTO_CHUNK_SIZE = 256
+CRYPTO_USE_PROCESSES = False
+
+# Decrypted-record cache defaults (the cache is off until enable_cache() is called)
+CACHE_MAX_ENTRIES = 256
+CACHE_TTL = 60  # Seconds a decrypted record may be served from memory
+
+
+class RecordCache:
+    """Thread-safe LRU cache of decrypted records with a per-entry time-to-live."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # service -> (expires_at, record)
+        self._lock = threading.Lock()
+
+    def get(self, service):
+        with self._lock:
+            entry = self._entries.get(service)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[service]
+                return None
+            self._entries.move_to_end(service)
+            return entry[1]
+
+    def put(self, service, record):
+        with self._lock:
+            self._entries[service] = (time.monotonic() + self.ttl, record)
+            self._entries.move_to_end(service)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, service):
+        with self._lock:
+            self._entries.pop(service, None)
+
+    def clear(self, release=False):
+        with self._lock:
+            if release:
+                for _, record in self._entries.values():
+                    record.release()
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class VaultLocked(RuntimeError):
+    """Raised when a locked vault is used."""
+
+
+class AutoLock:
+    """
+    Calls `on_lock` once `timeout` seconds pass without touch().
+
+    A single thread sleeps until the current deadline. touch() only moves the
+    deadline (no wakeup); when the thread wakes it goes back to sleep until the
+    new deadline if there was activity meanwhile. A session therefore costs at
+    most one wakeup per timeout period, idle or busy.
+    """
+
+    def __init__(self, on_lock, timeout):
+        self.on_lock = on_lock
+        self.timeout = timeout
+        self._deadline = 0.0
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self._condition:
+            self._deadline = time.monotonic() + self.timeout
+            self._stopped = False
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="autolock", daemon=True)
+                self._thread.start()
+
+    def touch(self):
+        # A plain store: the sleeping thread reads the new deadline when it wakes up
+        self._deadline = time.monotonic() + self.timeout
+
+    def stop(self):
+        """Cancel without locking."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def lock_now(self):
+        with self._condition:
+            self._deadline = 0.0
+            self._condition.notify()
+
+    def _run(self):
+        with self._condition:
+            while not self._stopped:
+                remaining = self._deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            if self._stopped:
+                return
+            self._stopped = True
+        self.on_lock()
+
+
+class Vault:
+    """
+    One password database and its key material.
+
+    Vault() is the default vault: the files in the working directory and the
+    process-wide connection pool (which follows db_setup.DB_PATH). Vault(directory)
+    keeps its own files in `directory` and owns a private pool.
+    """
+
+    def __init__(self, directory=None, pool_size=db_setup.POOL_SIZE, crypto_workers=CRYPTO_WORKERS,
+                 crypto_chunk_size=CRYPTO_CHUNK_SIZE, crypto_use_processes=CRYPTO_USE_PROCESSES):
+        self.directory = directory
+        if directory is None:
+            self.salt_path, self.verify_path, self.kdf_path = 'salt.bin', 'verify.bin', KDF_PARAMS_PATH
+        else:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            self.salt_path = os.path.join(directory, 'salt.bin')
+            self.verify_path = os.path.join(directory, 'verify.bin')
+            self.kdf_path = os.path.join(directory, KDF_PARAMS_PATH)
+        self.pool_size = pool_size
+        self.crypto_workers = crypto_workers
+        self.crypto_chunk_size = crypto_chunk_size
+        self.crypto_use_processes = crypto_use_processes
+
+        self.session = None
+        self.key = None
+        self.cipher = None
+        self.record_cipher = None
+        self.token_hasher = None
+        self.search_tokens_ready = False  # Set once every row is known to have its search tokens
+        self._key_version = None
+        self.cache = None
+        self.search_index = None
+        self._pool = None
+        self._executor = None
+        self._autolock = None
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        state = "unlocked" if self.unlocked else "locked"
+        return f"Vault({self.directory!r}, {state})"
+
+    # ----------------------------------------------------------------------------
+    # Database
+    # ----------------------------------------------------------------------------
+    @property
+    def db_path(self):
+        if self.directory is None:
+            return db_setup.DB_PATH
+        return os.path.join(self.directory, os.path.basename(db_setup.DB_PATH))
+
+    @property
+    def pool(self):
+        if self.directory is None:
+            return db_setup.get_pool()
+        with self._lock:
+            if self._pool is None:
+                self._pool = db_setup.ConnectionPool(self.db_path, self.pool_size)
+            return self._pool
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection from this vault's pool for the duration of a block."""
+        with self.pool.connection() as conn:
+            yield conn
+
+    def initialize_db(self, quiet=False):
+        db_setup.initialize_db(quiet, self.pool)
+
+    def close_pool(self):
+        if self.directory is None:
+            db_setup.close_pool()
+            return
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+
+    # ----------------------------------------------------------------------------
+    # Unlocking and locking
+    # ----------------------------------------------------------------------------
+    @property
+    def unlocked(self):
+        return self.record_cipher is not None
+
+    def require_unlocked(self):
+        """Raise VaultLocked unless the vault is unlocked; otherwise count as activity for the auto-lock."""
+        if self.record_cipher is None:
+            raise VaultLocked("The vault is locked.")
+        self.touch()
+
+    def unlock(self):
+        """Interactive unlock (prompts; creates the master password on first use)."""
+        self.set_session(unlock_session(self))
+
+    def open(self, master_password: bytes) -> bool:
+        """Non-interactive unlock. Returns False if the password is wrong or none is set yet."""
+        session = open_session(master_password, self)
+        if session is None:
+            return False
+        try:
+            self.set_session(session)
+        except db_setup.KeyVersionChanged:
+            # Another process changed the master password right after we checked this one
+            session.wipe()
+            return False
+        return True
+
+    def create(self, master_password: bytes):
+        """Set the master password of a new vault, create its database and unlock it."""
+        self.set_session(create_master_password(master_password, self))
+        self.initialize_db(quiet=True)
+
+    def set_session(self, session):
+        """Switch to another unlocked session, e.g. the one returned by change_master_password."""
+        with self._lock:
+            key_version = self._read_key_version(session.key)
+            self.session = session
+            self.set_key(session.key)
+            self._key_version = key_version
+
+    def _rotation_state(self):
+        try:
+            with self.connection() as conn:
+                return conn.execute(
+                    "SELECT key_version, target_version, pending_verification FROM key_rotation WHERE id = 1"
+                ).fetchone()
+        except sqlite3.OperationalError:
+            return None  # New database: initialize_db hasn't created the table yet
+
+    def _read_key_version(self, key):
+        """
+        The key_version `key` belongs to. While a master password change runs,
+        only the new key opens its pending token. Otherwise the key is checked
+        against verify.bin between two reads of key_rotation, so a change that
+        another process finishes meanwhile can't pair the old key with the new
+        version. Raises KeyVersionChanged if the key is no longer current.
+        """
+        while True:
+            state = self._rotation_state()
+            if state is None:
+                return None
+            key_version, target_version, pending_verification = state
+            if target_version is not None:
+                if pending_verification is not None and matches_verification(key, pending_verification):
+                    return target_version
+                return key_version
+            if not verify_master_password(key, self.verify_path):
+                raise db_setup.KeyVersionChanged()
+            if self._rotation_state() == state:
+                return key_version
+
+    @property
+    def key_version(self):
+        """Version of the unlocked key, as recorded in key_rotation when it was unlocked (see db_setup.begin_write)."""
+        if self._key_version is None and self.unlocked:
+            self._key_version = self._read_key_version(self.key)
+        return self._key_version
+
+    def check_key_version(self):
+        """
+        Called when a record doesn't decrypt. Raises RotationInProgress while a
+        master password change is re-encrypting the vault, or KeyVersionChanged
+        once one has finished since this vault was unlocked. Returns if the key
+        is current, i.e. the record itself is damaged.
+        """
+        state = self._rotation_state()
+        if state is None:
+            return
+        key_version, target_version, _ = state
+        if target_version is not None:
+            raise db_setup.RotationInProgress()
+        if key_version != self.key_version:
+            raise db_setup.KeyVersionChanged()
+
+    def set_key(self, key):
+        """Use `key` for every record from now on (drops cached records and the old executor)."""
+        with self._lock:
+            self.key = key
+            self.cipher = cipher_from_key(key)
+            self.record_cipher = RecordCipher(key, self.cipher)
+            self.token_hasher = TokenHasher(key)
+            self._shutdown_executor()
+            self.clear_cache()
+
+    def lock(self):
+        """Forget every piece of key material and decrypted data held for this vault."""
+        with self._lock:
+            self.stop_autolock()
+            self.clear_cache(release=True)
+            self._shutdown_executor()
+            if self.session is not None:
+                self.session.wipe()
+            self.session = None
+            self.key = None
+            self.cipher = None
+            self.record_cipher = None
+            self.token_hasher = None
+            self.search_tokens_ready = False
+            self._key_version = None
+            self.close_pool()
+
+    def start_autolock(self, timeout, on_lock=None):
+        """Lock this vault once it goes `timeout` seconds without use; `on_lock` is called right after."""
+        def lock():
+            self.lock()
+            if on_lock is not None:
+                on_lock()
+
+        with self._lock:
+            self.stop_autolock()
+            self._autolock = AutoLock(lock, timeout)
+            self._autolock.start()
+
+    def stop_autolock(self):
+        with self._lock:
+            if self._autolock is not None:
+                self._autolock.stop()
+                self._autolock = None
+
+    def touch(self):
+        """Record activity: push the auto-lock deadline back."""
+        autolock = self._autolock
+        if autolock is not None:
+            autolock.touch()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.lock()
+
+    # ----------------------------------------------------------------------------
+    # Crypto executor, record cache and search index
+    # ----------------------------------------------------------------------------
+    def crypto_executor(self):
+        """Executor for parallel record crypto with this vault's key (created on first use)."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = CryptoExecutor(self.key, self.crypto_workers, self.crypto_chunk_size,
+                                                self.crypto_use_processes)
+            return self._executor
+
+    def _shutdown_executor(self):
+        if self._executor is not None:
+            self._executor.close()
+            self._executor = None
+
+    def enable_cache(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.cache = RecordCache(max_entries, ttl)
+
+    def disable_cache(self):
+        self.clear_cache()
+        self.cache = None
+
+    def clear_cache(self, release=False):
+        if self.cache is not None:
+            self.cache.clear(release)
+
+    def get_search_index(self):
+        """The service-name index, built on first use and then kept up to date by every write."""
+        with self._lock:
+            if self.search_index is None:
+                with self.connection() as conn:
+                    self.search_index = ServiceIndex(conn.execute("SELECT id, service FROM credentials").fetchall())
+            return self.search_index